@@ -0,0 +1,120 @@
+"""
+Self-adaptive variation in the style of MO-CMA-ES (Igel, Hansen & Roth
+2007), vectorized over the population. Every row carries its own step size
+sigma and smoothed success rate p_succ in `pop.strategy`; an offspring is a
+success when it survives NSGA-II selection, and both it and its parent
+update sigma with the success rule. Instead of one full covariance per
+individual (D x D, out of reach for W+) a shared diagonal covariance is
+learned from the successful steps, as in sep-CMA-ES.
+"""
+import numpy as np
+from selection import nsga2_indices, tournament_dcd_indices
+from timing import timed
+
+#COLUMNS OF pop.strategy
+SIGMA, P_SUCC, PARENT = 0, 1, 2
+P_TARGET = 1 / (5 + np.sqrt(0.5)) #TARGET SUCCESS PROBABILITY OF THE SUCCESS RULE
+C_P = P_TARGET / (2 + P_TARGET) #SMOOTHING OF THE SUCCESS RATE
+
+class AdaptiveVariation():
+    """
+    Replaces select_parents / mate / mutate / select in the toolbox. Parents
+    are picked with the usual DCD tournament and mutated (no recombination)
+    as x + sigma * sqrt(C) * N(0, I). `damping` defaults to 1 + sqrt(D)
+    instead of MO-CMA-ES's 1 + D / 2, which barely moves sigma within a few
+    hundred generations at D = 512. `sigma0` None takes the mean per-gene
+    spread of the initial population, `sigma_max` caps the step size (far
+    from the mapping's output StyleGAN stops producing faces).
+    """
+
+    def __init__(self, sigma0=None, damping=None, p_target=P_TARGET, c_p=C_P, sigma_max=None):
+        self.sigma0 = sigma0
+        self.sigma_max = sigma_max
+        self.damping = damping
+        self.p_target = p_target
+        self.c_p = c_p
+        self.C = None
+
+    def init_strategy(self, pop):
+        sigma0 = self.sigma0
+        if sigma0 is None:
+            sigma0 = float(pop.latents.std(axis=0).mean()) or 1.0
+        strategy = np.empty((len(pop), 3))
+        strategy[:, SIGMA] = sigma0
+        strategy[:, P_SUCC] = self.p_target
+        strategy[:, PARENT] = -1
+        return strategy
+
+    @timed('selection')
+    def select_parents(self, pop, k):
+        """DCD tournament, every copy remembers the row of its parent"""
+        rows = tournament_dcd_indices(pop.fitness, pop.crowding, k)
+        out = pop.take(rows)
+        out.strategy[:, PARENT] = rows
+        return out
+
+    def mate(self, pop, cxpb=None):
+        # MO-CMA-ES has no recombination: a blend would break the parent/step bookkeeping
+        return pop
+
+    @timed('mutation')
+    def mutate(self, pop, mutpb=None):
+        """Mutates every row with its own step size, `mutpb` is ignored"""
+        if self.C is None:
+            self.C = np.ones(pop.latents.shape[1])
+        sigma = pop.strategy[:, SIGMA].astype(np.float32)
+        scale = np.sqrt(self.C).astype(np.float32)
+        noise = np.random.standard_normal(pop.latents.shape).astype(np.float32)
+        pop.latents += sigma[:, None] * scale * noise
+        pop.invalidate(slice(None))
+        return pop
+
+    @timed('selection')
+    def select(self, pop, k):
+        """
+        NSGA-II survival of parents + offspring (offspring being the rows with
+        a parent), then the success rule on sigma and the covariance update.
+        """
+        if pop.strategy is None:
+            pop.strategy = self.init_strategy(pop)
+        chosen, distances = nsga2_indices(pop.fitness, k)
+        strategy = pop.strategy.copy()
+        parents = strategy[:, PARENT].astype(np.intp)
+        children = np.flatnonzero(parents >= 0)
+        if len(children):
+            n = len(pop)
+            success = np.isin(children, chosen).astype(np.float64)
+            parents = parents[children]
+            # Parents count the mean success of all their offspring, like one smoothed step
+            n_children = np.bincount(parents, minlength=n)
+            rate = np.bincount(parents, success, minlength=n) / np.maximum(n_children, 1)
+            rate[children] = success
+            updated = np.flatnonzero(n_children > 0)
+            updated = np.concatenate([updated, children])
+            strategy[updated, P_SUCC] = (1 - self.c_p) * strategy[updated, P_SUCC] + self.c_p * rate[updated]
+
+            dim = pop.latents.shape[1]
+            damping = self.damping or 1 + np.sqrt(dim)
+            step_sigma = strategy[children, SIGMA]
+            strategy[updated, SIGMA] *= np.exp((strategy[updated, P_SUCC] - self.p_target)
+                                               / (damping * (1 - self.p_target)))
+            if self.sigma_max is not None:
+                np.minimum(strategy[:, SIGMA], self.sigma_max, out=strategy[:, SIGMA])
+
+            won = success > 0
+            if won.any():
+                # Steps that survived, in units of the sigma they were sampled with
+                y = (pop.latents[children[won]] - pop.latents[parents[won]]) / step_sigma[won, None]
+                c_cov = min(1.0, 2 * won.sum() / (3 * (dim + 2)))
+                C = np.ones(dim) if self.C is None else self.C
+                C = (1 - c_cov) * C + c_cov * (y.astype(np.float64) ** 2).mean(axis=0)
+                # Scale lives in sigma, C only keeps the shape
+                self.C = C / C.mean()
+        strategy[:, PARENT] = -1
+        pop.strategy = strategy
+        out = pop.take(chosen)
+        out.crowding = distances
+        return out
+
+    def mean_sigma(self, pop):
+        return float(pop.strategy[:, SIGMA].mean()) if pop.strategy is not None else float('nan')
@@ -0,0 +1,106 @@
+"""
+Fixed-box face alignment for generated images. StyleGAN's FFHQ faces are
+already aligned, so the box MTCNN would find is almost the same on every
+image: it is estimated once (python alignment.py) and then applied to the
+whole batch as one crop + resize. MTCNN itself only runs on real photos
+(utils/embeddings_referencia.py) and in the periodic AlignmentCheck.
+"""
+import numpy as np
+import torch.nn.functional as F
+
+#(LEFT, TOP, RIGHT, BOTTOM) AS FRACTIONS OF THE IMAGE, APPROXIMATE MTCNN BOX ON FFHQ, RE-ESTIMATE WITH python alignment.py
+FFHQ_FACE_BOX = (0.23, 0.25, 0.77, 0.84)
+
+def crop_resize(images, box, size):
+    """(n, 3, H, W) images cropped to `box` (fractions, None keeps the whole image) and resized to size x size"""
+    if box is not None:
+        h, w = images.shape[-2:]
+        left, top, right, bottom = box
+        rows = slice(int(round(top * h)), int(round(bottom * h)))
+        cols = slice(int(round(left * w)), int(round(right * w)))
+        images = images[..., rows, cols]
+    return F.interpolate(images, size=(size, size), mode='bilinear', align_corners=False, antialias=True)
+
+
+def detect_boxes(images, mtcnn):
+    """Most confident MTCNN box of each HWC uint8 image as fractions, NaN where nothing was found"""
+    images = np.asarray(images)
+    h, w = images.shape[1:3]
+    boxes, _ = mtcnn.detect(images)
+    out = np.full((len(images), 4), np.nan)
+    for i, found in enumerate(boxes):
+        if found is not None and len(found):
+            out[i] = np.asarray(found[0]) / (w, h, w, h)
+    return out
+
+
+def iou(a, b):
+    """Intersection over union of (left, top, right, bottom) boxes, row-wise"""
+    a, b = np.asarray(a, dtype=np.float64).reshape(-1, 4), np.asarray(b, dtype=np.float64).reshape(-1, 4)
+    inter_w = np.clip(np.minimum(a[:, 2], b[:, 2]) - np.maximum(a[:, 0], b[:, 0]), 0, None)
+    inter_h = np.clip(np.minimum(a[:, 3], b[:, 3]) - np.maximum(a[:, 1], b[:, 1]), 0, None)
+    inter = inter_w * inter_h
+    area = lambda x: (x[:, 2] - x[:, 0]) * (x[:, 3] - x[:, 1])
+    return inter / (area(a) + area(b) - inter)
+
+
+def make_mtcnn(device='cpu'):
+    from facenet_pytorch import MTCNN
+    # Same settings as the reference photos
+    return MTCNN(image_size=160, margin=0, device=device)
+
+
+def estimate_box(images, mtcnn=None):
+    """Median MTCNN box over a sample of generated images"""
+    boxes = detect_boxes(images, mtcnn or make_mtcnn())
+    boxes = boxes[~np.isnan(boxes).any(axis=1)]
+    if len(boxes) == 0:
+        raise ValueError("MTCNN found no face in the sample")
+    return tuple(float(v) for v in np.round(np.median(boxes, axis=0), 3))
+
+
+class AlignmentCheck():
+    """
+    Every `every` generations runs MTCNN on `n` images of the population and
+    compares the detections with the fixed box. Warns when the mean IoU
+    falls below `min_iou`, e.g. when evolution drifts to off-center faces.
+    """
+
+    def __init__(self, box, every=25, n=8, min_iou=0.7):
+        self.box = box
+        self.every = every
+        self.n = n
+        self.min_iou = min_iou
+        self.mtcnn = None
+        self.history = []
+        # Own generator, so checking does not shift the evolution's random stream
+        self.rng = np.random.default_rng(0)
+
+    def __call__(self, gen, pop, evaluator):
+        if self.box is None or gen % self.every != 0:
+            return None
+        if self.mtcnn is None:
+            self.mtcnn = make_mtcnn()
+        rows = self.rng.choice(len(pop), min(self.n, len(pop)), replace=False)
+        boxes = detect_boxes(evaluator.generate_batch(pop.latents[rows]), self.mtcnn)
+        # A missed detection counts as no overlap
+        score = float(np.nan_to_num(iou(boxes, self.box), nan=0.0).mean())
+        self.history.append((gen, score))
+        if score < self.min_iou:
+            print(f"Warning: generation {gen}, fixed face box IoU with MTCNN is {score:.2f}")
+        return score
+
+
+if __name__ == "__main__":
+    import torch
+    import fitness
+    from utils import cargar_modelo
+
+    # Truncated samples of W, faces like the ones the init population starts from
+    generator = cargar_modelo.cargar_generador()
+    evaluator = fitness.BatchEvaluator(generator, None, None, device=cargar_modelo.default_device())
+    z = np.random.RandomState(0).randn(64, generator.z_dim).astype(np.float32)
+    with torch.no_grad():
+        ws = generator.mapping(torch.from_numpy(z).to(evaluator.device), None, truncation_psi=0.7)[:, 0]
+    box = estimate_box(evaluator.generate_batch(ws.cpu().numpy()))
+    print(f"Face box over 64 samples: {box}")
@@ -0,0 +1,191 @@
+"""
+Throughput benchmark of the evolutionary loop with deterministic stub models.
+Runs on CPU with no downloads and writes a JSON file that can be diffed
+between commits:
+
+    python benchmark.py --output ../results/benchmark.json
+"""
+import argparse
+import json
+import platform
+import resource
+import subprocess
+import time
+from pathlib import Path
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from deap import base, creator
+import fitness
+from population import PopulationMatrix, cx_blend_matrix, mut_gaussian_matrix
+from selection import sel_nsga2, sel_tournament_dcd, ParetoArchive
+
+
+class StubGenerator(nn.Module):
+    """Same interface as StyleGAN's G_ema (mapping, synthesis, num_ws, w_dim), cost set by resolution and channels"""
+
+    def __init__(self, resolution=64, channels=32, w_dim=512, num_ws=18, seed=0):
+        super().__init__()
+        torch.manual_seed(seed)
+        self.z_dim = self.w_dim = w_dim
+        self.num_ws = num_ws
+        self.img_resolution = resolution
+        self.map = nn.Linear(w_dim, w_dim)
+        self.const = nn.Linear(w_dim, channels * 16)
+        n_up = int(np.log2(resolution // 4))
+        self.convs = nn.ModuleList(nn.Conv2d(channels, channels, 3, padding=1) for _ in range(n_up))
+        self.to_rgb = nn.Conv2d(channels, 3, 1)
+        self.channels = channels
+
+    def mapping(self, z, c, **kwargs):
+        return F.leaky_relu(self.map(z), 0.2).unsqueeze(1).repeat(1, self.num_ws, 1)
+
+    def synthesis(self, ws, **kwargs):
+        x = self.const(ws.mean(dim=1)).view(-1, self.channels, 4, 4)
+        for conv in self.convs:
+            x = F.leaky_relu(conv(F.interpolate(x, scale_factor=2)), 0.2)
+        return torch.tanh(self.to_rgb(x))
+
+    def forward(self, z, c):
+        return self.synthesis(self.mapping(z, c))
+
+
+class StubCNN(nn.Module):
+    """Small conv net standing in for FaceNet (out=512) or the gender classifier (out=2)"""
+
+    def __init__(self, out_features, channels=16, depth=3, seed=0):
+        super().__init__()
+        torch.manual_seed(seed)
+        layers = []
+        in_channels = 3
+        for _ in range(depth):
+            layers += [nn.Conv2d(in_channels, channels, 3, stride=2, padding=1), nn.ReLU()]
+            in_channels = channels
+        self.features = nn.Sequential(*layers)
+        self.head = nn.Linear(channels, out_features)
+
+    def forward(self, x):
+        return self.head(self.features(x).mean(dim=(2, 3)))
+
+
+def stub_evaluator(resolution=64, channels=32, cnn_channels=16, batch_size=16, latent_dim=512):
+    generator = StubGenerator(resolution, channels, w_dim=latent_dim).eval()
+    evaluator = fitness.BatchEvaluator(generator, StubCNN(512, cnn_channels).eval(),
+                                       StubCNN(2, cnn_channels, seed=1).eval(), batch_size=batch_size)
+    evaluator.set_target_embedding(np.ones(512, dtype=np.float32))
+    return evaluator
+
+
+def timed(func, repeat=3):
+    """Best wall time of `repeat` calls, in seconds"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_evaluation(evaluator, n=64, latent_dim=512):
+    latents = np.random.default_rng(0).normal(size=(n, latent_dim)).astype(np.float32)
+    seconds = timed(lambda: evaluator.evaluate_latents(latents), repeat=2)
+    return {'n': n, 'seconds': seconds, 'evals_per_sec': n / seconds}
+
+
+def bench_variation(mu=200, latent_dim=18 * 512):
+    rng = np.random.default_rng(0)
+    pop = PopulationMatrix(rng.normal(size=(mu, latent_dim)), rng.random((mu, 2)), creator.Individual)
+
+    def variation():
+        offspring = pop.take(np.arange(mu))
+        cx_blend_matrix(offspring, 0.9, 0.2)
+        mut_gaussian_matrix(offspring, 0.1, 0, 1, 0.1)
+    seconds = timed(variation)
+    return {'mu': mu, 'latent_dim': latent_dim, 'seconds': seconds, 'ops_per_sec': mu / seconds}
+
+
+def bench_selection(sizes=(100, 1000, 10000), latent_dim=64):
+    results = []
+    rng = np.random.default_rng(0)
+    for mu in sizes:
+        pop = PopulationMatrix(rng.normal(size=(2 * mu, latent_dim)), rng.random((2 * mu, 2)), creator.Individual)
+        archive = ParetoArchive(creator.Individual)
+        selected = sel_nsga2(pop, mu)
+        results.append({
+            'mu': mu,
+            'nsga2_seconds': timed(lambda: sel_nsga2(pop, mu)),
+            'tournament_dcd_seconds': timed(lambda: sel_tournament_dcd(selected, mu - mu % 4)),
+            'archive_update_seconds': timed(lambda: archive.update(pop), repeat=1),
+        })
+    return results
+
+
+def bench_generation(evaluator, mu=100, ngen=3, latent_dim=512):
+    """Latency of whole generations: parent selection, variation, evaluation, archive and survival"""
+    rng = np.random.default_rng(0)
+    pop = PopulationMatrix.from_seed(rng.normal(size=latent_dim), mu, 0.1, creator.Individual)
+    pop.fitness[:] = evaluator.evaluate_latents(pop.latents)
+    pop = sel_nsga2(pop, mu)
+    archive = ParetoArchive(creator.Individual)
+    archive.update(pop)
+    latencies = []
+    for _ in range(ngen):
+        start = time.perf_counter()
+        offspring = sel_tournament_dcd(pop, mu)
+        cx_blend_matrix(offspring, 0.9, 0.2)
+        mut_gaussian_matrix(offspring, 0.1, 0, 1, 0.1)
+        invalid = offspring.invalid_indices()
+        offspring.fitness[invalid] = evaluator.evaluate_latents(offspring.latents[invalid])
+        archive.update(offspring)
+        pop = sel_nsga2(pop.concat(offspring), mu)
+        latencies.append(time.perf_counter() - start)
+    return {'mu': mu, 'generations': ngen, 'mean_seconds': float(np.mean(latencies)),
+            'min_seconds': float(np.min(latencies))}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(quick=False, threads=None):
+    if threads:
+        torch.set_num_threads(threads)
+    np.random.seed(0)
+    if not hasattr(creator, "Individual"):
+        creator.create("FitnessMulti", base.Fitness, weights=(1.0, 1.0))
+        creator.create("Individual", np.ndarray, fitness=creator.FitnessMulti)
+
+    evaluator = stub_evaluator()
+    sizes = (100, 1000) if quick else (100, 1000, 10000)
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'torch_threads': torch.get_num_threads(),
+        'evaluation': bench_evaluation(evaluator, n=32 if quick else 128),
+        'variation': bench_variation(),
+        'selection': bench_selection(sizes),
+        'generation': bench_generation(evaluator, mu=40 if quick else 100, ngen=2 if quick else 3),
+    }
+    # ru_maxrss is in KiB on Linux
+    report['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--output', default='../results/benchmark.json')
+    parser.add_argument('--quick', action='store_true', help='smaller sizes, for a fast smoke run')
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    args = parser.parse_args()
+
+    report = run(args.quick, args.threads)
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print(json.dumps(report, indent=2, sort_keys=True))
@@ -0,0 +1,139 @@
+import json
+import os
+import pickle
+import random
+import threading
+from pathlib import Path
+import numpy as np
+import torch
+from deap import tools
+
+def rng_state():
+    """Python, NumPy and torch RNG states as uint8 arrays, so they fit in an .npz"""
+    return {
+        'rng_python': np.frombuffer(pickle.dumps(random.getstate()), dtype=np.uint8),
+        'rng_numpy': np.frombuffer(pickle.dumps(np.random.get_state()), dtype=np.uint8),
+        'rng_torch': torch.get_rng_state().numpy(),
+    }
+
+
+def set_rng_state(state):
+    random.setstate(pickle.loads(state['rng_python'].tobytes()))
+    np.random.set_state(pickle.loads(state['rng_numpy'].tobytes()))
+    torch.set_rng_state(torch.from_numpy(np.array(state['rng_torch'])))
+
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class LogbookWriter():
+    """Appends every logbook record to a JSON Lines file as soon as it is recorded"""
+
+    def __init__(self, path, truncate_after=None):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if truncate_after is None:
+            self.file = open(self.path, 'w')
+        else:
+            # Resuming: drop the generations logged after the checkpoint, they will be run again
+            records = [r for r in read_logbook_records(self.path) if r['gen'] <= truncate_after]
+            self.file = open(self.path, 'w')
+            for record in records:
+                self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def write(self, record):
+        self.file.write(json.dumps({key: _to_json(value) for key, value in record.items()}) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_logbook_records(path):
+    path = Path(path)
+    if not path.exists():
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def load_logbook(path, header=None):
+    """tools.Logbook rebuilt from the JSON Lines file, statistics back as arrays"""
+    logbook = tools.Logbook()
+    if header is not None:
+        logbook.header = header
+    for record in read_logbook_records(path):
+        logbook.record(**{key: np.asarray(value) if isinstance(value, list) else value
+                          for key, value in record.items()})
+    return logbook
+
+
+class CheckpointWriter():
+    """
+    Writes checkpoints from a background thread. save() snapshots the state
+    on the caller's thread (copies of the matrices and the RNG states) and
+    returns at once; the thread writes a temporary .npz and renames it over
+    the previous checkpoint, so the file on disk is always complete. If the
+    thread is still busy the pending snapshot is replaced by the newer one.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.pending = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def save(self, gen, pop, pareto_front, **extra):
+        snapshot = {
+            'gen': np.array(gen),
+            'latents': pop.latents.copy(),
+            'fitness': pop.fitness.copy(),
+            'crowding': np.zeros(0) if pop.crowding is None else pop.crowding.copy(),
+            'strategy': np.zeros(0) if pop.strategy is None else pop.strategy.copy(),
+            'archive_latents': pareto_front.latents.copy() if len(pareto_front) else pop.latents[:0].copy(),
+            'archive_fitness': pareto_front.fitness.copy() if len(pareto_front) else pop.fitness[:0].copy(),
+            **rng_state(),
+        }
+        snapshot.update({key: np.array(value, copy=True) for key, value in extra.items()})
+        with self.condition:
+            self.pending = snapshot
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.closed:
+                    self.condition.wait()
+                if self.pending is None:
+                    return
+                snapshot, self.pending = self.pending, None
+            self.write(snapshot)
+
+    def write(self, snapshot):
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp, 'wb') as f:
+            np.savez(f, **snapshot)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def close(self):
+        """Waits for the last pending checkpoint to be on disk"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+
+def load_checkpoint(path):
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
@@ -0,0 +1,312 @@
+"""
+Distilled gender scorer for f2. A small student learns the teacher
+classifier's probability on generated faces: either a tiny CNN on a 64 px
+crop or a linear probe on the W+ latent, which skips the crop altogether.
+With a student in the evaluator every offspring is scored by it, and
+TeacherCheck re-scores only the archive members with the real classifier.
+
+    python distill.py    # labels faces with the teacher, trains both students,
+                         # writes results/student/student_{kind}.pt + calibration_{kind}.json
+"""
+import json
+import time
+from pathlib import Path
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from alignment import crop_resize
+from population import PopulationMatrix
+from selection import ParetoArchive
+
+STUDENT_DIR = Path('../results/student')
+STUDENT_SIZE = 64 #INPUT RESOLUTION OF THE CNN STUDENT
+N_SAMPLES = 6000 #FACES LABELED BY THE TEACHER
+PERTURBATIONS = (0.1, 0.5, 1.0) #SPREAD AROUND THE INIT POPULATION, WHERE THE EVOLUTION SEARCHES
+TRUNCATION = 0.7
+N_BINS = 10 #BINS OF THE RELIABILITY TABLE
+
+class TinyGenderCNN(nn.Module):
+    """Four stride-2 conv blocks and a linear head, one logit for class 1"""
+
+    def __init__(self, width=16):
+        super().__init__()
+        layers = []
+        c_in = 3
+        for c_out in (width, 2 * width, 4 * width, 4 * width):
+            layers += [nn.Conv2d(c_in, c_out, 3, stride=2, padding=1), nn.BatchNorm2d(c_out), nn.ReLU(inplace=True)]
+            c_in = c_out
+        self.features = nn.Sequential(*layers)
+        self.head = nn.Linear(c_in, 1)
+
+    def forward(self, x):
+        return self.head(self.features(x).mean(dim=(2, 3))).squeeze(1)
+
+
+class LinearProbe(nn.Module):
+    """Logistic regression on the standardized, flattened W+ latent"""
+
+    def __init__(self, dim):
+        super().__init__()
+        self.register_buffer('mean', torch.zeros(dim))
+        self.register_buffer('std', torch.ones(dim))
+        self.linear = nn.Linear(dim, 1)
+
+    def forward(self, x):
+        return self.linear((x - self.mean) / self.std).squeeze(1)
+
+
+class GenderStudent():
+    """
+    Student scorer with the interface of BatchEvaluator.gender_probability:
+    probability of the requested class from the images (kind 'cnn') or from
+    the ws (kind 'probe'). Logits are divided by the fitted temperature.
+    """
+
+    def __init__(self, kind, model, temperature=1.0, size=STUDENT_SIZE, box=None):
+        if kind not in ('cnn', 'probe'):
+            raise ValueError(f"unknown student kind {kind!r}")
+        self.kind = kind
+        self.model = model.eval().requires_grad_(False)
+        self.temperature = temperature
+        self.size = size
+        self.box = box
+
+    def to(self, device):
+        self.model.to(device)
+        return self
+
+    def inputs(self, images, ws):
+        if self.kind == 'probe':
+            return ws.flatten(1).to(torch.float32)
+        return crop_resize(images, self.box, self.size)
+
+    def probability(self, images, ws, classes):
+        p = torch.sigmoid(self.model(self.inputs(images, ws)) / self.temperature)
+        return torch.where(classes == 1, p, 1 - p)
+
+
+def sample_latents(generator, n, seeds=None, perturbations=PERTURBATIONS, truncation=TRUNCATION, seed=0):
+    """
+    Half of the faces from the mapping network (both genders, all kinds of
+    faces), half perturbed from the `seeds` rows (the init population).
+    Returned as flattened ws (n, num_ws * w_dim) so W and W+ seeds mix.
+    """
+    rng = np.random.RandomState(seed)
+    num_ws, w_dim = generator.num_ws, generator.w_dim
+    n_seeded = n // 2 if seeds is not None and len(seeds) else 0
+    device = next(generator.parameters()).device
+    z = torch.from_numpy(rng.randn(n - n_seeded, generator.z_dim).astype(np.float32)).to(device)
+    with torch.no_grad():
+        ws = generator.mapping(z, None, truncation_psi=truncation).cpu().numpy().reshape(len(z), -1)
+    if n_seeded:
+        seeds = np.asarray(seeds, dtype=np.float32)
+        if seeds.shape[1] == w_dim:
+            seeds = np.tile(seeds, (1, num_ws))
+        rows = seeds[rng.randint(len(seeds), size=n_seeded)]
+        scales = np.asarray(perturbations, dtype=np.float32)[rng.randint(len(perturbations), size=n_seeded)]
+        noise = rng.randn(n_seeded, w_dim).astype(np.float32) * scales[:, None]
+        # Same W offset on every layer, like the mutations of a W genome
+        ws = np.concatenate([ws, rows + np.tile(noise, (1, num_ws))])
+    return ws[rng.permutation(len(ws))]
+
+
+@torch.no_grad()
+def teacher_data(evaluator, latents, size=STUDENT_SIZE):
+    """
+    Teacher probability of class 1 for every latent, together with the
+    inputs of both students: the (n, 3, size, size) crops as uint8 and the
+    flattened ws. Also returns the teacher's seconds per image.
+    """
+    n = len(latents)
+    probs = np.empty(n, dtype=np.float32)
+    crops = np.empty((n, 3, size, size), dtype=np.uint8)
+    features = None
+    seconds = 0.0
+    for start, ws in evaluator.batches(latents):
+        rows = slice(start, start + len(ws))
+        images = evaluator.synthesize(ws)
+        tick = time.perf_counter()
+        probs[rows] = evaluator.gender_probability(images, torch.ones(len(ws), dtype=torch.long,
+                                                                      device=images.device)).cpu().numpy()
+        seconds += time.perf_counter() - tick
+        crop = crop_resize(images, evaluator.classifier_box, size)
+        crops[rows] = ((crop + 1) * 127.5).round().clamp(0, 255).to(torch.uint8).cpu().numpy()
+        if features is None:
+            features = np.empty((n, ws[0].numel()), dtype=np.float32)
+        features[rows] = ws.flatten(1).cpu().numpy()
+    return probs, crops, features, seconds / max(n, 1)
+
+
+def _as_input(kind, x):
+    x = torch.as_tensor(x)
+    return x.to(torch.float32) / 127.5 - 1 if kind == 'cnn' else x.to(torch.float32)
+
+
+def _logits(model, kind, x, batch_size=512):
+    model.eval()
+    with torch.no_grad():
+        return torch.cat([model(_as_input(kind, x[i:i + batch_size])) for i in range(0, len(x), batch_size)])
+
+
+def train_student(kind, x, p, epochs=30, lr=1e-3, weight_decay=1e-4, batch_size=128, seed=0):
+    """Fits the student to the teacher's soft labels `p` (binary cross-entropy on probabilities)"""
+    torch.manual_seed(seed)
+    if kind == 'cnn':
+        model = TinyGenderCNN()
+    else:
+        model = LinearProbe(x.shape[1])
+        model.mean.copy_(torch.as_tensor(x.mean(axis=0)))
+        model.std.copy_(torch.as_tensor(x.std(axis=0) + 1e-6))
+    optimizer = torch.optim.AdamW(model.parameters(), lr=lr, weight_decay=weight_decay)
+    targets = torch.as_tensor(p, dtype=torch.float32)
+    rng = np.random.RandomState(seed)
+    for _ in range(epochs):
+        model.train()
+        for batch in np.array_split(rng.permutation(len(x)), max(1, len(x) // batch_size)):
+            loss = F.binary_cross_entropy_with_logits(model(_as_input(kind, x[batch])), targets[batch])
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+    return model.eval()
+
+
+def fit_temperature(logits, p):
+    """Temperature minimizing the soft cross-entropy to the teacher on held-out faces"""
+    p = torch.as_tensor(p, dtype=torch.float32)
+    grid = np.exp(np.linspace(np.log(0.25), np.log(4.0), 61))
+    losses = [F.binary_cross_entropy_with_logits(logits / t, p).item() for t in grid]
+    return float(grid[int(np.argmin(losses))])
+
+
+def calibration_report(student_p, teacher_p, n_bins=N_BINS):
+    """How well the student reproduces the teacher: errors, agreement, rank order and a reliability table"""
+    student_p = np.asarray(student_p, dtype=np.float64)
+    teacher_p = np.asarray(teacher_p, dtype=np.float64)
+    bins = np.minimum((student_p * n_bins).astype(int), n_bins - 1)
+    table = []
+    ece = 0.0
+    for b in range(n_bins):
+        rows = bins == b
+        if not rows.any():
+            continue
+        gap = abs(student_p[rows].mean() - teacher_p[rows].mean())
+        ece += rows.mean() * gap
+        table.append({'bin': [b / n_bins, (b + 1) / n_bins], 'count': int(rows.sum()),
+                      'student': float(student_p[rows].mean()), 'teacher': float(teacher_p[rows].mean())})
+    rank = lambda v: np.argsort(np.argsort(v))
+    return {
+        'n': len(student_p),
+        'mae': float(np.abs(student_p - teacher_p).mean()),
+        'max_error': float(np.abs(student_p - teacher_p).max()),
+        'agreement': float(((student_p > 0.5) == (teacher_p > 0.5)).mean()),
+        'brier': float(((student_p - (teacher_p > 0.5)) ** 2).mean()),
+        'ece': float(ece),
+        # NSGA-II only looks at the order of f2 values
+        'rank_corr': float(np.corrcoef(rank(student_p), rank(teacher_p))[0, 1]),
+        'reliability': table,
+    }
+
+
+def save_student(path, student, **meta):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    config = {'dim': student.model.linear.in_features} if student.kind == 'probe' else {}
+    torch.save({'kind': student.kind, 'state_dict': student.model.state_dict(), 'temperature': student.temperature,
+                'size': student.size, 'box': student.box, 'config': config, 'meta': meta}, path)
+
+
+def load_student(path, device='cpu'):
+    data = torch.load(path, map_location='cpu', weights_only=False)
+    model = LinearProbe(**data['config']) if data['kind'] == 'probe' else TinyGenderCNN(**data['config'])
+    model.load_state_dict(data['state_dict'])
+    return GenderStudent(data['kind'], model, data['temperature'], data['size'], data['box']).to(device)
+
+
+def distill(evaluator, seeds=None, n=N_SAMPLES, kinds=('probe', 'cnn'), output_dir=STUDENT_DIR,
+            val_fraction=0.2, seed=0, meta=None):
+    """Labels `n` faces with the teacher once and trains, calibrates and exports one student per kind"""
+    output_dir = Path(output_dir)
+    latents = sample_latents(evaluator.generator, n, seeds, seed=seed)
+    probs, crops, features, teacher_seconds = teacher_data(evaluator, latents)
+    n_val = max(1, int(n * val_fraction))
+    train, val = slice(n_val, None), slice(0, n_val)
+    reports = {}
+    for kind in kinds:
+        x = crops if kind == 'cnn' else features
+        model = train_student(kind, x[train], probs[train], seed=seed)
+        logits = _logits(model, kind, x[val])
+        temperature = fit_temperature(logits, probs[val])
+        student = GenderStudent(kind, model, temperature, crops.shape[-1], evaluator.classifier_box)
+
+        tick = time.perf_counter()
+        _logits(model, kind, x[val])
+        student_seconds = (time.perf_counter() - tick) / n_val
+        report = calibration_report(torch.sigmoid(logits / temperature).numpy(), probs[val])
+        report.update(kind=kind, temperature=temperature, uncalibrated=calibration_report(
+            torch.sigmoid(logits).numpy(), probs[val]), n_train=n - n_val,
+            ms_per_image={'student': 1000 * student_seconds, 'teacher': 1000 * teacher_seconds}, **(meta or {}))
+        save_student(output_dir / f'student_{kind}.pt', student, **(meta or {}))
+        (output_dir / f'calibration_{kind}.json').write_text(json.dumps(report, indent=1))
+        reports[kind] = report
+        print(f"{kind}: mae {report['mae']:.4f}, agreement {report['agreement']:.3f}, ece {report['ece']:.4f}, "
+              f"rank corr {report['rank_corr']:.3f}, T = {temperature:.2f}")
+    return reports
+
+
+class TeacherCheck():
+    """
+    Teacher f2 for archive members only, each distinct latent scored once.
+    Calling it returns the mean |student - teacher| gap over the archive;
+    rescore() rebuilds the archive with teacher f2 (f1 is unchanged),
+    rescore_population() does the same for a population.
+    """
+
+    def __init__(self, evaluator):
+        self.evaluator = evaluator
+        self.scores = {}
+
+    def reset(self):
+        """Forget the scores, e.g. after the render resolution changed"""
+        self.scores = {}
+
+    def teacher_f2(self, latents):
+        latents = np.ascontiguousarray(latents, dtype=np.float32)
+        keys = [row.tobytes() for row in latents]
+        new = [i for i, key in enumerate(keys) if key not in self.scores]
+        if new:
+            for i, value in zip(new, self.evaluator.teacher_probabilities(latents[new])):
+                self.scores[keys[i]] = float(value)
+        return np.array([self.scores[key] for key in keys])
+
+    def __call__(self, pareto_front):
+        if not len(pareto_front):
+            return float('nan')
+        return float(np.abs(pareto_front.fitness[:, 1] - self.teacher_f2(pareto_front.latents)).mean())
+
+    def rescore(self, pareto_front):
+        rescored = ParetoArchive(pareto_front.icls)
+        if len(pareto_front):
+            fits = pareto_front.fitness.copy()
+            fits[:, 1] = self.teacher_f2(pareto_front.latents)
+            rescored.update(PopulationMatrix(pareto_front.latents, fits, pareto_front.icls))
+        return rescored
+
+    def rescore_population(self, pop):
+        """Copy of `pop` with teacher f2, crowding is left to the caller's next selection"""
+        pop = pop.take(np.arange(len(pop)))
+        if len(pop):
+            pop.fitness[:, 1] = self.teacher_f2(pop.latents)
+        return pop
+
+
+if __name__ == "__main__":
+    from fitness_cache import model_version
+    from main import load_evaluator, load_population
+    from utils import cargar_modelo
+
+    evaluator = load_evaluator(workers=0)
+    evaluator.student = None
+    distill(evaluator, seeds=load_population().population_init,
+            meta={'teacher': model_version(cargar_modelo.CLASSIFIER_PATH),
+                  'generator': model_version(cargar_modelo.PKL_PATH)})
@@ -0,0 +1,55 @@
+import numpy as np
+from selection import ParetoArchive
+
+class FidelityScheduler():
+    """
+    Renders early generations at reduced resolution and moves to the next
+    level once the hypervolume stops improving: less than `min_improvement`
+    relative gain over the last `patience` generations. None in `levels`
+    stands for the generator's full resolution.
+    FaceNet and the gender classifier only see 160 and 224 px inputs, so
+    256 px renders already score close to full fidelity.
+    """
+
+    def __init__(self, levels=(256, 512, None), patience=5, min_improvement=1e-3):
+        self.levels = list(levels)
+        self.patience = patience
+        self.min_improvement = min_improvement
+        self.level = 0
+        self.history = []
+
+    @property
+    def resolution(self):
+        return self.levels[self.level]
+
+    @property
+    def full(self):
+        return self.resolution is None
+
+    def update(self, hypervolume):
+        """Records this generation's hypervolume, True when the fidelity level went up"""
+        self.history.append(hypervolume)
+        if self.level == len(self.levels) - 1 or len(self.history) <= self.patience:
+            return False
+        old = self.history[-1 - self.patience]
+        if hypervolume - old > self.min_improvement * max(abs(old), 1e-12):
+            return False
+        self.level += 1
+        self.history = []
+        return True
+
+
+def rescore(pop, evaluate):
+    """Copy of `pop` with every row evaluated again at the current fidelity"""
+    pop = pop.take(np.arange(len(pop)))
+    pop.invalidate(slice(None))
+    evaluate(pop)
+    return pop
+
+
+def rescore_archive(pareto_front, evaluate):
+    """Rebuilds the archive from its members scored at the current fidelity"""
+    rescored = ParetoArchive(pareto_front.icls)
+    if len(pareto_front):
+        rescored.update(rescore(pareto_front.front, evaluate))
+    return rescored
@@ -1,8 +1,197 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
 from deap import creator, base
+from population import PopulationMatrix
+from alignment import crop_resize
+import timing
+from utils import cargar_modelo
+
+FACENET_SIZE = 160
+CLASSIFIER_SIZE = 224
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+GENDER_CLASSES = ('male', 'female') #OUTPUT ORDER OF THE GENDER CLASSIFIER
 
 def init_fitness():
     creator.create("FitnessMulti", base.Fitness, wieghts=(-1.0,1.0))
 
 
-def fitness_function(population):
-    
\ No newline at end of file
+def load_models(device=None):
+    """(generator, embedder, classifier), loaded lazily and shared by every caller in the process"""
+    return cargar_modelo.cargar_modelos(device)
+
+
+class BatchEvaluator():
+    """
+    Evaluates many latents at once: stacks them into one tensor and runs
+    synthesis, identity embedding (f1) and gender probability (f2) in
+    mini-batches of `batch_size`.
+    """
+
+    def __init__(self, generator, embedder, classifier, target_embedding=None,
+                 target_class=1, batch_size=16, device='cpu', face_box=None, classifier_box=None, student=None):
+        self.generator = generator
+        self.embedder = embedder
+        self.classifier = classifier
+        # Distilled f2 scorer (distill.py) used instead of the classifier, None scores with the classifier
+        self.student = student
+        # Fixed crops (see alignment.py) applied to the whole batch, None feeds the full frame
+        self.face_box = face_box
+        self.classifier_box = classifier_box
+        self.target_class = target_class
+        self.batch_size = batch_size
+        self.device = torch.device(device)
+        self.resolution = None
+        self.target_embedding = None
+        if self.device.type == 'cuda':
+            # Kernels run asynchronously, sync at stage boundaries so timings are not misattributed
+            timing.set_sync(torch.cuda.synchronize)
+        if target_embedding is not None:
+            self.set_target_embedding(target_embedding)
+
+    def set_target_embedding(self, embedding):
+        embedding = torch.as_tensor(np.asarray(embedding, dtype=np.float32)).reshape(1, -1)
+        self.target_embedding = F.normalize(embedding, dim=1).to(self.device)
+
+    def set_resolution(self, resolution):
+        """Output resolution of the synthesis, None renders at full resolution"""
+        self.resolution = resolution
+
+    def latents_to_ws(self, latents):
+        """(n, w_dim) W latents are broadcast to every layer, (n, num_ws * w_dim) are read as W+"""
+        w = torch.as_tensor(latents, device=self.device)
+        num_ws, w_dim = self.generator.num_ws, self.generator.w_dim
+        if w.shape[1] == w_dim:
+            return w.unsqueeze(1).repeat(1, num_ws, 1)
+        return w.reshape(-1, num_ws, w_dim)
+
+    def synthesize(self, ws):
+        synthesis = self.generator.synthesis
+        if self.resolution is None or self.resolution >= self.generator.img_resolution:
+            return synthesis(ws, noise_mode='const')
+        if hasattr(synthesis, 'block_resolutions'):
+            # Stop the StyleGAN2 synthesis network after the block at the requested resolution,
+            # with the skip architecture its toRGB output is already a valid low-res image
+            ws = ws.to(torch.float32)
+            x = img = None
+            w_idx = 0
+            for res in synthesis.block_resolutions:
+                block = getattr(synthesis, f'b{res}')
+                x, img = block(x, img, ws.narrow(1, w_idx, block.num_conv + block.num_torgb), noise_mode='const')
+                w_idx += block.num_conv
+                if res >= self.resolution:
+                    break
+            return img
+        img = synthesis(ws, noise_mode='const')
+        return F.interpolate(img, size=(self.resolution, self.resolution), mode='area')
+
+    def embed(self, images):
+        faces = crop_resize(images, self.face_box, FACENET_SIZE)
+        # facenet fixed_image_standardization, (p - 127.5) / 128 with p = (x + 1) * 127.5
+        faces = faces * (127.5 / 128.0)
+        return F.normalize(self.embedder(faces), dim=1)
+
+    def identity_similarity(self, images, targets=None):
+        targets = self.target_embedding if targets is None else targets
+        return (self.embed(images) * targets).sum(dim=1)
+
+    def gender_probability(self, images, classes=None):
+        x = (crop_resize(images, self.classifier_box, CLASSIFIER_SIZE) + 1) / 2
+        mean = torch.tensor(IMAGENET_MEAN, device=x.device).view(1, 3, 1, 1)
+        std = torch.tensor(IMAGENET_STD, device=x.device).view(1, 3, 1, 1)
+        probs = self.classifier((x - mean) / std).softmax(dim=1)
+        if classes is None:
+            return probs[:, self.target_class]
+        return probs.gather(1, classes.view(-1, 1)).view(-1)
+
+    def score_gender(self, images, ws, classes=None):
+        """f2 of a batch: the student when there is one, otherwise the classifier"""
+        if self.student is None:
+            return self.gender_probability(images, classes)
+        if classes is None:
+            classes = torch.full((len(ws),), self.target_class, dtype=torch.long, device=ws.device)
+        return self.student.probability(images, ws, classes)
+
+    def batches(self, latents):
+        latents = np.ascontiguousarray(latents, dtype=np.float32)
+        for start in range(0, len(latents), self.batch_size):
+            yield start, self.latents_to_ws(latents[start:start + self.batch_size])
+
+    @torch.no_grad()
+    def embed_latents(self, latents):
+        """FaceNet embeddings of the synthesized faces, used to pick a reference identity"""
+        out = []
+        for _, ws in self.batches(latents):
+            out.append(self.embed(self.synthesize(ws)).cpu().numpy())
+        return np.concatenate(out)
+
+    @torch.no_grad()
+    def evaluate_latents(self, latents, targets=None, target_classes=None):
+        """
+        Returns an (n, 2) array with (f1, f2) for every row of `latents`.
+        `targets` (n, 512) and `target_classes` (n,) give each row its own
+        reference identity and target gender, so latents of different
+        subjects can share the same batches.
+        """
+        if targets is None and self.target_embedding is None:
+            raise ValueError("target_embedding must be set before evaluating")
+        latents = np.asarray(latents, dtype=np.float32)
+        if targets is not None:
+            targets = F.normalize(torch.as_tensor(np.asarray(targets, dtype=np.float32)), dim=1).to(self.device)
+        if target_classes is not None:
+            target_classes = torch.as_tensor(np.asarray(target_classes, dtype=np.int64), device=self.device)
+        fits = np.empty((len(latents), 2), dtype=np.float64)
+        for start, ws in self.batches(latents):
+            with timing.section('synthesis'):
+                images = self.synthesize(ws)
+            stop = start + len(ws)
+            rows = slice(start, stop)
+            with timing.section('embedding'):
+                fits[rows, 0] = self.identity_similarity(
+                    images, None if targets is None else targets[rows]).cpu().numpy()
+            with timing.section('classification'):
+                fits[rows, 1] = self.score_gender(
+                    images, ws, None if target_classes is None else target_classes[rows]).cpu().numpy()
+        return fits
+
+    @torch.no_grad()
+    def teacher_probabilities(self, latents):
+        """f2 from the classifier even when a student is set, for the archive re-checks"""
+        out = []
+        for _, ws in self.batches(latents):
+            out.append(self.gender_probability(self.synthesize(ws)).cpu().numpy())
+        return np.concatenate(out) if out else np.empty(0)
+
+    @torch.no_grad()
+    def generate_batch(self, latents):
+        """(n, H, W, 3) uint8 images, synthesized batch_size at a time"""
+        out = []
+        for _, ws in self.batches(latents):
+            img = self.synthesize(ws)
+            out.append((img.permute(0, 2, 3, 1) * 127.5 + 128).clamp(0, 255).to(torch.uint8).cpu().numpy())
+        return np.concatenate(out)
+
+    def generate(self, w):
+        """Single image as an HWC uint8 array, the interface expected by utils_ae.save_generated_images"""
+        return self.generate_batch(np.asarray(w, dtype=np.float32).reshape(1, -1))[0]
+
+    def __call__(self, individuals):
+        individuals = list(individuals)
+        if not individuals:
+            return []
+        fits = self.evaluate_latents(np.asarray(individuals, dtype=np.float32))
+        fits = [tuple(fit) for fit in fits]
+        for ind, fit in zip(individuals, fits):
+            ind.fitness.values = fit
+        return fits
+
+
+def fitness_function(population, evaluator):
+    """Evaluates the whole population in one call and writes the fitness values back"""
+    if isinstance(population, PopulationMatrix):
+        invalid = population.invalid_indices()
+        if len(invalid):
+            population.fitness[invalid] = evaluator.evaluate_latents(population.latents[invalid])
+        return population.fitness[invalid]
+    return evaluator(population)
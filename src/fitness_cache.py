@@ -0,0 +1,152 @@
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+import numpy as np
+import timing
+
+def model_version(path):
+    """Cheap version tag for a weights file (name, size and mtime), avoids hashing 300+ MB"""
+    path = Path(path)
+    if not path.exists():
+        return path.name
+    stat = path.stat()
+    return f"{path.name}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+class FitnessCache():
+    """
+    Content-addressed fitness cache. Keys are a hash of the quantized latent
+    plus a namespace (subject/reference ID and model versions). Lookups go
+    to an in-memory LRU first and then to an sqlite file on disk.
+    """
+
+    def __init__(self, path=None, namespace='', max_items=100000, step=1e-4):
+        self.namespace = namespace.encode()
+        self.max_items = max_items
+        self.step = step
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        # Evaluations may run on several threads (steady-state mode), they share the connection
+        self.lock = threading.RLock()
+        if path is not None:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self.db = sqlite3.connect(str(path), check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS fitness (key BLOB PRIMARY KEY, fits BLOB)")
+
+    def key(self, latent, salt=b''):
+        """`salt` separates entries that share the namespace, e.g. per-row reference identities"""
+        quantized = np.round(np.asarray(latent, dtype=np.float64) / self.step).astype(np.int64)
+        return hashlib.sha1(self.namespace + salt + quantized.tobytes()).digest()
+
+    def remember(self, key, fits):
+        self.memory[key] = fits
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
+
+    def get_many(self, keys):
+        """Dict key -> fitness tuple for the keys that are cached, counted as hits and misses"""
+        with self.lock:
+            found = self._get_many(keys)
+            # Counted under the lock, several threads may share the cache
+            hits = sum(key in found for key in keys)
+            self.hits += hits
+            self.misses += len(keys) - hits
+            return found
+
+    def _get_many(self, keys):
+        found = {}
+        missing = []
+        for key in keys:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                found[key] = self.memory[key]
+            else:
+                missing.append(key)
+        if self.db is not None and missing:
+            for start in range(0, len(missing), 500):
+                chunk = missing[start:start + 500]
+                rows = self.db.execute(
+                    "SELECT key, fits FROM fitness WHERE key IN (%s)" % ','.join('?' * len(chunk)), chunk)
+                for key, blob in rows:
+                    fits = tuple(np.frombuffer(blob, dtype=np.float64))
+                    self.remember(key, fits)
+                    found[key] = fits
+        return found
+
+    def put_many(self, keys, fits):
+        with self.lock:
+            self._put_many(keys, fits)
+
+    def _put_many(self, keys, fits):
+        fits = [tuple(float(v) for v in fit) for fit in fits]
+        for key, fit in zip(keys, fits):
+            self.remember(key, fit)
+        if self.db is not None:
+            self.db.executemany("INSERT OR REPLACE INTO fitness VALUES (?, ?)",
+                                [(key, np.asarray(fit, dtype=np.float64).tobytes()) for key, fit in zip(keys, fits)])
+            self.db.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0}
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+class CachedEvaluator():
+    """Wraps a BatchEvaluator: only latents missing from the cache reach the models"""
+
+    def __init__(self, evaluator, cache):
+        self.evaluator = evaluator
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self.evaluator, name)
+
+    def set_resolution(self, resolution):
+        self.evaluator.set_resolution(resolution)
+
+    def evaluate_latents(self, latents, targets=None, target_classes=None):
+        latents = np.asarray(latents, dtype=np.float32)
+        # Per-row targets and classes, and the rendering resolution, become part of the key
+        resolution = getattr(self.evaluator, 'resolution', None)
+        salts = [b'' if resolution is None else b'res=%d' % resolution] * len(latents)
+        if targets is not None:
+            targets = np.asarray(targets, dtype=np.float32)
+            salts = [salt + target.tobytes() for salt, target in zip(salts, targets)]
+        if target_classes is not None:
+            target_classes = np.asarray(target_classes)
+            salts = [salt + b'class=%d' % cls for salt, cls in zip(salts, target_classes)]
+        keys = [self.cache.key(latent, salt) for latent, salt in zip(latents, salts)]
+        found = self.cache.get_many(keys)
+        missing = [i for i, key in enumerate(keys) if key not in found]
+        timing.count('cache_hits', len(keys) - len(missing))
+
+        fits = np.empty((len(latents), 2), dtype=np.float64)
+        for i, key in enumerate(keys):
+            if key in found:
+                fits[i] = found[key]
+        if missing:
+            fits[missing] = self.evaluator.evaluate_latents(
+                latents[missing], None if targets is None else targets[missing],
+                None if target_classes is None else target_classes[missing])
+            self.cache.put_many([keys[i] for i in missing], fits[missing])
+        return fits
+
+    def __call__(self, individuals):
+        individuals = list(individuals)
+        if not individuals:
+            return []
+        fits = [tuple(fit) for fit in self.evaluate_latents(np.asarray(individuals, dtype=np.float32))]
+        for ind, fit in zip(individuals, fits):
+            ind.fitness.values = fit
+        return fits
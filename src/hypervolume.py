@@ -0,0 +1,105 @@
+import time
+from bisect import bisect_left
+import numpy as np
+
+#REFERENCE POINT FOR (IDENTITY SIMILARITY, GENDER PROBABILITY), BOTH MAXIMIZED
+REFERENCE = (0.0, 0.0)
+
+def hypervolume_2d(fits, ref=REFERENCE):
+    """Area dominated by the points of `fits` (maximization) and bounded below by `ref`"""
+    fits = np.asarray(fits, dtype=np.float64).reshape(-1, 2)
+    fits = fits[(fits[:, 0] > ref[0]) & (fits[:, 1] > ref[1])]
+    if len(fits) == 0:
+        return 0.0
+    # Sweep by decreasing f1, each point adds the strip above the best f2 seen so far
+    fits = fits[np.lexsort((-fits[:, 1], -fits[:, 0]))]
+    best_f2 = np.maximum.accumulate(fits[:, 1])
+    prev_f2 = np.r_[ref[1], best_f2[:-1]]
+    return float(((fits[:, 0] - ref[0]) * np.maximum(best_f2 - prev_f2, 0)).sum())
+
+
+class HypervolumeTracker():
+    """
+    2-D hypervolume kept up to date point by point. The non-dominated points
+    are held sorted by increasing f1 (so decreasing f2); a new point only
+    changes the strips of its neighbours and of the points it dominates.
+    """
+
+    def __init__(self, ref=REFERENCE):
+        self.ref = ref
+        self.reset()
+
+    def reset(self, fits=()):
+        self.xs = []
+        self.ys = []
+        self.value = 0.0
+        return self.update(fits)
+
+    def _strip(self, j):
+        # Area between point j-1 and point j, up to the height of point j
+        left = self.xs[j - 1] if j > 0 else self.ref[0]
+        return (self.xs[j] - left) * (self.ys[j] - self.ref[1])
+
+    def add(self, x, y):
+        """Adds one point, returns the hypervolume it contributed"""
+        if x <= self.ref[0] or y <= self.ref[1]:
+            return 0.0
+        i = bisect_left(self.xs, x)
+        if i < len(self.xs) and self.ys[i] >= y:
+            return 0.0
+        # Points dominated by the new one (f1 <= x and f2 <= y) are a contiguous block ending at i
+        end = i + 1 if i < len(self.xs) and self.xs[i] == x else i
+        start = end
+        while start > 0 and self.ys[start - 1] <= y:
+            start -= 1
+        # Strips that change: the dominated block and the right neighbour, whose left edge moves
+        before = sum(self._strip(j) for j in range(start, min(end, len(self.xs) - 1) + 1))
+        self.xs[start:end] = [x]
+        self.ys[start:end] = [y]
+        after = sum(self._strip(j) for j in range(start, min(start + 1, len(self.xs) - 1) + 1))
+        self.value += after - before
+        return after - before
+
+    def update(self, fits):
+        for x, y in np.asarray(fits, dtype=np.float64).reshape(-1, 2):
+            self.add(x, y)
+        return self.value
+
+
+class EarlyStopping():
+    """
+    Stopping rules for one run: relative hypervolume gain below `epsilon`
+    over the last `window` generations, or a wall-clock (`max_seconds`) or
+    evaluation (`max_evals`) budget. Any of them can be None.
+    """
+
+    def __init__(self, epsilon=None, window=20, max_seconds=None, max_evals=None):
+        self.epsilon = epsilon
+        self.window = window
+        self.max_seconds = max_seconds
+        self.max_evals = max_evals
+        self.start = time.perf_counter()
+        self.evals = 0
+        self.history = []
+
+    def update(self, hypervolume, evals, converging=True):
+        """
+        Records one generation, returns the reason to stop or None. With
+        converging=False (e.g. before the last fidelity level) only the
+        budgets apply.
+        """
+        self.history.append(hypervolume)
+        self.evals += evals
+        if self.max_evals is not None and self.evals >= self.max_evals:
+            return f"evaluation budget of {self.max_evals} reached"
+        if self.max_seconds is not None and time.perf_counter() - self.start >= self.max_seconds:
+            return f"time budget of {self.max_seconds} s reached"
+        if converging and self.epsilon is not None and len(self.history) > self.window:
+            old = self.history[-1 - self.window]
+            if hypervolume - old <= self.epsilon * max(abs(old), 1e-12):
+                return f"hypervolume gain below {self.epsilon} over {self.window} generations"
+        return None
+
+    def restart(self):
+        """Forget the hypervolume history, e.g. after re-scoring at another fidelity"""
+        self.history = []
@@ -0,0 +1,153 @@
+"""
+GAN inversion: projects real face crops into W or W+ by optimizing a whole
+batch of latents at once. Every row has its own Adam state and its own
+stopping rule (loss plateau or step limit); a finished row hands its slot
+to the next pending image, so the batch stays full until the queue is empty.
+Results are stored once in the latent bank (utils/banco_latentes.py).
+"""
+from itertools import islice
+import torch
+import torch.nn.functional as F
+from alignment import crop_resize
+
+STEPS = 500 #MAXIMUM OPTIMIZATION STEPS PER IMAGE
+LR = 0.01
+PATIENCE = 50 #STEPS WITHOUT IMPROVEMENT BEFORE AN IMAGE IS DONE
+MIN_DELTA = 1e-4 #SMALLER LOSS DECREASES DO NOT COUNT AS IMPROVEMENT
+PIXEL_SIZE = 64 #RESOLUTION OF THE PIXEL TERM, COMPUTED ON THE FACE CROP
+ID_WEIGHT = 1.0 #WEIGHT OF 1 - COSINE(FACENET) AGAINST THE PIXEL MSE
+BETAS = (0.9, 0.999)
+EPS = 1e-8
+
+def mean_latent(generator, device='cpu', n=10000, seed=0):
+    """Average W: the w_avg tracked by the mapping network, or estimated from n samples"""
+    w_avg = getattr(getattr(generator, 'mapping', None), 'w_avg', None)
+    if w_avg is not None:
+        return w_avg.detach().to(device, torch.float32).reshape(-1)
+    z = torch.randn(n, generator.z_dim, generator=torch.Generator().manual_seed(seed))
+    with torch.no_grad():
+        ws = generator.mapping(z.to(device), None)
+    return ws[:, 0].mean(dim=0).to(torch.float32)
+
+
+class Inverter():
+    """
+    Inverts face crops through a BatchEvaluator, which provides the
+    synthesis, the fixed face box and the FaceNet embedder. The loss of each
+    row is the pixel MSE between the generated face crop and the real one at
+    `pixel_size`, plus `id_weight` * (1 - cosine) of their FaceNet identities.
+    """
+
+    def __init__(self, evaluator, space='w', steps=STEPS, lr=LR, patience=PATIENCE, min_delta=MIN_DELTA,
+                 pixel_size=PIXEL_SIZE, id_weight=ID_WEIGHT, batch_size=None):
+        if space not in ('w', 'w+'):
+            raise ValueError(f"space must be 'w' or 'w+', got {space!r}")
+        self.evaluator = evaluator
+        self.space = space
+        self.steps = steps
+        self.lr = lr
+        self.patience = patience
+        self.min_delta = min_delta
+        self.pixel_size = pixel_size
+        self.id_weight = id_weight
+        self.batch_size = batch_size or evaluator.batch_size
+        generator = evaluator.generator
+        self.num_ws = generator.num_ws
+        self.shape = (generator.w_dim,) if space == 'w' else (generator.num_ws, generator.w_dim)
+        self.start = mean_latent(generator, evaluator.device).expand(*self.shape)
+
+    def config(self):
+        """Settings that change the result, stored with the bank to know when it is stale"""
+        return {'space': self.space, 'steps': self.steps, 'lr': self.lr, 'patience': self.patience,
+                'min_delta': self.min_delta, 'pixel_size': self.pixel_size, 'id_weight': self.id_weight,
+                'face_box': self.evaluator.face_box}
+
+    def losses(self, latents, faces, targets):
+        """Loss of every row of `latents` against its (3, pixel_size, pixel_size) face and FaceNet target"""
+        evaluator = self.evaluator
+        ws = latents.unsqueeze(1).repeat(1, self.num_ws, 1) if self.space == 'w' else latents
+        images = evaluator.synthesize(ws)
+        # Same framing and standardization as the FaceNet input of the real photo
+        pixels = crop_resize(images * (127.5 / 128.0), evaluator.face_box, self.pixel_size)
+        mse = ((pixels - faces) ** 2).flatten(1).mean(dim=1)
+        identity = (evaluator.embed(images) * targets).sum(dim=1)
+        return mse + self.id_weight * (1 - identity)
+
+    def _load(self, items):
+        # Pixel-term targets and FaceNet embeddings of a few new faces, computed together
+        keys = [key for key, _ in items]
+        faces = torch.stack([torch.as_tensor(face) for _, face in items]).to(self.evaluator.device, torch.float32)
+        with torch.no_grad():
+            targets = F.normalize(self.evaluator.embedder(faces), dim=1)
+        return keys, F.interpolate(faces, size=(self.pixel_size, self.pixel_size), mode='area'), targets
+
+    def invert(self, items):
+        """
+        `items` yields (key, face), face being a (3, h, w) crop in the FaceNet
+        input range (fixed_image_standardization). Yields (key, latent, loss,
+        steps) for every image as soon as it finishes, not in input order.
+        """
+        items = iter(items)
+        n, device = self.batch_size, self.evaluator.device
+        keys = [None] * n
+        w = self.start.expand(n, *self.shape).clone()
+        best = w.clone()
+        m = torch.zeros_like(w)
+        v = torch.zeros_like(w)
+        step = torch.zeros(n, dtype=torch.long, device=device)
+        best_loss = torch.full((n,), float('inf'), device=device)
+        stall = torch.zeros(n, dtype=torch.long, device=device)
+        faces = targets = None
+        active = torch.zeros(n, dtype=torch.bool, device=device)
+        pending = True
+        broadcast = (-1,) + (1,) * len(self.shape)
+
+        while True:
+            free = (~active).nonzero().flatten()
+            if pending and len(free):
+                new = list(islice(items, len(free)))
+                pending = len(new) == len(free)
+                if new:
+                    slots = free[:len(new)]
+                    new_keys, new_faces, new_targets = self._load(new)
+                    if faces is None:
+                        faces = torch.zeros((n,) + new_faces.shape[1:], device=device)
+                        targets = torch.zeros((n,) + new_targets.shape[1:], device=device)
+                    faces[slots], targets[slots] = new_faces, new_targets
+                    # A new image starts from the average latent with a fresh optimizer state
+                    w[slots], best[slots] = self.start, self.start
+                    m[slots], v[slots] = 0, 0
+                    step[slots], stall[slots] = 0, 0
+                    best_loss[slots] = float('inf')
+                    active[slots] = True
+                    for slot, key in zip(slots.tolist(), new_keys):
+                        keys[slot] = key
+            if not active.any():
+                return
+
+            rows = active.nonzero().flatten()
+            latents = w[rows].requires_grad_(True)
+            with torch.enable_grad():
+                loss = self.losses(latents, faces[rows], targets[rows])
+                # Rows are independent, the sum gives each one its own gradient
+                grad, = torch.autograd.grad(loss.sum(), latents)
+            loss = loss.detach()
+
+            improved = loss < best_loss[rows] - self.min_delta
+            best[rows[improved]] = latents.detach()[improved]
+            best_loss[rows] = torch.where(improved, loss, best_loss[rows])
+            stall[rows] = torch.where(improved, torch.zeros_like(stall[rows]), stall[rows] + 1)
+
+            # Adam with a step counter per row, so refilled slots restart their bias correction
+            step[rows] += 1
+            t = step[rows].to(torch.float32).view(broadcast)
+            m[rows] = BETAS[0] * m[rows] + (1 - BETAS[0]) * grad
+            v[rows] = BETAS[1] * v[rows] + (1 - BETAS[1]) * grad * grad
+            m_hat = m[rows] / (1 - BETAS[0] ** t)
+            v_hat = v[rows] / (1 - BETAS[1] ** t)
+            w[rows] = latents.detach() - self.lr * m_hat / (v_hat.sqrt() + EPS)
+
+            done = rows[(stall[rows] >= self.patience) | (step[rows] >= self.steps)]
+            for slot in done.tolist():
+                active[slot] = False
+                yield keys[slot], best[slot].reshape(-1).cpu().numpy(), float(best_loss[slot]), int(step[slot])
@@ -0,0 +1,175 @@
+"""
+Island model: K NSGA-II populations in separate processes, each with its
+own variation parameters. Every `migration_interval` generations an island
+sends its best non-dominated rows to the next island of a ring and takes
+whatever migrants are waiting in its own queue, without blocking. The
+island archives are merged into one global Pareto front at the end.
+"""
+import multiprocessing as mp
+import pickle
+import queue
+import random
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+from deap import base, creator
+import fitness
+from population import PopulationMatrix, cx_blend_matrix, mut_gaussian_matrix
+from selection import sel_nsga2, sel_tournament_dcd, nsga2_indices, ParetoArchive
+
+N_ISLANDS = 4
+MIGRATION_INTERVAL = 10 #GENERATIONS BETWEEN MIGRATIONS
+N_MIGRANTS = 5 #NON-DOMINATED ROWS SENT PER MIGRATION
+
+#CYCLED OVER THE ISLANDS WHEN NO PARAMETERS ARE GIVEN: FROM EXPLOITATION TO EXPLORATION
+DEFAULT_PARAMS = [
+    {'cx_prob': 0.9, 'mutation_prob': 0.1, 'sigma': 1.0},
+    {'cx_prob': 0.9, 'mutation_prob': 0.2, 'sigma': 0.25},
+    {'cx_prob': 0.7, 'mutation_prob': 0.3, 'sigma': 0.5},
+    {'cx_prob': 0.5, 'mutation_prob': 0.5, 'sigma': 0.1},
+]
+
+def _individual_class():
+    # Spawned island processes do not run main.py, they create the DEAP classes themselves
+    if not hasattr(creator, "Individual"):
+        creator.create("FitnessMulti", base.Fitness, weights=(1.0, 1.0))
+        creator.create("Individual", np.ndarray, fitness=creator.FitnessMulti)
+    return creator.Individual
+
+
+def _run_island(index, params, w0, target_embedding, target_class, inbox, outbox, mu, ngen,
+                migration_interval, n_migrants, loader, loader_kwargs, batch_size, n_threads,
+                perturbation, seed, face_box=None, classifier_box=None, student_path=None, runtime=None):
+    torch.set_num_threads(n_threads)
+    random.seed(seed)
+    np.random.seed(seed)
+    icls = _individual_class()
+    generator, embedder, classifier = loader(device='cpu', **loader_kwargs)
+    student = None
+    if student_path is not None:
+        from distill import load_student
+        student = load_student(student_path)
+    evaluator = fitness.BatchEvaluator(generator, embedder, classifier, target_embedding,
+                                       target_class, batch_size, face_box=face_box,
+                                       classifier_box=classifier_box, student=student)
+    if runtime is not None:
+        # Same options as the pool workers; the parent checked them against fp32
+        from runtime import optimize_evaluator
+        optimize_evaluator(evaluator, **runtime)
+
+    pop = PopulationMatrix.from_seed(w0, mu, perturbation, icls)
+    evals = [len(fitness.fitness_function(pop, evaluator))]
+    pop = sel_nsga2(pop, mu)
+    archive = ParetoArchive(icls)
+    archive.update(pop)
+    history = [pop.fitness.copy()]
+    migrants_in = 0
+
+    for gen in range(1, ngen):
+        offspring = sel_tournament_dcd(pop, len(pop) - len(pop) % 4)
+        cx_blend_matrix(offspring, params['cx_prob'], 0.2)
+        mut_gaussian_matrix(offspring, params['mutation_prob'], 0, params['sigma'], 0.1)
+        evals.append(len(fitness.fitness_function(offspring, evaluator)))
+        archive.update(offspring)
+        pop = sel_nsga2(pop.concat(offspring), mu)
+
+        if gen % migration_interval == 0:
+            chosen, _ = nsga2_indices(pop.fitness, min(n_migrants, len(pop)))
+            outbox.put((pop.latents[chosen], pop.fitness[chosen]))
+            while True:
+                try:
+                    latents, fits = inbox.get_nowait()
+                except queue.Empty:
+                    break
+                # Migrants were scored by the same models and target, they compete as they are
+                migrants = PopulationMatrix(latents, fits, icls)
+                archive.update(migrants)
+                pop = sel_nsga2(pop.concat(migrants), mu)
+                migrants_in += len(migrants)
+        history.append(pop.fitness.copy())
+
+    return {'index': index, 'params': params, 'latents': pop.latents, 'fitness': pop.fitness,
+            'archive_latents': archive.latents, 'archive_fitness': archive.fitness,
+            'history': np.stack(history), 'evals': evals, 'migrants_in': migrants_in}
+
+
+def merged_logbook(results, logbook):
+    """Fills `logbook` with one record per generation, statistics of all island populations together"""
+    for gen in range(min(len(r['history']) for r in results)):
+        fits = np.concatenate([r['history'][gen] for r in results])
+        logbook.record(gen=gen, evals=sum(r['evals'][gen] for r in results), avg=fits.mean(axis=0),
+                       std=fits.std(axis=0), min=fits.min(axis=0), max=fits.max(axis=0))
+    return logbook
+
+
+def run_islands(w0, target_embedding, target_class=1, n_islands=N_ISLANDS, params=None, mu=100, ngen=250,
+                migration_interval=MIGRATION_INTERVAL, n_migrants=N_MIGRANTS, loader=fitness.load_models, loader_kwargs=None,
+                batch_size=16, threads_per_island=1, perturbation=0.1, seed=None, face_box=None,
+                classifier_box=None, student_path=None, runtime=None):
+    """
+    Returns (island results, global Pareto front). `params` is one dict of
+    cx_prob / mutation_prob / sigma per island, DEFAULT_PARAMS when None.
+    `student_path` and `runtime` are passed to every island as to the pool
+    workers (parallel.PoolEvaluator).
+    """
+    params = params or [DEFAULT_PARAMS[i % len(DEFAULT_PARAMS)] for i in range(n_islands)]
+    n_islands = len(params)
+    w0 = np.asarray(w0, dtype=np.float32)
+    target_embedding = np.asarray(target_embedding, dtype=np.float32).reshape(-1)
+    ctx = mp.get_context('spawn')
+    with ctx.Manager() as manager, ProcessPoolExecutor(n_islands, mp_context=ctx) as pool:
+        # Ring topology: island i sends to island i + 1
+        queues = [manager.Queue() for _ in range(n_islands)]
+        futures = [pool.submit(_run_island, i, p, w0, target_embedding, target_class,
+                               queues[i], queues[(i + 1) % n_islands], mu, ngen, migration_interval,
+                               n_migrants, loader, loader_kwargs or {}, batch_size, threads_per_island,
+                               perturbation, None if seed is None else seed + i, face_box, classifier_box,
+                               student_path, runtime)
+                   for i, p in enumerate(params)]
+        results = [future.result() for future in futures]
+
+    icls = _individual_class()
+    pareto_front = ParetoArchive(icls)
+    for r in results:
+        pareto_front.update(PopulationMatrix(r['archive_latents'], r['archive_fitness'], icls))
+    return results, pareto_front
+
+
+if __name__ == "__main__":
+    from main import (build_evaluator, make_logbook, runtime_options, w0, BATCH_SIZE, PERTURBATION, FACE_BOX,
+                      CLASSIFIER_BOX, STUDENT_PATH, SUBSPACE_K)
+    from distill import TeacherCheck
+    from utils import utils_ae
+
+    if SUBSPACE_K:
+        # The islands vary raw latents with their own operators, a PCA genome is not wired in
+        raise ValueError("islands.py runs in the full latent space, set SUBSPACE_K = None")
+
+    # Reference identity and target class as set up for the single-population run (runtime checked here too)
+    evaluator = build_evaluator(cache_path=None, workers=0)
+    target = evaluator.target_embedding.cpu().numpy().reshape(-1)
+    results, pareto_front = run_islands(w0, target, evaluator.target_class, batch_size=BATCH_SIZE,
+                                        perturbation=PERTURBATION, seed=42, face_box=FACE_BOX,
+                                        classifier_box=CLASSIFIER_BOX, student_path=STUDENT_PATH,
+                                        runtime=runtime_options())
+    if STUDENT_PATH:
+        # Reported populations and front carry classifier f2, as in main.py
+        teacher_check = TeacherCheck(evaluator)
+        for r in results:
+            r['fitness'][:, 1] = teacher_check.teacher_f2(r['latents'])
+            r['archive_fitness'][:, 1] = teacher_check.teacher_f2(r['archive_latents'])
+        pareto_front = teacher_check.rescore(pareto_front)
+    for r in results:
+        print(f"island {r['index']} {r['params']}: front {len(r['archive_fitness'])}, migrants in {r['migrants_in']}")
+    print(f"global front: {len(pareto_front)}")
+
+    logbook = merged_logbook(results, make_logbook())
+    utils_ae.visualize_results(pareto_front, logbook)
+    utils_ae.save_generated_images(pareto_front, evaluator)
+
+    with open('results/final_results_islands.pkl', 'wb') as f:
+        pickle.dump({
+            'islands': results,
+            'logbook': logbook,
+            'pareto_front': pareto_front
+        }, f)
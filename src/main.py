@@ -1,95 +1,400 @@
+import argparse
 import random
 import numpy as np
 from deap import base, creator, tools, algorithms
-from population import init_population 
-from utils_ae import save_generated_images, visualize_results
-import tools
+import fitness
+from fitness_cache import FitnessCache, CachedEvaluator, model_version
+from parallel import PoolEvaluator
+from population import load_population, PopulationMatrix, cx_blend_matrix, mut_gaussian_matrix
+from selection import sel_nsga2, sel_tournament_dcd, ParetoArchive
+from surrogate import Surrogate, screen_offspring
+from fidelity import FidelityScheduler, rescore, rescore_archive
+from hypervolume import HypervolumeTracker, EarlyStopping
+from subspace import load_pca_basis, SubspaceEncoding, SubspaceEvaluator
+from adaptive import AdaptiveVariation
+from distill import TeacherCheck, load_student
+from runtime import optimize_evaluator, report_check
+import timing
+from alignment import FFHQ_FACE_BOX, AlignmentCheck
+from checkpoint import CheckpointWriter, LogbookWriter, load_checkpoint, load_logbook, set_rng_state
+from utils import utils_ae, cargar_modelo
+from utils.embeddings_referencia import ReferenceStore
+
+BATCH_SIZE = 16 #IMAGES PER GENERATOR/CLASSIFIER CALL
+PERTURBATION = 0.1
+SUBJECT = 0 #ROW OF THE INIT POPULATION TO TRANSFORM: PERSON OF THE LATENT BANK, OR CSV ROW WITHOUT A BANK
+CACHE_PATH = '../results/fitness_cache.sqlite' #NONE TO DISABLE THE CACHE
+WORKERS = 0 #EVALUATOR PROCESSES, 0 EVALUATES IN THIS PROCESS
+THREADS_PER_WORKER = 1
+REFERENCE_PERSON = None #CELEBA ID IN THE REFERENCE STORE, NONE USES THE FACE OF w0
+SURROGATE = None #'ridge' OR 'knn' TO PRE-SCREEN OFFSPRING BEFORE THE REAL EVALUATION
+SURROGATE_POOL_FACTOR = 4 #CANDIDATES BRED PER GENERATION, IN UNITS OF MU
+SURROGATE_EVAL_FRACTION = 0.5 #SHARE OF MU THAT REACHES THE REAL EVALUATOR
+FIDELITY_LEVELS = None #E.G. (256, 512, None): RENDER RESOLUTIONS, NONE IS FULL RESOLUTION
+SUBSPACE_K = None #E.G. 40: GENOME OF PCA COEFFICIENTS AROUND w0 INSTEAD OF THE RAW LATENT
+SUBSPACE_PER_LAYER = False #ONE SET OF COEFFICIENTS PER W+ LAYER
+TIMING = True #SECONDS PER STAGE AND CACHE HITS AS LOGBOOK COLUMNS
+PROFILER = None #'torch' OR 'cprofile' TO CAPTURE THE GENERATIONS IN PROFILE_GENERATIONS
+PROFILE_GENERATIONS = (10, 12) #FIRST AND LAST GENERATION CAPTURED
+LOGBOOK_PATH = '../results/logbook.jsonl' #ONE JSON RECORD PER GENERATION, WRITTEN AS THE RUN GOES
+CHECKPOINT_PATH = '../results/checkpoint.npz' #NONE TO DISABLE CHECKPOINTS
+CHECKPOINT_EVERY = 10 #GENERATIONS BETWEEN CHECKPOINTS
+HV_EPSILON = None #E.G. 1e-4: STOP WHEN THE RELATIVE HYPERVOLUME GAIN OVER HV_WINDOW GENERATIONS IS BELOW IT
+HV_WINDOW = 20
+TIME_BUDGET = None #SECONDS OF WALL CLOCK FOR THE WHOLE RUN
+EVAL_BUDGET = None #EVALUATIONS FOR THE WHOLE RUN
+FACE_BOX = FFHQ_FACE_BOX #FIXED CROP FED TO FACENET, NONE FEEDS THE FULL FRAME
+CLASSIFIER_BOX = None #FIXED CROP FED TO THE GENDER CLASSIFIER
+ALIGNMENT_CHECK_EVERY = 25 #GENERATIONS BETWEEN MTCNN CHECKS OF FACE_BOX, NONE TO DISABLE
+VARIATION = 'nsga2' #'adaptive': PER-INDIVIDUAL STEP SIZES AND LEARNED DIAGONAL COVARIANCE (adaptive.py)
+ADAPTIVE_SIGMA0 = None #INITIAL STEP SIZE, NONE USES THE SPREAD OF THE INITIAL POPULATION
+ADAPTIVE_SIGMA_MAX = None #UPPER BOUND OF THE STEP SIZE
+STUDENT_PATH = None #DISTILLED f2 SCORER FROM distill.py (E.G. '../results/student/student_probe.pt'), NONE USES THE CLASSIFIER
+TEACHER_CHECK_EVERY = 10 #GENERATIONS BETWEEN CLASSIFIER RE-CHECKS OF THE ARCHIVE WHEN A STUDENT SCORES f2
+RUNTIME = None #'eager', 'trace' OR 'compile': FIXED-BATCH INFERENCE RUNTIME FOR THE MODELS (runtime.py), NONE KEEPS THEM AS LOADED
+RUNTIME_BF16 = False #BF16 WEIGHTS, CHECKED AGAINST FP32 BEFORE THE RUN
+RUNTIME_INT8 = False #DYNAMIC INT8 LINEAR LAYERS IN FACENET AND THE CLASSIFIER
 
 #INITIALIZATION:
 creator.create("FitnessMulti", base.Fitness, weights=(1.0, 1.0))
-creator.create("Individual", list, fitness=creator.FitnessMulti)
+creator.create("Individual", np.ndarray, fitness=creator.FitnessMulti)
 
 toolbox = base.Toolbox()
 
-w0 = init_population.get_nth_init_population(0)
+w0 = load_population().get_nth_init_population(SUBJECT)
 
-pertubation + 0.1
-init_individual(w0, pertubation)
+#POPULATION IS A (MU, latent_dim) MATRIX, OPERATORS WORK ON ALL ROWS AT ONCE
+toolbox.register("population", PopulationMatrix.from_seed, w0, perturbation=PERTURBATION, icls=creator.Individual)
 
-toolbox.register("population", tools.initRepeat, list, toolbox.individual)
+toolbox.register("mate", cx_blend_matrix, alpha = 0.2)
+toolbox.register("mutate", mut_gaussian_matrix, mu=0, sigma=1, indpb=0.1)
+toolbox.register("select", sel_nsga2)
+toolbox.register("select_parents", sel_tournament_dcd)
 
-toolbox.register("evaluate", fitness.fitness_function)
-toolbox.register("mate", tools.csBlend, alpha = 0.2)
-toolbox.register("mutate", tools.mutGaussian, mu=0, sigma=1, indpb=0.1)
-toolbox.register("select", tools.selNSGA2)
+def runtime_options():
+    if RUNTIME is None:
+        return None
+    versions = {'generator': model_version(cargar_modelo.PKL_PATH), 'embedder': model_version(cargar_modelo.FACENET_PATH),
+                'classifier': model_version(cargar_modelo.CLASSIFIER_PATH)}
+    return dict(compile=None if RUNTIME == 'eager' else RUNTIME, bf16=RUNTIME_BF16, int8=RUNTIME_INT8,
+                versions=versions)
 
-def main():
-    N = 250
-    MU = 100
-    CX_PROB = 0.9
-    MUTATION_PROB = 0.1 
+def load_evaluator(batch_size=BATCH_SIZE, workers=WORKERS):
+    runtime = runtime_options()
+    if workers:
+        evaluator = PoolEvaluator(workers, THREADS_PER_WORKER, batch_size, face_box=FACE_BOX,
+                                  classifier_box=CLASSIFIER_BOX, student_path=STUDENT_PATH, runtime=runtime)
+        if runtime is not None:
+            # Checked inside one worker against its fp32 models, the parent never loads them
+            try:
+                report_check(evaluator.check_runtime(check_latents()),
+                             f"runtime ({RUNTIME}, bf16={RUNTIME_BF16}, int8={RUNTIME_INT8})", strict=True)
+            except RuntimeError:
+                evaluator.close()
+                raise
+        toolbox.register("map", evaluator.map)
+        return evaluator
+    device = cargar_modelo.default_device()
+    generator, embedder, classifier = fitness.load_models(device)
+    student = load_student(STUDENT_PATH, device) if STUDENT_PATH else None
+    evaluator = fitness.BatchEvaluator(generator, embedder, classifier, batch_size=batch_size, device=device,
+                                       face_box=FACE_BOX, classifier_box=CLASSIFIER_BOX, student=student)
+    if runtime is not None:
+        optimize_evaluator(evaluator, check_latents=check_latents(), **runtime)
+    return evaluator
+
+def check_latents(n=32, seed=0):
+    # Neighbourhood of w0 the run will explore, drawn without touching the run's RNG
+    rng = np.random.RandomState(seed)
+    w = np.asarray(w0, dtype=np.float32).reshape(1, -1)
+    return w + PERTURBATION * rng.randn(n, w.shape[1]).astype(np.float32)
+
+def model_namespace():
+    # Cached fitness values are only valid for the same model weights and input crops
+    parts = [model_version(cargar_modelo.PKL_PATH), model_version(cargar_modelo.FACENET_PATH),
+             model_version(cargar_modelo.CLASSIFIER_PATH), f"box={FACE_BOX}", f"cls_box={CLASSIFIER_BOX}"]
+    if STUDENT_PATH:
+        parts.append(f"student={model_version(STUDENT_PATH)}")
+    if RUNTIME is not None and (RUNTIME_BF16 or RUNTIME_INT8):
+        # Reduced precision moves the values a little, fp32 entries stay apart
+        parts.append(f"bf16={RUNTIME_BF16}|int8={RUNTIME_INT8}")
+    return '|'.join(parts)
+
+def build_evaluator(batch_size=BATCH_SIZE, cache_path=CACHE_PATH, workers=WORKERS):
+    evaluator = load_evaluator(batch_size, workers)
+    if REFERENCE_PERSON is not None:
+        # Mean FaceNet identity of the real photos, target gender is the opposite one
+        store = ReferenceStore()
+        evaluator.set_target_embedding(store.mean_embedding(REFERENCE_PERSON))
+        target_gender = 'female' if store.gender(REFERENCE_PERSON) == 'male' else 'male'
+        evaluator.target_class = fitness.GENDER_CLASSES.index(target_gender)
+    else:
+        # Reference identity: the face synthesized from the starting latent
+        evaluator.set_target_embedding(evaluator.embed_latents([np.asarray(w0, dtype=np.float32)])[0])
+    if cache_path is not None:
+        # w0 depends on where the init population came from (latent bank or CSV), key on its content
+        namespace = '|'.join([f"subject={SUBJECT}", f"w0={utils_ae.latent_hash(w0)}",
+                              f"reference={REFERENCE_PERSON}", model_namespace()])
+        evaluator = CachedEvaluator(evaluator, FitnessCache(cache_path, namespace))
+    if SUBSPACE_K:
+        evaluator = use_subspace(evaluator)
+    return evaluator
 
+def use_subspace(evaluator, k=SUBSPACE_K, per_layer=SUBSPACE_PER_LAYER):
+    # Individuals become k PCA coefficients, decoded to latents in batch before synthesis
+    generator = cargar_modelo.cargar_generador()
+    _, basis = load_pca_basis(generator, k, version=model_version(cargar_modelo.PKL_PATH))
+    encoding = SubspaceEncoding(basis, np.asarray(w0, dtype=np.float32), generator.num_ws, per_layer)
+    toolbox.register("population", PopulationMatrix.from_seed, np.zeros(encoding.genome_size),
+                     perturbation=PERTURBATION, icls=creator.Individual)
+    return SubspaceEvaluator(evaluator, encoding)
+
+def use_adaptive_variation(sigma0=ADAPTIVE_SIGMA0, sigma_max=ADAPTIVE_SIGMA_MAX):
+    # Same generational loop, the engine takes over parent selection, variation and survival
+    engine = AdaptiveVariation(sigma0, sigma_max=sigma_max)
+    toolbox.register("select_parents", engine.select_parents)
+    toolbox.register("mate", engine.mate)
+    toolbox.register("mutate", engine.mutate)
+    toolbox.register("select", engine.select)
+    return engine
+
+def make_stats():
     stats = tools.Statistics(lambda ind: ind.fitness.values)
-    stats.register("avg", numpy.mean, axis=0)
-    stats.register("std", numpy.std, axis=0)
-    stats.register("min", numpy.min, axis=0)
-    stats.register("max", numpy.max, axis=0)
+    stats.register("avg", np.mean, axis=0)
+    stats.register("std", np.std, axis=0)
+    stats.register("min", np.min, axis=0)
+    stats.register("max", np.max, axis=0)
+    return stats
 
+def make_logbook(extra=()):
     logbook = tools.Logbook()
-    logbook.header = "gen", "evals", "std", "min", "avg", "max"
-
-    pop = toolbox.population(n=MU)
-    pareto_front = tools.ParetoFront()
-
-    invalid_ind = [ind for ind in pop if not ind.fitness.valid]
-    fitnesses = map(toolbox.evaluate, invalid_ind)
-    for ind, fit in zip(invalid_ind, fitnesses):
-        ind.fitness.values = fit
-    
-    pop = toolbox.select(pop, len(pop))
-    
-    pareto_front.update(pop)
-    for gen in range(1, NGEN):
-        # Select and clone
-        offspring = tools.selTournamentDCD(pop, len(pop))
-        offspring = [toolbox.clone(ind) for ind in offspring]
-        
-        # Crossover
-        for ind1, ind2 in zip(offspring[::2], offspring[1::2]):
-            if random.random() <= CXPB:
-                toolbox.mate(ind1, ind2)
-                del ind1.fitness.values, ind2.fitness.values
-        
-        # Mutation 
-        for mutant in offspring:
-            if random.random() < MUTPB:
-                toolbox.mutate(mutant)
-                del mutant.fitness.values
-        
-        # Evaluate
-        invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
-        fitnesses = map(toolbox.evaluate, invalid_ind)
-        for ind, fit in zip(invalid_ind, fitnesses):
-            ind.fitness.values = fit
-        
-        # Select next generation 
-        pop = toolbox.select(pop + offspring, MU)
+    logbook.header = ("gen", "evals") + tuple(extra) + ("std", "min", "avg", "max")
+    return logbook
+
+def evaluate_invalid(pop):
+    # All invalid rows go to the evaluator together so they share batches
+    return len(toolbox.evaluate(pop))
+
+def run_state(surrogate, scheduler, engine=None, stopping=None):
+    # Everything besides population, archive and RNGs that the next generation depends on
+    state = {}
+    if stopping:
+        # The early-stop window as it is, a fidelity switch may have restarted it
+        state.update(stopping_history=np.asarray(stopping.history, dtype=np.float64), stopping_evals=stopping.evals)
+    if engine and engine.C is not None:
+        state.update(variation_C=engine.C)
+    if surrogate and surrogate.X is not None:
+        state.update(surrogate_X=surrogate.X, surrogate_Y=surrogate.Y, surrogate_errors=surrogate.errors)
+    if scheduler:
+        state.update(fidelity_level=scheduler.level, fidelity_history=scheduler.history)
+    return state
+
+def restore(state, surrogate, scheduler, engine=None, stopping=None):
+    """(pop, pareto_front, gen) from a checkpoint, RNG states and optional components restored in place"""
+    pop = PopulationMatrix(state['latents'], state['fitness'], creator.Individual)
+    pop.crowding = state['crowding'] if len(state['crowding']) else None
+    if len(state.get('strategy', ())):
+        pop.strategy = state['strategy']
+    if engine and 'variation_C' in state:
+        engine.C = state['variation_C']
+    pareto_front = ParetoArchive(creator.Individual)
+    pareto_front.update(PopulationMatrix(state['archive_latents'], state['archive_fitness'], creator.Individual))
+    if surrogate and 'surrogate_X' in state:
+        surrogate.X, surrogate.Y = state['surrogate_X'], state['surrogate_Y']
+        surrogate.errors = state['surrogate_errors'].tolist()
+        surrogate.fit()
+    if scheduler:
+        scheduler.level = int(state['fidelity_level'])
+        scheduler.history = state['fidelity_history'].tolist()
+    if stopping and 'stopping_history' in state:
+        stopping.history = state['stopping_history'].tolist()
+        stopping.evals = int(state['stopping_evals'])
+    set_rng_state(state)
+    return pop, pareto_front, int(state['gen'])
+
+def main(seed=None, evaluator=None, resume=None):
+    NGEN = 250
+    MU = 100
+    CX_PROB = 0.9
+    MUTATION_PROB = 0.1
+
+    random.seed(seed)
+    np.random.seed(seed)
+
+    if evaluator is None:
+        evaluator = build_evaluator()
+    toolbox.register("evaluate", fitness.fitness_function, evaluator=evaluator)
+
+    surrogate = Surrogate(SURROGATE) if SURROGATE else None
+    n_screened = max(1, round(MU * SURROGATE_EVAL_FRACTION))
+
+    scheduler = FidelityScheduler(FIDELITY_LEVELS) if FIDELITY_LEVELS else None
+    if scheduler:
+        evaluator.set_resolution(scheduler.resolution)
+
+    engine = use_adaptive_variation() if VARIATION == 'adaptive' else None
+
+    profiler = timing.Profiler(PROFILER, *PROFILE_GENERATIONS) if PROFILER else None
+    alignment_check = AlignmentCheck(FACE_BOX, ALIGNMENT_CHECK_EVERY) if ALIGNMENT_CHECK_EVERY else None
+    checkpoints = CheckpointWriter(CHECKPOINT_PATH) if CHECKPOINT_PATH else None
+    teacher_check = TeacherCheck(evaluator) if STUDENT_PATH else None
+
+    stats = make_stats()
+    hypervolume = HypervolumeTracker()
+    stopping = EarlyStopping(HV_EPSILON, HV_WINDOW, TIME_BUDGET, EVAL_BUDGET)
+
+    logbook = make_logbook(("hv",) + (("sigma",) if engine else ()) + (("teacher_err",) if teacher_check else ()) + (("surr_err", "saved") if surrogate else ()) + (("res",) if scheduler else ())
+                           + ((*timing.STAGES, "cache_hits") if TIMING else ()))
+
+    def log(**record):
+        logbook.record(**record)
+        logbook_file.write(logbook[-1])
+        print(logbook.stream)
+
+    if resume:
+        # Continue after the checkpointed generation, with the same RNG states it had
+        pop, pareto_front, start = restore(load_checkpoint(resume), surrogate, scheduler, engine, stopping)
+        if scheduler:
+            evaluator.set_resolution(scheduler.resolution)
+        logbook_file = LogbookWriter(LOGBOOK_PATH, truncate_after=start)
+        for record in load_logbook(LOGBOOK_PATH):
+            logbook.record(**record)
+        hypervolume.reset(pareto_front.fitness)
+        print(f"Resuming from generation {start}")
+    else:
+        logbook_file = LogbookWriter(LOGBOOK_PATH)
+        timing.take()
+        pop = toolbox.population(n=MU)
+        pareto_front = ParetoArchive(creator.Individual)
+
+        evals = evaluate_invalid(pop)
+
+        pop = toolbox.select(pop, len(pop))
+
         pareto_front.update(pop)
-    
+        if surrogate:
+            surrogate.add(pop.latents, pop.fitness)
+        stopping.update(hypervolume.update(pop.fitness), evals)
+        extra = {'sigma': engine.mean_sigma(pop)} if engine else {}
+        log(gen=0, evals=evals, hv=hypervolume.value, **extra, **(timing.columns() if TIMING else {}), **stats.compile(pop))
+        start = 0
+    timing.take()
+    for gen in range(start + 1, NGEN):
+        if profiler:
+            profiler.step(gen)
+        predicted = None
+        if surrogate and surrogate.ready:
+            # Breed a larger pool and only keep what the surrogate finds promising or uncertain
+            offspring, predicted, _ = screen_offspring(
+                toolbox, pop, surrogate, SURROGATE_POOL_FACTOR, n_screened, CX_PROB, MUTATION_PROB)
+        else:
+            # Select and clone (take() copies the chosen rows)
+            offspring = toolbox.select_parents(pop, len(pop))
+
+            # Crossover
+            toolbox.mate(offspring, CX_PROB)
+
+            # Mutation
+            toolbox.mutate(offspring, MUTATION_PROB)
+
+        # Evaluate
+        invalid = offspring.invalid_indices()
+        evals = evaluate_invalid(offspring)
+
+        extra = {}
+        if surrogate:
+            if predicted is not None:
+                extra = {'surr_err': surrogate.record_error(predicted, offspring.fitness),
+                         # Against the MU offspring a generation without screening breeds
+                         'saved': 1 - evals / MU}
+            surrogate.add(offspring.latents[invalid], offspring.fitness[invalid])
+
+        # Only the new offspring can change the archive and its hypervolume
+        pareto_front.update(offspring)
+        hypervolume.update(offspring.fitness)
+
+        # Select next generation
+        pop = toolbox.select(pop.concat(offspring), MU)
+
+        if scheduler:
+            extra['res'] = scheduler.resolution or 'full'
+            if scheduler.update(hypervolume.value):
+                # Scores of different fidelities are not comparable, re-score what survives
+                evaluator.set_resolution(scheduler.resolution)
+                pop = toolbox.select(rescore(pop, toolbox.evaluate), MU)
+                pareto_front = rescore_archive(pareto_front, toolbox.evaluate)
+                hypervolume.reset(pareto_front.fitness)
+                stopping.restart()
+                if teacher_check:
+                    teacher_check.reset()
+        stop = stopping.update(hypervolume.value, evals, converging=not scheduler or scheduler.full)
+        if alignment_check:
+            alignment_check(gen, pop, evaluator)
+        if engine:
+            extra['sigma'] = engine.mean_sigma(pop)
+        if teacher_check and gen % TEACHER_CHECK_EVERY == 0:
+            # Drift of the student on the archive, each member goes through the classifier once
+            extra['teacher_err'] = teacher_check(pareto_front)
+        if TIMING:
+            extra.update(timing.columns())
+        log(gen=gen, evals=evals, hv=hypervolume.value, **extra, **stats.compile(pop))
+
+        if checkpoints and (gen % CHECKPOINT_EVERY == 0 or gen == NGEN - 1 or stop):
+            checkpoints.save(gen, pop, pareto_front, **run_state(surrogate, scheduler, engine, stopping))
+        if stop:
+            print(f"Stopping at generation {gen}: {stop}")
+            break
+
+    if profiler:
+        profiler.close()
+    if checkpoints:
+        checkpoints.close()
+    logbook_file.close()
+
+    if scheduler and not scheduler.full:
+        # The final population and front always get full-fidelity scores
+        evaluator.set_resolution(None)
+        pop = toolbox.select(rescore(pop, toolbox.evaluate), MU)
+        pareto_front = rescore_archive(pareto_front, toolbox.evaluate)
+        if teacher_check:
+            teacher_check.reset()
+
+    if teacher_check:
+        # The reported population and front carry classifier f2, student scores only guided the search
+        pop = toolbox.select(teacher_check.rescore_population(pop), MU)
+        pareto_front = teacher_check.rescore(pareto_front)
+
     return pop, logbook, pareto_front
 
 if __name__ == "__main__":
-    pop, logbook, pareto_front = main(seed=42)
-    
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--resume', nargs='?', const=CHECKPOINT_PATH, default=None,
+                        help='continue from a checkpoint (default: CHECKPOINT_PATH)')
+    args = parser.parse_args()
+
+    evaluator = build_evaluator()
+    pop, logbook, pareto_front = main(seed=args.seed, evaluator=evaluator, resume=args.resume)
+
     utils_ae.visualize_results(pareto_front, logbook)
 
-    utils_ae.save_generated_images(pareto_front, stylegan)
-    
+    utils_ae.save_generated_images(pareto_front, evaluator)
+
+    cache = getattr(evaluator, 'cache', None)
+    if cache is not None:
+        print(f"Fitness cache: {cache.stats()}")
+    if WORKERS:
+        evaluator.close()
+
+    results = {
+        'population': pop,
+        'logbook': logbook,
+        'pareto_front': pareto_front
+    }
+    if isinstance(evaluator, SubspaceEvaluator):
+        results['pareto_latents'] = evaluator.encoding.decode(pareto_front.latents)
+
     import pickle
     with open('results/final_results.pkl', 'wb') as f:
-        pickle.dump({
-            'population': pop,
-            'logbook': logbook,
-            'pareto_front': pareto_front
-        }, f)
-    
\ No newline at end of file
+        pickle.dump(results, f)
+
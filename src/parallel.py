@@ -0,0 +1,218 @@
+import math
+import multiprocessing as mp
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+import torch
+import fitness
+import timing
+from runtime import optimize_evaluator, accuracy_check, TOLERANCE
+
+#STATE OF EACH WORKER PROCESS, FILLED ONCE BY _init_worker
+_worker = {}
+
+def _init_worker(loader, loader_kwargs, batch_size, n_threads, face_box=None, classifier_box=None,
+                 student_path=None, runtime=None):
+    torch.set_num_threads(n_threads)
+    torch.set_num_interop_threads(1)
+    generator, embedder, classifier = loader(device='cpu', **loader_kwargs)
+    student = None
+    if student_path is not None:
+        from distill import load_student
+        student = load_student(student_path)
+    _worker['evaluator'] = fitness.BatchEvaluator(generator, embedder, classifier, batch_size=batch_size,
+                                                  face_box=face_box, classifier_box=classifier_box,
+                                                  student=student)
+    if runtime is not None:
+        # Options of runtime.optimize_evaluator; the untouched models stay as the fp32 reference of _check_runtime
+        _worker['baseline'] = fitness.BatchEvaluator(generator, embedder, classifier, batch_size=batch_size,
+                                                     face_box=face_box, classifier_box=classifier_box,
+                                                     student=student)
+        optimize_evaluator(_worker['evaluator'], **runtime)
+    _worker['shm'] = {}
+
+
+def _attach(*names):
+    # Attach once per block and drop blocks the parent has replaced after growing
+    for name in list(_worker['shm']):
+        if name not in names:
+            _worker['shm'].pop(name).close()
+    for name in names:
+        if name not in _worker['shm']:
+            _worker['shm'][name] = SharedMemory(name=name)
+    return [_worker['shm'][name] for name in names]
+
+
+def _configure(target_embedding, target_class, resolution):
+    evaluator = _worker['evaluator']
+    evaluator.set_target_embedding(target_embedding)
+    evaluator.target_class = target_class
+    evaluator.set_resolution(resolution)
+    return evaluator
+
+
+def _evaluate_shared(in_name, out_name, shape, start, stop, target_embedding, target_class,
+                     targets=None, target_classes=None, resolution=None):
+    evaluator = _configure(target_embedding, target_class, resolution)
+    shm_in, shm_out = _attach(in_name, out_name)
+    latents = np.ndarray(shape, dtype=np.float32, buffer=shm_in.buf)
+    fits = np.ndarray((shape[0], 2), dtype=np.float64, buffer=shm_out.buf)
+    fits[start:stop] = evaluator.evaluate_latents(latents[start:stop], targets, target_classes)
+    # Stage times of this worker travel back with the call
+    return timing.take()
+
+
+def _evaluate(latents, target_embedding, target_class, targets=None, target_classes=None, resolution=None):
+    evaluator = _configure(target_embedding, target_class, resolution)
+    return evaluator.evaluate_latents(latents, targets, target_classes), timing.take()
+
+
+def _embed(latents):
+    return _worker['evaluator'].embed_latents(latents)
+
+
+def _teacher_probabilities(latents, target_class, resolution=None):
+    evaluator = _worker['evaluator']
+    evaluator.target_class = target_class
+    evaluator.set_resolution(resolution)
+    return evaluator.teacher_probabilities(latents)
+
+
+def _check_runtime(latents, tolerance):
+    return accuracy_check(_worker['baseline'], _worker['evaluator'], latents, tolerance)
+
+
+def _generate(w):
+    return _worker['evaluator'].generate(w)
+
+
+def _generate_batch(latents, resolution=None):
+    evaluator = _worker['evaluator']
+    evaluator.set_resolution(resolution)
+    return evaluator.generate_batch(latents)
+
+
+class PoolEvaluator():
+    """
+    Evaluates latents on a pool of processes. Every worker loads the models
+    once, pins its torch thread count and reads its slice of the latent
+    matrix from shared memory; fitness values are written back the same way.
+    """
+
+    def __init__(self, n_workers=None, threads_per_worker=1, batch_size=16,
+                 loader=fitness.load_models, loader_kwargs=None, target_class=1, face_box=None,
+                 classifier_box=None, student_path=None, runtime=None):
+        self.n_workers = n_workers or max(1, (os.cpu_count() or 1) // threads_per_worker)
+        self.batch_size = batch_size
+        self.target_class = target_class
+        self.target_embedding = None
+        self.resolution = None
+        self.shm_in = None
+        self.shm_out = None
+        self.lock = threading.Lock()
+        self.pool = ProcessPoolExecutor(
+            self.n_workers, mp_context=mp.get_context('spawn'), initializer=_init_worker,
+            initargs=(loader, loader_kwargs or {}, batch_size, threads_per_worker, face_box, classifier_box,
+                      student_path, runtime))
+
+    def set_target_embedding(self, embedding):
+        self.target_embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+
+    def set_resolution(self, resolution):
+        self.resolution = resolution
+
+    def map(self, func, *iterables):
+        """Backend for toolbox.map"""
+        return self.pool.map(func, *iterables)
+
+    def reserve(self, n, latent_dim):
+        """Makes sure the shared blocks can hold n latents, growing them when needed"""
+        nbytes = n * latent_dim * 4
+        if self.shm_in is None or self.shm_in.size < nbytes or self.shm_out.size < n * 2 * 8:
+            self.release()
+            self.shm_in = SharedMemory(create=True, size=nbytes)
+            self.shm_out = SharedMemory(create=True, size=n * 2 * 8)
+
+    def evaluate_latents(self, latents, targets=None, target_classes=None):
+        if targets is None and self.target_embedding is None:
+            raise ValueError("target_embedding must be set before evaluating")
+        latents = np.asarray(latents, dtype=np.float32)
+        n = len(latents)
+        if n == 0:
+            return np.empty((0, 2), dtype=np.float64)
+        if n <= self.batch_size:
+            # A single batch goes to one worker by value, several threads can do this at once
+            fits, times = self.pool.submit(
+                _evaluate, latents, self.target_embedding, self.target_class,
+                None if targets is None else np.asarray(targets, dtype=np.float32),
+                None if target_classes is None else np.asarray(target_classes), self.resolution).result()
+            timing.add(*times)
+            return fits
+        with self.lock:
+            return self.evaluate_shared(latents, targets, target_classes)
+
+    def evaluate_shared(self, latents, targets=None, target_classes=None):
+        """Whole matrix through shared memory, split across all workers"""
+        n = len(latents)
+        self.reserve(n, latents.shape[1])
+        np.ndarray(latents.shape, dtype=np.float32, buffer=self.shm_in.buf)[:] = latents
+
+        # One slice per worker, rounded up to whole batches
+        chunk = self.batch_size * math.ceil(n / (self.n_workers * self.batch_size))
+        futures = []
+        for start in range(0, n, chunk):
+            stop = min(start + chunk, n)
+            rows = slice(start, stop)
+            futures.append(self.pool.submit(
+                _evaluate_shared, self.shm_in.name, self.shm_out.name, latents.shape, start, stop,
+                self.target_embedding, self.target_class,
+                None if targets is None else np.asarray(targets[rows], dtype=np.float32),
+                None if target_classes is None else np.asarray(target_classes[rows]), self.resolution))
+        for future in futures:
+            timing.add(*future.result())
+        return np.ndarray((n, 2), dtype=np.float64, buffer=self.shm_out.buf).copy()
+
+    def embed_latents(self, latents):
+        return self.pool.submit(_embed, np.asarray(latents, dtype=np.float32)).result()
+
+    def teacher_probabilities(self, latents):
+        latents = np.asarray(latents, dtype=np.float32)
+        chunks = [latents[start:start + self.batch_size] for start in range(0, len(latents), self.batch_size)]
+        out = self.pool.map(_teacher_probabilities, chunks, [self.target_class] * len(chunks),
+                            [self.resolution] * len(chunks))
+        return np.concatenate(list(out)) if chunks else np.empty(0)
+
+    def check_runtime(self, latents, tolerance=TOLERANCE):
+        """runtime.accuracy_check run inside one worker, against its fp32 models"""
+        return self.pool.submit(_check_runtime, np.asarray(latents, dtype=np.float32), tolerance).result()
+
+    def generate(self, w):
+        return self.pool.submit(_generate, np.asarray(w, dtype=np.float32)).result()
+
+    def generate_batch(self, latents):
+        """Images of `latents`, one batch per worker task"""
+        latents = np.asarray(latents, dtype=np.float32)
+        chunks = [latents[start:start + self.batch_size] for start in range(0, len(latents), self.batch_size)]
+        return np.concatenate(list(self.pool.map(_generate_batch, chunks, [self.resolution] * len(chunks))))
+
+    def __call__(self, individuals):
+        individuals = list(individuals)
+        if not individuals:
+            return []
+        fits = [tuple(fit) for fit in self.evaluate_latents(np.asarray(individuals, dtype=np.float32))]
+        for ind, fit in zip(individuals, fits):
+            ind.fitness.values = fit
+        return fits
+
+    def release(self):
+        for shm in (self.shm_in, self.shm_out):
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        self.shm_in = self.shm_out = None
+
+    def close(self):
+        self.pool.shutdown()
+        self.release()
@@ -1,11 +1,17 @@
-from deap import base, creator, tools, algorithms
-import csv
 import random
+import numpy as np
+from timing import timed
+from utils.banco_latentes import LatentBank, SALIDA as LATENT_BANK
 
-class load_population(): #GENERAL POPULATION CLASS, NOT THE DEAP ONE (FOR THAT IS INIT_INDVIDUAL)
+class load_population(): #STARTING LATENTS (w0), NOT THE DEAP POPULATION (FOR THAT IS PopulationMatrix)
 
-    def __init__(self, n=20):
-        self.population_init = get_init_population_from_csv(n)
+    def __init__(self, n=20, bank=LATENT_BANK):
+        # Inverted latents of the real photos when the bank exists (one row per person), the CSV otherwise
+        self.bank = LatentBank(bank) if bank is not None and LatentBank.exists(bank) else None
+        if self.bank is not None:
+            self.population_init = self.bank.means
+        else:
+            self.population_init = self.get_init_population_from_csv(n)
 
     def get_random_population(self, n=20):
         min_value = -1.0
@@ -14,13 +20,116 @@ class load_population(): #GENERAL POPULATION CLASS, NOT THE DEAP ONE (FOR THAT I
         return random_population
 
     def get_nth_init_population(self, n):
-        return self.population_init[n]
+        return np.array(self.population_init[n], dtype=np.float32)
+
+    def get_person_init_population(self, person_id):
+        """Mean inverted latent of a CelebA person, needs the latent bank"""
+        if self.bank is None:
+            raise ValueError("no latent bank, build it with python -m utils.banco_latentes")
+        return self.bank.person_latent(person_id)
 
     def get_init_population_from_csv(self, n, path = '../data/init_population.csv'):
-        with open(path, 'r') as file:
-            rows = list(csv.reader(file))
-        return rows
+        return np.loadtxt(path, delimiter=',', dtype=np.float32, ndmin=2)
+
+
+class PopulationMatrix():
+    """
+    Array-backed population: one contiguous (n, latent_dim) float32 matrix and
+    an (n, n_objectives) fitness array, NaN rows being invalid individuals.
+    Iterating yields DEAP individuals that are views over the matrix rows, so
+    tools.Statistics, ParetoFront and utils_ae keep working on it.
+    """
+
+    def __init__(self, latents, fitness=None, icls=None, n_objectives=2):
+        self.latents = np.ascontiguousarray(latents, dtype=np.float32)
+        if fitness is None:
+            fitness = np.full((len(self.latents), n_objectives), np.nan)
+        self.fitness = np.asarray(fitness, dtype=np.float64)
+        self.icls = icls
+        self.crowding = None
+        # Per-row parameters of the variation engine (adaptive.py), carried along by take/concat
+        self.strategy = None
+
+    @classmethod
+    def from_seed(cls, w0, n, perturbation=0.1, icls=None):
+        w0 = np.asarray(w0, dtype=np.float32)
+        noise = np.random.normal(0, perturbation, (n, len(w0))).astype(np.float32)
+        return cls(w0 + noise, icls=icls)
+
+    def __len__(self):
+        return len(self.latents)
+
+    def __iter__(self):
+        return iter(self.individuals())
+
+    def valid(self):
+        return ~np.isnan(self.fitness).any(axis=1)
+
+    def invalid_indices(self):
+        return np.flatnonzero(~self.valid())
+
+    def invalidate(self, rows):
+        self.fitness[rows] = np.nan
+
+    @timed('clone')
+    def take(self, indices):
+        """Copies the selected rows into a new population, cloning them all in one shot"""
+        indices = np.asarray(indices, dtype=np.intp)
+        out = PopulationMatrix(self.latents[indices], self.fitness[indices], self.icls)
+        if self.crowding is not None:
+            out.crowding = self.crowding[indices]
+        if self.strategy is not None:
+            out.strategy = self.strategy[indices]
+        return out
+
+    @timed('clone')
+    def concat(self, other):
+        out = PopulationMatrix(np.concatenate([self.latents, other.latents]),
+                               np.concatenate([self.fitness, other.fitness]), self.icls)
+        if self.strategy is not None and other.strategy is not None:
+            out.strategy = np.concatenate([self.strategy, other.strategy])
+        return out
+
+    def individuals(self):
+        """DEAP individuals sharing memory with the matrix rows, tagged with their row index"""
+        inds = []
+        for i, row in enumerate(self.latents):
+            ind = row.view(self.icls)
+            ind.fitness = self.icls.fitness()
+            if not np.isnan(self.fitness[i]).any():
+                ind.fitness.values = tuple(self.fitness[i])
+            if self.crowding is not None:
+                ind.fitness.crowding_dist = self.crowding[i]
+            ind.index = i
+            inds.append(ind)
+        return inds
+
+
+@timed('crossover')
+def cx_blend_matrix(pop, cxpb, alpha):
+    """tools.cxBlend applied to consecutive row pairs, each pair mating with probability cxpb"""
+    n_pairs = len(pop) // 2
+    mate = np.flatnonzero(np.random.random(n_pairs) <= cxpb)
+    if len(mate) == 0:
+        return pop
+    rows1, rows2 = 2 * mate, 2 * mate + 1
+    x1, x2 = pop.latents[rows1], pop.latents[rows2]
+    gamma = ((1. + 2. * alpha) * np.random.random(x1.shape) - alpha).astype(np.float32)
+    pop.latents[rows1] = (1. - gamma) * x1 + gamma * x2
+    pop.latents[rows2] = gamma * x1 + (1. - gamma) * x2
+    pop.invalidate(np.concatenate([rows1, rows2]))
+    return pop
 
-def init_individual(toolbox, n=10):
-    toolbox.register()
 
+@timed('mutation')
+def mut_gaussian_matrix(pop, mutpb, mu, sigma, indpb):
+    """tools.mutGaussian applied to each row with probability mutpb"""
+    rows = np.flatnonzero(np.random.random(len(pop)) < mutpb)
+    if len(rows) == 0:
+        return pop
+    shape = (len(rows), pop.latents.shape[1])
+    mask = np.random.random(shape) < indpb
+    noise = np.random.normal(mu, sigma, shape).astype(np.float32)
+    pop.latents[rows] += noise * mask
+    pop.invalidate(rows)
+    return pop
@@ -0,0 +1,145 @@
+import pickle
+import random
+from pathlib import Path
+import numpy as np
+from deap import creator
+import fitness
+from fitness_cache import FitnessCache, CachedEvaluator
+from hypervolume import HypervolumeTracker, EarlyStopping
+from main import (toolbox, load_evaluator, model_namespace, make_stats, make_logbook,
+                  BATCH_SIZE, CACHE_PATH, PERTURBATION, WORKERS, HV_EPSILON, HV_WINDOW, EVAL_BUDGET)
+from population import load_population, PopulationMatrix
+from selection import ParetoArchive
+from utils import utils_ae
+from utils.embeddings_referencia import ReferenceStore
+
+OUTPUT_DIR = '../results/subjects'
+
+class Subject():
+    """One independent evolution: its own population, Pareto archive and logbook"""
+
+    def __init__(self, name, w0, target_embedding, target_class=1):
+        self.name = name
+        self.w0 = np.asarray(w0, dtype=np.float32)
+        self.target_embedding = np.asarray(target_embedding, dtype=np.float32)
+        self.target_class = target_class
+        self.pop = None
+        self.pareto_front = ParetoArchive(creator.Individual)
+        self.logbook = make_logbook(("hv",))
+        self.hypervolume = HypervolumeTracker()
+        self.stopping = EarlyStopping(HV_EPSILON, HV_WINDOW, max_evals=EVAL_BUDGET)
+        self.stopped = None
+
+
+def make_subjects(evaluator, n=None, persons=None, store=None):
+    """
+    One subject per row of the init population. With `persons` (one CelebA ID
+    per row) the targets come from the reference store and, when the latent
+    bank exists, each person starts from their own inverted latent.
+    Otherwise targets are the faces synthesized from each starting latent.
+    """
+    population = load_population()
+    latents = np.asarray(population.population_init[:n], dtype=np.float32)
+    if persons is None:
+        targets = evaluator.embed_latents(latents)
+        return [Subject(f"subject_{i:04d}", w0, target) for i, (w0, target) in enumerate(zip(latents, targets))]
+
+    store = store or ReferenceStore()
+    if population.bank is not None:
+        # Each person starts from the inversion of their own photos
+        latents = [population.get_person_init_population(person_id) for person_id in persons]
+    subjects = []
+    for w0, person_id in zip(latents, persons):
+        target_gender = 'female' if store.gender(person_id) == 'male' else 'male'
+        subjects.append(Subject(f"person_{person_id:04d}", w0, store.mean_embedding(person_id),
+                                fitness.GENDER_CLASSES.index(target_gender)))
+    return subjects
+
+
+def evaluate_subjects(evaluator, subjects, pops):
+    """Packs the invalid rows of every population into one evaluation call"""
+    invalid = [pop.invalid_indices() for pop in pops]
+    counts = [len(idx) for idx in invalid]
+    if sum(counts) == 0:
+        return counts
+    latents = np.concatenate([pop.latents[idx] for pop, idx in zip(pops, invalid)])
+    targets = np.concatenate([np.repeat(s.target_embedding[None], n, axis=0) for s, n in zip(subjects, counts)])
+    classes = np.concatenate([np.full(n, s.target_class) for s, n in zip(subjects, counts)])
+
+    fits = evaluator.evaluate_latents(latents, targets, classes)
+    for pop, idx, part in zip(pops, invalid, np.split(fits, np.cumsum(counts)[:-1])):
+        pop.fitness[idx] = part
+    return counts
+
+
+def run_subjects(subjects, evaluator, ngen=250, mu=100, cx_prob=0.9, mutation_prob=0.1, seed=None):
+    """
+    Advances every subject's NSGA-II in lockstep, one shared evaluation per
+    generation. Subjects that converge (see EarlyStopping) leave the lockstep
+    and the rest keep the batches full.
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    stats = make_stats()
+
+    pops = [PopulationMatrix.from_seed(s.w0, mu, PERTURBATION, creator.Individual) for s in subjects]
+    evals = evaluate_subjects(evaluator, subjects, pops)
+    for s, pop, n in zip(subjects, pops, evals):
+        s.pop = toolbox.select(pop, mu)
+        s.pareto_front.update(s.pop)
+        s.stopping.update(s.hypervolume.update(s.pop.fitness), n)
+        s.logbook.record(gen=0, evals=n, hv=s.hypervolume.value, **stats.compile(s.pop))
+    print(f"gen 0: {sum(evals)} evaluations for {len(subjects)} subjects")
+
+    for gen in range(1, ngen):
+        active = [s for s in subjects if s.stopped is None]
+        if not active:
+            break
+        offspring = []
+        for s in active:
+            o = toolbox.select_parents(s.pop, len(s.pop))
+            toolbox.mate(o, cx_prob)
+            toolbox.mutate(o, mutation_prob)
+            offspring.append(o)
+
+        evals = evaluate_subjects(evaluator, active, offspring)
+
+        for s, o, n in zip(active, offspring, evals):
+            s.pareto_front.update(o)
+            s.pop = toolbox.select(s.pop.concat(o), mu)
+            s.stopped = s.stopping.update(s.hypervolume.update(o.fitness), n)
+            s.logbook.record(gen=gen, evals=n, hv=s.hypervolume.value, **stats.compile(s.pop))
+            if s.stopped:
+                print(f"{s.name} stopped at generation {gen}: {s.stopped}")
+        print(f"gen {gen}: {sum(evals)} evaluations for {len(active)} subjects")
+
+    return subjects
+
+
+def save_subjects(subjects, evaluator, output_dir=OUTPUT_DIR):
+    for s in subjects:
+        subject_dir = Path(output_dir) / s.name
+        utils_ae.visualize_results(s.pareto_front, s.logbook, subject_dir / 'plots')
+        utils_ae.save_generated_images(s.pareto_front, evaluator, subject_dir / 'images')
+        with open(subject_dir / 'final_results.pkl', 'wb') as f:
+            pickle.dump({
+                'population': s.pop,
+                'logbook': s.logbook,
+                'pareto_front': s.pareto_front
+            }, f)
+
+
+if __name__ == "__main__":
+    evaluator = load_evaluator(BATCH_SIZE, WORKERS)
+    if CACHE_PATH is not None:
+        # Each row's reference identity goes into its cache key, so one namespace serves every subject
+        evaluator = CachedEvaluator(evaluator, FitnessCache(CACHE_PATH, model_namespace()))
+
+    subjects = make_subjects(evaluator)
+    run_subjects(subjects, evaluator, seed=42)
+    save_subjects(subjects, evaluator)
+
+    if isinstance(evaluator, CachedEvaluator):
+        print(f"Fitness cache: {evaluator.cache.stats()}")
+    if WORKERS:
+        evaluator.close()
@@ -0,0 +1,264 @@
+"""
+Inference runtime for the evaluation models. Each model runs through a
+BatchRunner: fixed-size batches copied into a preallocated (padded) input
+buffer, under torch.inference_mode, optionally traced to TorchScript and
+cached on disk (or torch.compile'd), with channels-last CNNs, bf16 weights
+or dynamic int8 Linear layers. optimize_evaluator() swaps the models of a
+BatchEvaluator in place, warms them up and checks f1/f2 against fp32.
+Evaluation only: inference tensors cannot be used for gradients, so the
+inversion (inversion.py) keeps the eager models.
+
+    python runtime.py    # speed and accuracy of each option on the real models
+"""
+import copy
+import hashlib
+import os
+import time
+import warnings
+from pathlib import Path
+import numpy as np
+import torch
+import torch.nn as nn
+
+CACHE_DIR = Path('../results/runtime_cache')
+TOLERANCE = (0.01, 0.01) #MAX ABSOLUTE DIFFERENCE IN (f1, f2) ACCEPTED AGAINST THE FP32 EAGER MODELS
+
+class _ConstSynthesis(nn.Module):
+    # generator.synthesis(ws, noise_mode='const') as a one-input module, the form tracing and compile need
+    def __init__(self, generator):
+        super().__init__()
+        self.generator = generator
+
+    def forward(self, ws):
+        return self.generator.synthesis(ws, noise_mode='const')
+
+
+def fingerprint(module):
+    """sha1 of the weights, the cache key of a module without a file version"""
+    digest = hashlib.sha1()
+    for name, tensor in module.state_dict().items():
+        digest.update(f"{name}{tuple(tensor.shape)}{tensor.dtype}".encode())
+        digest.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+
+class BatchRunner():
+    """
+    Runs `module` on batches of exactly `batch_size` rows: inputs are copied
+    into a buffer allocated once per input shape (the tail of a short batch
+    is padding) and the output is cut back to the real rows. A fixed shape
+    is what lets the traced graph and oneDNN reuse their kernels.
+    compile: None (eager), 'trace' (TorchScript, saved under cache_dir) or
+    'compile' (torch.compile, inductor's on-disk cache under cache_dir).
+    """
+
+    def __init__(self, module, batch_size, name, compile=None, bf16=False, int8=False, channels_last=False,
+                 cache_dir=CACHE_DIR, version=''):
+        if compile not in (None, 'trace', 'compile'):
+            raise ValueError(f"unknown compile mode {compile!r}")
+        if compile == 'trace' and not version:
+            version = fingerprint(module)
+        if bf16 or int8 or channels_last:
+            # The originals stay untouched for the fp32 baseline
+            module = copy.deepcopy(module)
+        if int8:
+            module = torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8)
+        if bf16:
+            module = module.to(torch.bfloat16)
+        if channels_last:
+            module = module.to(memory_format=torch.channels_last)
+        self.module = module.eval()
+        self.batch_size = batch_size
+        self.name = name
+        self.compile = compile
+        self.dtype = torch.bfloat16 if bf16 else torch.float32
+        self.channels_last = channels_last
+        self.cache_dir = Path(cache_dir)
+        self.version = version
+        self.int8 = int8
+        #INPUT BUFFER AND RUNNABLE PER INPUT SHAPE
+        self.buffers = {}
+        self.runnables = {}
+
+    def cache_path(self, shape):
+        key = '|'.join(map(str, [self.name, self.version, tuple(shape), self.dtype, self.int8,
+                                 self.channels_last, torch.__version__]))
+        return self.cache_dir / f"{self.name}_{hashlib.sha1(key.encode()).hexdigest()[:12]}.pt"
+
+    def _build(self, example):
+        if self.compile == 'compile':
+            from torch._inductor import config as inductor_config
+            os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', str(self.cache_dir.absolute() / 'inductor'))
+            inductor_config.fx_graph_cache = True
+            return torch.compile(self.module, dynamic=False)
+        if self.compile == 'trace':
+            path = self.cache_path(example.shape)
+            try:
+                if path.exists():
+                    traced = torch.jit.load(str(path), map_location=example.device)
+                else:
+                    with torch.no_grad():
+                        traced = torch.jit.trace(self.module, example, check_trace=False)
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    tmp = path.with_suffix('.tmp')
+                    torch.jit.save(traced, str(tmp))
+                    tmp.replace(path)
+                # Frozen graphs with folded oneDNN weights do not reload, the plain trace is what gets cached
+                return torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+            except Exception as error:
+                warnings.warn(f"{self.name}: tracing failed ({error}), running eager")
+                return self.module
+        return self.module
+
+    def _runnable(self, x):
+        shape = (self.batch_size,) + tuple(x.shape[1:])
+        if shape not in self.runnables:
+            buffer = torch.zeros(shape, dtype=self.dtype, device=x.device)
+            if self.channels_last and buffer.dim() == 4:
+                buffer = buffer.contiguous(memory_format=torch.channels_last)
+            self.buffers[shape] = buffer
+            self.runnables[shape] = self._build(buffer)
+        return self.buffers[shape], self.runnables[shape]
+
+    def __call__(self, x):
+        if len(x) > self.batch_size:
+            return torch.cat([self(x[i:i + self.batch_size]) for i in range(0, len(x), self.batch_size)])
+        n = len(x)
+        buffer, runnable = self._runnable(x)
+        with torch.inference_mode():
+            buffer[:n].copy_(x)
+            out = runnable(buffer)
+            return out[:n].to(torch.float32)
+
+    def warm_up(self, example, steps=2):
+        """Builds the runnable for this input shape and runs it a few times (allocator, oneDNN primitives)"""
+        for _ in range(steps):
+            self(example)
+
+
+class _Synthesis():
+    # Full-resolution const-noise calls go to the runner, anything else (block-wise low-res) to the original
+    def __init__(self, synthesis, runner):
+        self.synthesis = synthesis
+        self.runner = runner
+
+    def __call__(self, ws, noise_mode='const', **kwargs):
+        if noise_mode == 'const' and not kwargs:
+            return self.runner(ws)
+        return self.synthesis(ws, noise_mode=noise_mode, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.synthesis, name)
+
+
+class OptimizedGenerator():
+    """The generator with its synthesis network behind a BatchRunner, everything else forwarded"""
+
+    def __init__(self, generator, runner):
+        self.generator = generator
+        self.synthesis = _Synthesis(generator.synthesis, runner)
+
+    def __getattr__(self, name):
+        return getattr(self.generator, name)
+
+
+def accuracy_check(baseline, optimized, latents, tolerance=TOLERANCE, seed=0):
+    """
+    (f1, f2) of both evaluators on the same latents, random unit targets and
+    classes. Returns max / mean absolute difference and rank correlation per
+    objective, and whether the max differences are within `tolerance`.
+    """
+    rng = np.random.RandomState(seed)
+    latents = np.asarray(latents, dtype=np.float32)
+    targets = rng.randn(len(latents), 512).astype(np.float32)
+    classes = rng.randint(2, size=len(latents))
+    base = baseline.evaluate_latents(latents, targets, classes)
+    fast = optimized.evaluate_latents(latents, targets, classes)
+    rank = lambda v: np.argsort(np.argsort(v))
+    report = {'ok': True}
+    for i, (name, tol) in enumerate(zip(('f1', 'f2'), tolerance)):
+        diff = np.abs(base[:, i] - fast[:, i])
+        report[name] = {'max_abs': float(diff.max()), 'mean_abs': float(diff.mean()),
+                        'rank_corr': float(np.corrcoef(rank(base[:, i]), rank(fast[:, i]))[0, 1])
+                        if len(latents) > 1 else 1.0}
+        report['ok'] &= bool(diff.max() <= tol)
+    return report
+
+
+def optimize_evaluator(evaluator, compile='trace', bf16=False, int8=False, channels_last=True,
+                       cache_dir=CACHE_DIR, versions=None, check_latents=None, tolerance=TOLERANCE, strict=False):
+    """
+    Puts the models of a BatchEvaluator behind BatchRunners, in place.
+    bf16 applies to all three models, int8 to the Linear layers of FaceNet
+    and the classifier (StyleGAN's layers are custom modules). With
+    `check_latents` the result is compared to the fp32 eager models; a
+    failed check warns, or raises with strict=True. Returns the report.
+    """
+    import fitness
+
+    versions = versions or {}
+    baseline = fitness.BatchEvaluator(evaluator.generator, evaluator.embedder, evaluator.classifier,
+                                      batch_size=evaluator.batch_size, device=evaluator.device,
+                                      face_box=evaluator.face_box, classifier_box=evaluator.classifier_box,
+                                      student=evaluator.student)
+    options = dict(compile=compile, bf16=bf16, cache_dir=cache_dir)
+    evaluator.generator = OptimizedGenerator(evaluator.generator, BatchRunner(
+        _ConstSynthesis(evaluator.generator), evaluator.batch_size, 'synthesis',
+        version=versions.get('generator', ''), **options))
+    evaluator.embedder = BatchRunner(evaluator.embedder, evaluator.batch_size, 'embedder', int8=int8,
+                                     channels_last=channels_last, version=versions.get('embedder', ''), **options)
+    if evaluator.classifier is not None:
+        evaluator.classifier = BatchRunner(evaluator.classifier, evaluator.batch_size, 'classifier', int8=int8,
+                                           channels_last=channels_last, version=versions.get('classifier', ''),
+                                           **options)
+
+    # Warm-up: one full pass builds (or loads) every graph before the first generation
+    generator = evaluator.generator
+    z = torch.from_numpy(np.random.RandomState(0).randn(evaluator.batch_size, generator.z_dim).astype(np.float32))
+    with torch.no_grad():
+        warm = generator.mapping(z.to(evaluator.device), None)[:, 0].cpu().numpy()
+    tick = time.perf_counter()
+    evaluator.evaluate_latents(warm, np.ones((len(warm), 512), dtype=np.float32), np.ones(len(warm), dtype=np.int64))
+    report = {'warm_up_seconds': time.perf_counter() - tick}
+
+    if check_latents is not None:
+        report.update(accuracy_check(baseline, evaluator, check_latents, tolerance))
+        report_check(report, f"runtime ({compile}, bf16={bf16}, int8={int8})", tolerance, strict)
+    return report
+
+
+def report_check(report, label, tolerance=TOLERANCE, strict=False):
+    """Prints the result of accuracy_check; above tolerance it warns, or raises with strict=True"""
+    message = f"{label} vs fp32: f1 max {report['f1']['max_abs']:.4f}, f2 max {report['f2']['max_abs']:.4f}"
+    if not report['ok']:
+        if strict:
+            raise RuntimeError(message + f", above tolerance {tolerance}")
+        warnings.warn(message + f", above tolerance {tolerance}")
+    else:
+        print(message)
+
+
+if __name__ == "__main__":
+    import fitness
+    from fitness_cache import model_version
+    from utils import cargar_modelo
+
+    device = cargar_modelo.default_device()
+    versions = {'generator': model_version(cargar_modelo.PKL_PATH), 'embedder': model_version(cargar_modelo.FACENET_PATH),
+                'classifier': model_version(cargar_modelo.CLASSIFIER_PATH)}
+    models = fitness.load_models(device)
+    generator = models[0]
+    z = torch.from_numpy(np.random.RandomState(1).randn(64, generator.z_dim).astype(np.float32))
+    with torch.no_grad():
+        latents = generator.mapping(z.to(device), None, truncation_psi=0.7)[:, 0].cpu().numpy()
+    targets = np.ones((len(latents), 512), dtype=np.float32)
+
+    for options in ({'compile': None, 'channels_last': False}, {'compile': None}, {'compile': 'trace'},
+                    {'compile': 'trace', 'bf16': True}, {'compile': 'trace', 'int8': True}):
+        evaluator = fitness.BatchEvaluator(*models, batch_size=16, device=device)
+        report = optimize_evaluator(evaluator, versions=versions, check_latents=latents, **options)
+        tick = time.perf_counter()
+        evaluator.evaluate_latents(latents, targets)
+        rate = len(latents) / (time.perf_counter() - tick)
+        print(f"{options}: {rate:.1f} latents/s, warm-up {report['warm_up_seconds']:.1f} s, "
+              f"f1 max {report['f1']['max_abs']:.4f}, f2 max {report['f2']['max_abs']:.4f}")
@@ -0,0 +1,200 @@
+from bisect import bisect_right
+import numpy as np
+from population import PopulationMatrix
+from timing import timed
+
+#ALL FUNCTIONS ASSUME MAXIMIZATION OF EVERY OBJECTIVE, AS IN creator.FitnessMulti
+
+def dominates(a, b):
+    """Boolean matrix, [i, j] is True when a[i] Pareto-dominates b[j]"""
+    a = a[:, None, :]
+    b = b[None, :, :]
+    return (a >= b).all(axis=2) & (a > b).any(axis=2)
+
+
+def _sort_2d(fits):
+    # Sweep over the points by decreasing f1: a point is dominated by a front
+    # iff the front's largest f2 is >= its own, and those values decrease
+    # from one front to the next, so the front is found with a binary search.
+    unique, inverse = np.unique(fits, axis=0, return_inverse=True)
+    order = np.lexsort((-unique[:, 1], -unique[:, 0]))
+    ranks = np.empty(len(unique), dtype=np.intp)
+    neg_last_f2 = []
+    for i in order:
+        f2 = -unique[i, 1]
+        k = bisect_right(neg_last_f2, f2)
+        if k == len(neg_last_f2):
+            neg_last_f2.append(f2)
+        else:
+            neg_last_f2[k] = f2
+        ranks[i] = k
+    return ranks[inverse.reshape(-1)]
+
+
+def _sort_nd(fits):
+    dom = dominates(fits, fits)
+    n_dominators = dom.sum(axis=0)
+    ranks = np.full(len(fits), -1, dtype=np.intp)
+    current = np.flatnonzero(n_dominators == 0)
+    rank = 0
+    while len(current):
+        ranks[current] = rank
+        n_dominators = n_dominators - dom[current].sum(axis=0)
+        n_dominators[current] = -1
+        current = np.flatnonzero(n_dominators == 0)
+        rank += 1
+    return ranks
+
+
+def non_dominated_sort(fits):
+    """Front index (0 = non-dominated) of every row of `fits`"""
+    fits = np.asarray(fits, dtype=np.float64)
+    if len(fits) == 0:
+        return np.empty(0, dtype=np.intp)
+    if fits.shape[1] == 2:
+        return _sort_2d(fits)
+    return _sort_nd(fits)
+
+
+def crowding_distance(fits, ranks):
+    """Crowding distance of every row inside its own front, same formula as tools.emo"""
+    fits = np.asarray(fits, dtype=np.float64)
+    n, nobj = fits.shape
+    distances = np.zeros(n)
+    if n == 0:
+        return distances
+    for i in range(nobj):
+        order = np.lexsort((fits[:, i], ranks))
+        values = fits[order, i]
+        r = ranks[order]
+        first = np.r_[True, r[1:] != r[:-1]]
+        last = np.r_[r[1:] != r[:-1], True]
+        starts = np.flatnonzero(first)
+        sizes = np.diff(np.r_[starts, n])
+        span = np.repeat(values[np.flatnonzero(last)] - values[starts], sizes)
+        interior = ~(first | last)
+        gaps = np.zeros(n)
+        gaps[1:-1] = values[2:] - values[:-2]
+        norm = nobj * span
+        add = np.zeros(n)
+        ok = interior & (norm != 0)
+        add[ok] = gaps[ok] / norm[ok]
+        add[first | last] = np.inf
+        distances[order] += add
+    return distances
+
+
+def nsga2_indices(fits, k):
+    """Indices chosen by NSGA-II and their crowding distances"""
+    ranks = non_dominated_sort(fits)
+    distances = crowding_distance(fits, ranks)
+    counts = np.bincount(ranks)
+    last_rank = np.searchsorted(np.cumsum(counts), k)
+    chosen = np.flatnonzero(ranks < last_rank)
+    last_front = np.flatnonzero(ranks == last_rank)
+    last_front = last_front[np.argsort(-distances[last_front], kind='stable')]
+    chosen = np.concatenate([chosen, last_front[:k - len(chosen)]])
+    return chosen, distances[chosen]
+
+
+def tournament_dcd_indices(fits, crowding, k):
+    """tools.selTournamentDCD on index arrays: dominance first, then crowding, then a coin flip"""
+    n = len(fits)
+    if k > n:
+        raise ValueError("selTournamentDCD: k must be less than or equal to individuals length")
+    if k % 4 != 0:
+        raise ValueError("selTournamentDCD: k must be divisible by four")
+    winners = []
+    for _ in range(2):
+        # As in DEAP, pairs come from the first k of each permutation: k / 2 winners each
+        perm = np.random.permutation(n)
+        a, b = perm[0:k:2], perm[1:k:2]
+        fa, fb = fits[a], fits[b]
+        a_dom = (fa >= fb).all(axis=1) & (fa > fb).any(axis=1)
+        b_dom = (fb >= fa).all(axis=1) & (fb > fa).any(axis=1)
+        pick_a = np.where(crowding[a] != crowding[b], crowding[a] > crowding[b],
+                          np.random.random(len(a)) <= 0.5)
+        pick_a = a_dom | (~b_dom & pick_a)
+        winners.append(np.where(pick_a, a, b))
+    return np.concatenate(winners)
+
+
+@timed('selection')
+def sel_nsga2(pop, k):
+    chosen, distances = nsga2_indices(pop.fitness, k)
+    out = pop.take(chosen)
+    out.crowding = distances
+    return out
+
+
+@timed('selection')
+def sel_tournament_dcd(pop, k):
+    return pop.take(tournament_dcd_indices(pop.fitness, pop.crowding, k))
+
+
+class ParetoArchive():
+    """
+    Incremental replacement for tools.ParetoFront: new individuals are only
+    tested against the current front instead of re-scanning everything.
+    Iterating yields DEAP individuals, like the population matrix.
+    """
+
+    def __init__(self, icls=None):
+        self.icls = icls
+        self.front = None
+        self.keys = set()
+
+    def __len__(self):
+        return 0 if self.front is None else len(self.front)
+
+    def __iter__(self):
+        return iter([] if self.front is None else self.front.individuals())
+
+    def __getitem__(self, i):
+        return self.front.individuals()[i]
+
+    @property
+    def latents(self):
+        return self.front.latents
+
+    @property
+    def fitness(self):
+        return self.front.fitness
+
+    @timed('archive')
+    def update(self, pop):
+        valid = np.flatnonzero(pop.valid())
+        if len(valid) == 0:
+            return
+        candidates = pop.take(valid)
+        candidates = candidates.take(np.flatnonzero(non_dominated_sort(candidates.fitness) == 0))
+
+        # Skip latents already in the archive (or repeated in this batch)
+        batch = {}
+        for i, row in enumerate(candidates.latents):
+            key = hash(row.tobytes())
+            if key not in self.keys:
+                batch.setdefault(key, i)
+        if not batch:
+            return
+        keys = list(batch)
+        candidates = candidates.take(list(batch.values()))
+
+        if self.front is None:
+            survivors = np.ones(len(candidates), dtype=bool)
+            kept = np.zeros(0, dtype=np.intp)
+        else:
+            survivors = ~dominates(self.front.fitness, candidates.fitness).any(axis=0)
+            if not survivors.any():
+                return
+            removed = dominates(candidates.fitness[survivors], self.front.fitness).any(axis=0)
+            kept = np.flatnonzero(~removed)
+            for row in np.flatnonzero(removed):
+                self.keys.discard(hash(self.front.latents[row].tobytes()))
+
+        added = candidates.take(np.flatnonzero(survivors))
+        self.keys.update(key for key, s in zip(keys, survivors) if s)
+        if self.front is None:
+            self.front = PopulationMatrix(added.latents, added.fitness, self.icls)
+        else:
+            self.front = self.front.take(kept).concat(added)
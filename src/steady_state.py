@@ -0,0 +1,108 @@
+"""
+Asynchronous steady-state NSGA-II: no generation barrier. Every evaluator
+slot gets a small batch of offspring bred from the current population, and
+each batch is merged into the population and the archive as soon as its
+fitness comes back, while the other slots keep evaluating.
+"""
+import math
+import pickle
+import random
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+from deap import creator
+import fitness
+from main import toolbox, build_evaluator, make_stats, make_logbook, WORKERS
+from selection import ParetoArchive
+from utils import utils_ae
+
+MAX_EMPTY_BREEDS = 100 #CONSECUTIVE BREEDS WITHOUT A SINGLE CHANGED CHILD BEFORE THE RUN STOPS
+
+def breed(pop, n, cx_prob, mutation_prob):
+    """Up to `n` new (unevaluated) offspring; unchanged clones of their parents are dropped"""
+    k = min(len(pop) - len(pop) % 4, 4 * math.ceil(n / 4))
+    offspring = toolbox.select_parents(pop, k)
+    toolbox.mate(offspring, cx_prob)
+    toolbox.mutate(offspring, mutation_prob)
+    return offspring.take(offspring.invalid_indices()[:n])
+
+
+def run_steady_state(evaluator, mu=100, max_evals=25000, cx_prob=0.9, mutation_prob=0.1,
+                     batch_size=None, n_slots=None, seed=None):
+    """
+    Runs until `max_evals` evaluations. `n_slots` batches of `batch_size`
+    offspring are in flight at any time (default: one per pool worker).
+    The logbook gets one record every `mu` evaluations, so it has the same
+    gen/evals/avg/max columns as the generational loop.
+    """
+    if cx_prob <= 0 and mutation_prob <= 0:
+        raise ValueError("cx_prob and mutation_prob are both 0, no offspring would ever differ from its parent")
+    random.seed(seed)
+    np.random.seed(seed)
+    batch_size = batch_size or getattr(evaluator, 'batch_size', 16)
+    n_slots = n_slots or getattr(evaluator, 'n_workers', 1)
+
+    stats = make_stats()
+    logbook = make_logbook()
+    pareto_front = ParetoArchive(creator.Individual)
+
+    pop = toolbox.population(n=mu)
+    evals = len(fitness.fitness_function(pop, evaluator))
+    pop = toolbox.select(pop, mu)
+    pareto_front.update(pop)
+    logbook.record(gen=0, evals=evals, **stats.compile(pop))
+    print(logbook.stream)
+
+    submitted = evals
+    logged = evals
+    running = {}
+    empty = 0
+    with ThreadPoolExecutor(n_slots) as executor:
+        while running or submitted < max_evals:
+            # Refill every free slot with offspring of the population as it is right now
+            while len(running) < n_slots and submitted < max_evals and empty < MAX_EMPTY_BREEDS:
+                batch = breed(pop, min(batch_size, max_evals - submitted), cx_prob, mutation_prob)
+                if len(batch) == 0:
+                    empty += 1
+                    continue
+                empty = 0
+                running[executor.submit(evaluator.evaluate_latents, batch.latents)] = batch
+                submitted += len(batch)
+            if not running:
+                # Only reachable when breeding keeps returning clones
+                print(f"Stopping after {MAX_EMPTY_BREEDS} breeds without a changed child, {evals} evaluations")
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = running.pop(future)
+                batch.fitness[:] = future.result()
+                evals += len(batch)
+                # (mu + batch) reduction: a few rows per arrival, cheap with the O(n log n) 2-D sort
+                pareto_front.update(batch)
+                pop = toolbox.select(pop.concat(batch), mu)
+
+            if evals - logged >= mu:
+                logbook.record(gen=len(logbook), evals=evals - logged, **stats.compile(pop))
+                print(logbook.stream)
+                logged = evals
+
+    return pop, logbook, pareto_front
+
+
+if __name__ == "__main__":
+    evaluator = build_evaluator()
+    pop, logbook, pareto_front = run_steady_state(evaluator, seed=42)
+
+    utils_ae.visualize_results(pareto_front, logbook)
+
+    utils_ae.save_generated_images(pareto_front, evaluator)
+
+    if WORKERS:
+        evaluator.close()
+
+    with open('results/final_results_steady_state.pkl', 'wb') as f:
+        pickle.dump({
+            'population': pop,
+            'logbook': logbook,
+            'pareto_front': pareto_front
+        }, f)
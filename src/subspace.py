@@ -0,0 +1,115 @@
+from pathlib import Path
+import numpy as np
+import torch
+
+CACHE_DIR = Path('../results/model_cache')
+
+def pca_basis(generator, k=40, n_samples=10000, batch_size=1000, seed=0):
+    """
+    Principal directions of W, from `n_samples` z ~ N(0, I) sent through the
+    mapping network. Returns the mean w and the top-k components scaled by
+    their standard deviation, so unit coefficients are one std along each.
+    """
+    rng = torch.Generator().manual_seed(seed)
+    device = next(generator.parameters()).device
+    ws = []
+    with torch.no_grad():
+        for start in range(0, n_samples, batch_size):
+            z = torch.randn(min(batch_size, n_samples - start), generator.z_dim, generator=rng)
+            ws.append(generator.mapping(z.to(device), None)[:, 0].cpu().numpy())
+    ws = np.concatenate(ws).astype(np.float64)
+    mean = ws.mean(axis=0)
+    _, s, vt = np.linalg.svd(ws - mean, full_matrices=False)
+    std = s[:k] / np.sqrt(len(ws) - 1)
+    return mean.astype(np.float32), (vt[:k] * std[:, None]).astype(np.float32)
+
+
+def load_pca_basis(generator, k=40, n_samples=10000, version='', cache_dir=CACHE_DIR):
+    """pca_basis cached on disk, `version` should identify the generator weights"""
+    tag = ''.join(c if c.isalnum() else '_' for c in version)
+    path = Path(cache_dir) / f"pca_{tag}_{k}_{n_samples}.npz"
+    if path.exists():
+        data = np.load(path)
+        return data['mean'], data['basis']
+    mean, basis = pca_basis(generator, k, n_samples)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    np.savez(path, mean=mean, basis=basis)
+    return mean, basis
+
+
+class SubspaceEncoding():
+    """
+    Genome of k PCA coefficients around a starting latent `origin`: the zero
+    genome decodes to `origin` exactly. With per_layer=True each of the
+    num_ws layers of W+ gets its own k coefficients.
+    """
+
+    def __init__(self, basis, origin, num_ws, per_layer=False):
+        self.basis = np.asarray(basis, dtype=np.float32)
+        self.origin = np.asarray(origin, dtype=np.float32).reshape(-1)
+        self.k, self.w_dim = self.basis.shape
+        self.num_ws = num_ws
+        self.per_layer = per_layer
+        if per_layer and len(self.origin) == self.w_dim:
+            self.origin = np.tile(self.origin, num_ws)
+
+    @property
+    def genome_size(self):
+        return self.k * self.num_ws if self.per_layer else self.k
+
+    def decode(self, coefficients):
+        """(n, genome_size) coefficients to (n, latent_dim) latents, one matmul for the batch"""
+        coefficients = np.asarray(coefficients, dtype=np.float32).reshape(len(coefficients), -1)
+        if self.per_layer:
+            offsets = coefficients.reshape(-1, self.num_ws, self.k) @ self.basis
+            return self.origin + offsets.reshape(len(coefficients), -1)
+        offsets = coefficients @ self.basis
+        if len(self.origin) != self.w_dim:
+            # W+ origin, the same offset moves every layer
+            offsets = np.tile(offsets, self.num_ws)
+        return self.origin + offsets
+
+    def encode(self, latents):
+        """Least-squares coefficients of latents relative to the origin"""
+        delta = np.asarray(latents, dtype=np.float32).reshape(len(latents), -1) - self.origin
+        pinv = np.linalg.pinv(self.basis)
+        if self.per_layer:
+            return (delta.reshape(-1, self.num_ws, self.w_dim) @ pinv).reshape(len(latents), -1)
+        if len(self.origin) != self.w_dim:
+            delta = delta.reshape(-1, self.num_ws, self.w_dim).mean(axis=1)
+        return delta @ pinv
+
+
+class SubspaceEvaluator():
+    """Decodes coefficient genomes to latents right before handing them to the wrapped evaluator"""
+
+    def __init__(self, evaluator, encoding):
+        self.evaluator = evaluator
+        self.encoding = encoding
+
+    def __getattr__(self, name):
+        return getattr(self.evaluator, name)
+
+    def set_resolution(self, resolution):
+        self.evaluator.set_resolution(resolution)
+
+    def evaluate_latents(self, coefficients, targets=None, target_classes=None):
+        return self.evaluator.evaluate_latents(self.encoding.decode(coefficients), targets, target_classes)
+
+    def generate(self, coefficients):
+        return self.evaluator.generate(self.encoding.decode(np.asarray(coefficients).reshape(1, -1))[0])
+
+    def generate_batch(self, coefficients):
+        return self.evaluator.generate_batch(self.encoding.decode(coefficients))
+
+    def teacher_probabilities(self, coefficients):
+        return self.evaluator.teacher_probabilities(self.encoding.decode(coefficients))
+
+    def __call__(self, individuals):
+        individuals = list(individuals)
+        if not individuals:
+            return []
+        fits = [tuple(fit) for fit in self.evaluate_latents(np.asarray(individuals, dtype=np.float32))]
+        for ind, fit in zip(individuals, fits):
+            ind.fitness.values = fit
+        return fits
@@ -0,0 +1,103 @@
+import math
+import numpy as np
+from selection import nsga2_indices
+
+class Surrogate():
+    """
+    Cheap regressor of (f1, f2) from the latent, fitted on every latent the
+    real evaluator has scored so far (capped to the `max_points` most recent).
+    kind='ridge' is a linear ridge regression solved in its dual form (the
+    latent is much wider than the archive), kind='knn' averages the k
+    nearest evaluated latents. Both report an uncertainty per prediction.
+    """
+
+    def __init__(self, kind='ridge', alpha=1.0, k=5, max_points=1000, min_points=200):
+        if kind not in ('ridge', 'knn'):
+            raise ValueError(f"unknown surrogate kind {kind!r}")
+        self.kind = kind
+        self.alpha = alpha
+        self.k = k
+        self.max_points = max_points
+        self.min_points = min_points
+        self.X = None
+        self.Y = None
+        self.errors = []
+
+    @property
+    def ready(self):
+        return self.X is not None and len(self.X) >= self.min_points
+
+    def add(self, latents, fits):
+        latents = np.asarray(latents, dtype=np.float32)
+        fits = np.asarray(fits, dtype=np.float64)
+        if self.X is None:
+            self.X, self.Y = latents, fits
+        else:
+            self.X = np.concatenate([self.X, latents])[-self.max_points:]
+            self.Y = np.concatenate([self.Y, fits])[-self.max_points:]
+        self.fit()
+
+    def fit(self):
+        self.x_mean = self.X.mean(axis=0)
+        self.y_mean = self.Y.mean(axis=0)
+        Xc = (self.X - self.x_mean).astype(np.float64)
+        self.sq_norms = (Xc ** 2).sum(axis=1)
+        if self.kind == 'ridge':
+            K = Xc @ Xc.T
+            K[np.diag_indices_from(K)] += self.alpha
+            self.dual = np.linalg.solve(K, self.Y - self.y_mean)
+        # Typical distance to the nearest evaluated neighbour, scales the uncertainty
+        d = self.distances(self.X)
+        np.fill_diagonal(d, np.inf)
+        self.scale = max(float(np.median(d.min(axis=1))), 1e-12) if len(self.X) > 1 else 1.0
+
+    def distances(self, latents):
+        Q = (np.asarray(latents, dtype=np.float32) - self.x_mean).astype(np.float64)
+        Xc = (self.X - self.x_mean).astype(np.float64)
+        d2 = (Q ** 2).sum(axis=1)[:, None] + self.sq_norms[None, :] - 2 * Q @ Xc.T
+        return np.sqrt(np.maximum(d2, 0))
+
+    def predict(self, latents):
+        """(predicted fitness (n, 2), uncertainty (n,))"""
+        d = self.distances(latents)
+        nearest = np.argsort(d, axis=1)[:, :self.k]
+        if self.kind == 'ridge':
+            Q = (np.asarray(latents, dtype=np.float32) - self.x_mean).astype(np.float64)
+            Xc = (self.X - self.x_mean).astype(np.float64)
+            pred = self.y_mean + (Q @ Xc.T) @ self.dual
+            uncertainty = d.min(axis=1) / self.scale
+        else:
+            pred = self.Y[nearest].mean(axis=1)
+            uncertainty = self.Y[nearest].std(axis=1).mean(axis=1) + d.min(axis=1) / self.scale
+        return pred, uncertainty
+
+    def record_error(self, predicted, fits):
+        self.errors.append(float(np.abs(np.asarray(predicted) - np.asarray(fits)).mean()))
+        return self.errors[-1]
+
+
+def screen_offspring(toolbox, pop, surrogate, pool_factor, n_eval, cx_prob, mutation_prob, explore=0.25):
+    """
+    Breeds `pool_factor` times the usual offspring, predicts them with the
+    surrogate and keeps `n_eval` of them: the best under NSGA-II on the
+    predicted fitness plus an `explore` share of the most uncertain ones.
+    Returns the kept offspring, their predictions and the pool size.
+    """
+    rounds = max(1, math.ceil(pool_factor))
+    pool = toolbox.select_parents(pop, len(pop))
+    for _ in range(rounds - 1):
+        pool = pool.concat(toolbox.select_parents(pop, len(pop)))
+    toolbox.mate(pool, cx_prob)
+    toolbox.mutate(pool, mutation_prob)
+
+    candidates = pool.invalid_indices()
+    if len(candidates) <= n_eval:
+        return pool.take(candidates), None, len(candidates)
+
+    pred, uncertainty = surrogate.predict(pool.latents[candidates])
+    n_explore = int(round(explore * n_eval))
+    exploit, _ = nsga2_indices(pred, n_eval - n_explore)
+    rest = np.setdiff1d(np.arange(len(candidates)), exploit)
+    explore_rows = rest[np.argsort(-uncertainty[rest], kind='stable')[:n_explore]]
+    chosen = np.concatenate([exploit, explore_rows])
+    return pool.take(candidates[chosen]), pred[chosen], len(candidates)
@@ -0,0 +1,142 @@
+import cProfile
+import functools
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+import torch
+
+#STAGES RECORDED AS LOGBOOK COLUMNS, IN HEADER ORDER
+STAGES = ('selection', 'clone', 'crossover', 'mutation', 'synthesis', 'embedding', 'classification', 'archive')
+
+#ACCUMULATED SINCE THE LAST take(), PER PROCESS
+_times = defaultdict(float)
+_counts = defaultdict(int)
+_local = threading.local() #NESTING STACK, ONE PER THREAD
+_state = {'sync': None, 'record_function': False}
+
+def set_sync(sync):
+    """Callable run before reading the clock, e.g. torch.cuda.synchronize so GPU work lands in its own stage"""
+    _state['sync'] = sync
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+@contextmanager
+def section(name):
+    """
+    Adds the wall time of the block to stage `name`. Times are exclusive:
+    a section nested in another one (clone inside selection) is only
+    counted in the inner stage.
+    """
+    if _state['sync'] is not None:
+        _state['sync']()
+    stack = _stack()
+    frame = [time.perf_counter(), 0.0]
+    stack.append(frame)
+    label = torch.profiler.record_function(name) if _state['record_function'] else nullcontext()
+    try:
+        with label:
+            yield
+    finally:
+        if _state['sync'] is not None:
+            _state['sync']()
+        stack.pop()
+        elapsed = time.perf_counter() - frame[0]
+        _times[name] += elapsed - frame[1]
+        if stack:
+            stack[-1][1] += elapsed
+
+
+def timed(name):
+    """Decorator form of section()"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with section(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, n=1):
+    _counts[name] += n
+
+
+def add(times=None, counts=None):
+    """Merges what another process recorded (worker times add up, they are not wall time)"""
+    for name, seconds in (times or {}).items():
+        _times[name] += seconds
+    for name, n in (counts or {}).items():
+        _counts[name] += n
+
+
+def take():
+    """(times, counts) recorded since the previous call, and resets both"""
+    times, counts = dict(_times), dict(_counts)
+    _times.clear()
+    _counts.clear()
+    return times, counts
+
+
+def columns(stages=STAGES, counters=('cache_hits',)):
+    """take() as logbook columns: seconds per stage rounded to 0.1 ms, plus the counters"""
+    times, counts = take()
+    record = {name: round(times.get(name, 0.0), 4) for name in stages}
+    record.update({name: counts.get(name, 0) for name in counters})
+    return record
+
+
+class Profiler():
+    """
+    Captures generations `start` to `stop` (inclusive) with torch.profiler
+    (kind='torch', Chrome trace plus an operator table) or cProfile
+    (kind='cprofile', a .prof file for snakeviz/pstats).
+    """
+
+    def __init__(self, kind, start, stop, output_dir='../results/profile'):
+        if kind not in ('torch', 'cprofile'):
+            raise ValueError(f"unknown profiler {kind!r}")
+        self.kind = kind
+        self.start = start
+        self.stop = stop
+        self.output_dir = Path(output_dir)
+        self.profiler = None
+
+    def step(self, gen):
+        """Called at the start of every generation"""
+        if gen == self.start and self.profiler is None:
+            if self.kind == 'torch':
+                activities = [torch.profiler.ProfilerActivity.CPU]
+                if torch.cuda.is_available():
+                    activities.append(torch.profiler.ProfilerActivity.CUDA)
+                self.profiler = torch.profiler.profile(activities=activities)
+                _state['record_function'] = True
+                self.profiler.__enter__()
+            else:
+                self.profiler = cProfile.Profile()
+                self.profiler.enable()
+        elif gen == self.stop + 1:
+            self.close()
+
+    def close(self):
+        if self.profiler is None:
+            return
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        name = f"gen_{self.start}_{self.stop}"
+        if self.kind == 'torch':
+            self.profiler.__exit__(None, None, None)
+            _state['record_function'] = False
+            self.profiler.export_chrome_trace(str(self.output_dir / f"{name}.json"))
+            table = self.profiler.key_averages().table(sort_by='self_cpu_time_total', row_limit=40)
+            (self.output_dir / f"{name}.txt").write_text(table)
+        else:
+            self.profiler.disable()
+            self.profiler.dump_stats(str(self.output_dir / f"{name}.prof"))
+        print(f"Profile of generations {self.start}-{self.stop} written to {self.output_dir}")
+        self.profiler = None
@@ -0,0 +1,155 @@
+# banco_latentes.py - Latentes W/W+ de las fotos reales, invertidos una vez y guardados en un .npy mapeado
+import json
+from pathlib import Path
+import numpy as np
+
+SALIDA = Path('../data/banco_latentes')
+
+def _caras(imagenes, mtcnn, batch_size, n_threads):
+    """(row, cara) de cada imagen; se decodifica y recorta por bloques, el siguiente en paralelo"""
+    from concurrent.futures import ThreadPoolExecutor
+    from utils.embeddings_referencia import _leer, _recortar
+
+    bloques = [list(range(i, min(i + batch_size, len(imagenes)))) for i in range(0, len(imagenes), batch_size)]
+    with ThreadPoolExecutor(n_threads) as pool:
+        futuros = [pool.submit(_leer, imagenes[row][2]) for row in bloques[0]] if bloques else []
+        for i, bloque in enumerate(bloques):
+            fotos = [futuro.result() for futuro in futuros]
+            if i + 1 < len(bloques):
+                futuros = [pool.submit(_leer, imagenes[row][2]) for row in bloques[i + 1]]
+            yield from zip(bloque, _recortar(fotos, mtcnn))
+
+
+def construir_banco(carpetas=None, salida=SALIDA, space='w', batch_size=16, n_threads=8, device=None, **opciones):
+    """
+    Invierte las fotos de referencia y escribe latents.npy (una fila por
+    imagen), means.npy (latente medio por persona) e index.json. Solo se
+    invierten las imágenes nuevas o cambiadas; si cambia el modelo o la
+    configuración de la inversión se recalcula todo.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from facenet_pytorch import MTCNN
+    import fitness
+    from alignment import FFHQ_FACE_BOX
+    from fitness_cache import model_version
+    from inversion import Inverter
+    from utils import cargar_modelo
+    from utils.embeddings_referencia import CARPETAS, listar_imagenes, _hash
+
+    salida = Path(salida)
+    salida.mkdir(parents=True, exist_ok=True)
+    imagenes = listar_imagenes(carpetas or CARPETAS)
+    print(f"📊 {len(imagenes):,} imágenes de referencia")
+    if not imagenes:
+        print(f"❌ No se encontraron carpetas person_* en {carpetas or CARPETAS}")
+        return None
+
+    device = device or cargar_modelo.default_device()
+    generator = cargar_modelo.cargar_generador(device)
+    evaluator = fitness.BatchEvaluator(generator, cargar_modelo.cargar_embedder(device), None,
+                                       batch_size=batch_size, device=device,
+                                       face_box=opciones.pop('face_box', FFHQ_FACE_BOX))
+    inverter = Inverter(evaluator, space, **opciones)
+    config = dict(inverter.config(), model=model_version(cargar_modelo.PKL_PATH))
+
+    with ThreadPoolExecutor(n_threads) as pool:
+        hashes = list(pool.map(_hash, [path for _, _, path in imagenes]))
+
+    anterior = {}
+    index_file = salida / 'index.json'
+    if index_file.exists() and (salida / 'latents.npy').exists():
+        old_index = json.loads(index_file.read_text())
+        if old_index['config'] == json.loads(json.dumps(config)):
+            old_latents = np.load(salida / 'latents.npy', mmap_mode='r')
+            anterior = {img['sha1']: (old_latents[img['row']], img['loss'], img['steps'])
+                        for img in old_index['images']}
+        else:
+            print("   ✓ Cambió el modelo o la configuración, se invierte todo de nuevo")
+
+    nuevas = [i for i, h in enumerate(hashes) if h not in anterior]
+    print(f"   ✓ {len(imagenes) - len(nuevas):,} sin cambios, {len(nuevas):,} a invertir ({space})")
+    calculadas = {}
+    if nuevas:
+        mtcnn = MTCNN(image_size=160, margin=0, device=device)
+        caras = ((nuevas[row], cara) for row, cara in _caras([imagenes[i] for i in nuevas], mtcnn,
+                                                                batch_size, n_threads))
+        for row, latent, loss, steps in inverter.invert(caras):
+            calculadas[row] = (latent, loss, steps)
+            if len(calculadas) % 50 == 0:
+                print(f"   ✓ {len(calculadas):,}/{len(nuevas):,} invertidas")
+
+    resultados = [calculadas[i] if i in calculadas else anterior[h] for i, h in enumerate(hashes)]
+    dim = len(resultados[0][0])
+    tmp = salida / 'latents.tmp.npy'
+    latents = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=(len(imagenes), dim))
+    for i, (latent, _, _) in enumerate(resultados):
+        latents[i] = latent
+    latents.flush()
+    del latents, anterior
+    tmp.replace(salida / 'latents.npy')
+    latents = np.load(salida / 'latents.npy', mmap_mode='r')
+
+    personas = {}
+    for row, (person_id, gender, _) in enumerate(imagenes):
+        personas.setdefault(person_id, {'gender': gender, 'rows': []})['rows'].append(row)
+
+    # El promedio en W sigue siendo una cara de la persona, es el punto de partida de la evolución
+    means = np.zeros((len(personas), dim), dtype=np.float32)
+    for mean_row, (person_id, persona) in enumerate(personas.items()):
+        means[mean_row] = latents[persona['rows']].mean(axis=0)
+        persona['mean_row'] = mean_row
+    tmp = salida / 'means.tmp.npy'
+    np.save(tmp, means)
+    tmp.replace(salida / 'means.npy')
+
+    index = {
+        'config': config,
+        'images': [{'person': person_id, 'gender': gender, 'image': path.name, 'path': str(path),
+                    'sha1': h, 'row': row, 'loss': loss, 'steps': steps}
+                   for row, ((person_id, gender, path), h, (_, loss, steps))
+                   in enumerate(zip(imagenes, hashes, resultados))],
+        'persons': {str(person_id): persona for person_id, persona in personas.items()},
+    }
+    tmp = salida / 'index.tmp.json'
+    tmp.write_text(json.dumps(index, indent=1))
+    tmp.replace(index_file)
+
+    print(f"\n✅ Banco de latentes en: {salida.absolute()} ({len(personas)} personas, dim {dim})")
+    return salida
+
+
+class LatentBank():
+    """
+    Read-only access to the bank, the matrices are memory-mapped. Row n of
+    `means` is the starting latent of the n-th person of the index.
+    """
+
+    def __init__(self, path=SALIDA):
+        path = Path(path)
+        self.index = json.loads((path / 'index.json').read_text())
+        self.latents = np.load(path / 'latents.npy', mmap_mode='r')
+        self.means = np.load(path / 'means.npy', mmap_mode='r')
+
+    @staticmethod
+    def exists(path=SALIDA):
+        path = Path(path)
+        return all((path / name).exists() for name in ('index.json', 'latents.npy', 'means.npy'))
+
+    def __len__(self):
+        return len(self.means)
+
+    def persons(self):
+        return [int(person_id) for person_id in self.index['persons']]
+
+    def gender(self, person_id):
+        return self.index['persons'][str(person_id)]['gender']
+
+    def person_latent(self, person_id):
+        return np.array(self.means[self.index['persons'][str(person_id)]['mean_row']])
+
+    def image_latents(self, person_id):
+        return np.array(self.latents[self.index['persons'][str(person_id)]['rows']])
+
+
+if __name__ == "__main__":
+    construir_banco()
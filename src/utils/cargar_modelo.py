@@ -1,15 +1,133 @@
-import torch
 import pickle
-from torchvision.utils import save_image
+from pathlib import Path
+import torch
+
+URL = "https://nvlabs-fi-cdn.nvidia.com/stylegan2-ada-pytorch/pretrained/ffhq.pkl"
+
+#PATHS ARE RELATIVE TO src/, LIKE THE REST OF THE PROJECT
+PKL_PATH = Path('../ffhq.pkl')
+CACHE_DIR = Path('../results/model_cache')
+FACENET_PATH = Path('../facenet_vggface2.pt')
+CLASSIFIER_NAME = 'resnet18'
+CLASSIFIER_PATH = Path('../gender_classifier.pth')
+
+#LOADED MODELS, ONE ENTRY PER (NAME, DEVICE)
+_models = {}
+
+def default_device():
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def descargar_pesos(path=PKL_PATH):
+    """Explicit download of ffhq.pkl, never called implicitly"""
+    torch.hub.download_url_to_file(URL, str(path), progress=True)
+
+
+def descargar_facenet(path=FACENET_PATH):
+    """Explicit download of the VGGFace2 FaceNet weights into `path`, never called implicitly"""
+    from facenet_pytorch import InceptionResnetV1
+    state = InceptionResnetV1(pretrained='vggface2', classify=False).state_dict()
+    # The pretrained model keeps its VGGFace2 logits layer, the embedder loaded by cargar_embedder has none
+    torch.save({k: v for k, v in state.items() if not k.startswith('logits.')}, path)
+
+
+def _cache_paths(pkl_path, cache_dir):
+    stat = Path(pkl_path).stat()
+    tag = f"{Path(pkl_path).stem}_{stat.st_size}_{stat.st_mtime_ns}"
+    return Path(cache_dir) / f"{tag}.skeleton.pkl", Path(cache_dir) / f"{tag}.weights.pt"
+
+
+def convertir_pesos(pkl_path=PKL_PATH, cache_dir=CACHE_DIR):
+    """
+    Splits G_ema from the network pickle into a weightless skeleton (the
+    module on the meta device) and a flat tensor file that torch.load can
+    memory-map. Only done once per pickle, later loads skip the unpickling.
+    """
+    skeleton_path, weights_path = _cache_paths(pkl_path, cache_dir)
+    if skeleton_path.exists() and weights_path.exists():
+        return skeleton_path, weights_path
+    if not Path(pkl_path).exists():
+        raise FileNotFoundError(f"{pkl_path} not found, download it with descargar_pesos()")
+
+    with open(pkl_path, 'rb') as f:
+        G = pickle.load(f)['G_ema']
+    tensors = {name: t.detach().contiguous() for name, t in
+               list(G.named_parameters()) + list(G.named_buffers())}
+
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    tmp = weights_path.with_suffix('.tmp')
+    torch.save(tensors, tmp)
+    tmp.replace(weights_path)
+    tmp = skeleton_path.with_suffix('.tmp')
+    with open(tmp, 'wb') as f:
+        pickle.dump(G.to('meta'), f)
+    tmp.replace(skeleton_path)
+    return skeleton_path, weights_path
+
+
+def _asignar(module, tensors):
+    # Put the (memory-mapped) tensors in place of the meta ones without copying them
+    for name, tensor in tensors.items():
+        owner_name, _, attr = name.rpartition('.')
+        owner = module.get_submodule(owner_name)
+        if attr in owner._parameters:
+            owner._parameters[attr] = torch.nn.Parameter(tensor, requires_grad=False)
+        else:
+            owner._buffers[attr] = tensor
+
+
+def cargar_generador(device=None, pkl_path=PKL_PATH, cache_dir=CACHE_DIR):
+    """G_ema, loaded on first use. On CPU the weights stay memory-mapped and
+    their pages are shared by every process that loads the same cache."""
+    device = device or default_device()
+    key = ('generator', str(device))
+    if key not in _models:
+        skeleton_path, weights_path = convertir_pesos(pkl_path, cache_dir)
+        with open(skeleton_path, 'rb') as f:
+            G = pickle.load(f)
+        _asignar(G, torch.load(weights_path, mmap=True, weights_only=True))
+        _models[key] = G.to(device).eval().requires_grad_(False)
+    return _models[key]
+
+
+def cargar_embedder(device=None, path=FACENET_PATH):
+    device = device or default_device()
+    key = ('embedder', str(device))
+    if key not in _models:
+        from facenet_pytorch import InceptionResnetV1
+        if not Path(path).exists():
+            raise FileNotFoundError(f"{path} not found, download it with descargar_facenet()")
+        embedder = InceptionResnetV1(pretrained=None, classify=False)
+        embedder.load_state_dict(torch.load(path, mmap=True, weights_only=True))
+        _models[key] = embedder.to(device).eval().requires_grad_(False)
+    return _models[key]
+
+
+def cargar_clasificador(device=None, name=CLASSIFIER_NAME, path=CLASSIFIER_PATH):
+    device = device or default_device()
+    key = ('classifier', str(device))
+    if key not in _models:
+        if not Path(path).exists():
+            # No public checkpoint: it is trained locally, nothing downloads it
+            raise FileNotFoundError(f"{path} not found, it must hold the state_dict of a timm '{name}' "
+                                    f"with 2 classes (male, female) fine-tuned on CelebA")
+        import timm
+        classifier = timm.create_model(name, pretrained=False, num_classes=2)
+        classifier.load_state_dict(torch.load(path, mmap=True, weights_only=True))
+        _models[key] = classifier.to(device).eval().requires_grad_(False)
+    return _models[key]
+
 
-url = "https://nvlabs-fi-cdn.nvidia.com/stylegan2-ada-pytorch/pretrained/ffhq.pkl"
-with open("ffhq.pkl", "wb") as f:
-    f.write(torch.hub.load_state_dict_from_url(url, progress=True))
+def cargar_modelos(device=None):
+    """(generator, embedder, classifier) on `device`, defaulting to CUDA when available"""
+    return cargar_generador(device), cargar_embedder(device), cargar_clasificador(device)
 
 
-with open("ffhq.pkl", "rb") as f:
-    G = pickle.load(f)['G_ema'].cuda()  
+if __name__ == "__main__":
+    from torchvision.utils import save_image
 
-z = torch.randn(1, G.z_dim).cuda()
-img = G(z, None)
-save_image((img + 1) / 2, 'face.png') 
\ No newline at end of file
+    G = cargar_generador()
+    z = torch.randn(1, G.z_dim, device=default_device())
+    with torch.no_grad():
+        img = G(z, None)
+    save_image((img + 1) / 2, 'face.png')
@@ -1,9 +1,11 @@
 import pandas as pd
 import numpy as np
 from pathlib import Path
-import shutil
-from PIL import Image
-import matplotlib.pyplot as plt
+try:
+    from utils.vista_previa import Miniaturas, enlazar, escribir_paginas, html_persona
+except ImportError:
+    # Ejecutado como python utils/descargar_imagenes.py
+    from vista_previa import Miniaturas, enlazar, escribir_paginas, html_persona
 
 def descargar_y_preparar_dataset():
     print("Descargando dataset")
@@ -62,7 +64,7 @@ def descargar_y_preparar_dataset():
             src = img_path / img_name
             dst = person_folder / img_name
             if src.exists():
-                shutil.copy(src, dst)
+                enlazar(src, dst)
                 total_images += 1
     
     print(f"\nCompletado")
@@ -72,23 +74,21 @@ def descargar_y_preparar_dataset():
     
     return output_path
 
-def preview_dataset(dataset_path, n_preview=3):
-    """Muestra preview de las imágenes"""
-    person_folders = sorted(list(Path(dataset_path).glob('person_*')))[:n_preview]
+def preview_dataset(dataset_path, n_preview=None):
+    """Preview de las imágenes: miniaturas y hoja de contacto por persona en preview.html (paginado)"""
+    dataset_path = Path(dataset_path)
+    person_folders = sorted(list(dataset_path.glob('person_*')))[:n_preview]
+    carpetas = {folder.name: sorted(folder.glob('*.jpg')) for folder in person_folders}
     
-    for person_folder in person_folders:
-        images = list(person_folder.glob('*.jpg'))[:5]
-        
-        fig, axes = plt.subplots(1, len(images), figsize=(15, 3))
-        fig.suptitle(person_folder.name, fontsize=14)
-        
-        for ax, img_path in zip(axes, images):
-            img = Image.open(img_path)
-            ax.imshow(img)
-            ax.axis('off')
-        
-        plt.tight_layout()
-        plt.show()
+    miniaturas = Miniaturas()
+    thumbs = miniaturas.construir([img for imagenes in carpetas.values() for img in imagenes])
+    hojas = miniaturas.hojas(carpetas, thumbs)
+    
+    bloques = [('', html_persona(dataset_path, imagenes, thumbs, hojas[nombre], nombre, nombre.rsplit('_', 1)[-1]))
+               for nombre, imagenes in carpetas.items() if imagenes]
+    html_file = escribir_paginas(dataset_path, 'preview', f'Preview - {dataset_path.name}', bloques)
+    print(f"   xdg-open {html_file.absolute()}")
+    return html_file
 
 if __name__ == "__main__":
     dataset_path = descargar_y_preparar_dataset()
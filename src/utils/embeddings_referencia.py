@@ -0,0 +1,165 @@
+# embeddings_referencia.py - Embeddings FaceNet de las fotos reales de cada persona
+import hashlib
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+import torch
+from PIL import Image
+
+CARPETAS = ['../data/dataset_final', '../data/conjunto_extra_grande']
+SALIDA = Path('../data/embeddings_referencia')
+PERSON_RE = re.compile(r'person_(\d+)_(male|female)$')
+
+def _hash(path):
+    return hashlib.sha1(Path(path).read_bytes()).hexdigest()
+
+
+def _leer(path):
+    with Image.open(path) as img:
+        return img.convert('RGB')
+
+
+def listar_imagenes(carpetas=CARPETAS):
+    """(person_id, gender, path) de cada jpg dentro de carpetas person_XXXX_gender"""
+    imagenes = []
+    for carpeta in carpetas:
+        for person_folder in sorted(Path(carpeta).glob('person_*')):
+            match = PERSON_RE.match(person_folder.name)
+            if match is None:
+                continue
+            for img_path in sorted(person_folder.glob('*.jpg')):
+                imagenes.append((int(match.group(1)), match.group(2), img_path))
+    return imagenes
+
+
+def _recortar(imagenes, mtcnn):
+    # MTCNN devuelve la cara ya estandarizada; si no detecta nada usamos un recorte central
+    if len({img.size for img in imagenes}) == 1:
+        caras = mtcnn(imagenes)
+    else:
+        caras = [mtcnn(img) for img in imagenes]
+    out = []
+    for img, cara in zip(imagenes, caras):
+        if cara is None:
+            side = min(img.size)
+            left, top = (img.width - side) // 2, (img.height - side) // 2
+            img = img.crop((left, top, left + side, top + side)).resize((160, 160), Image.BILINEAR)
+            cara = (torch.from_numpy(np.asarray(img, dtype=np.float32)).permute(2, 0, 1) - 127.5) / 128.0
+        out.append(cara)
+    return torch.stack(out)
+
+
+def calcular_embeddings(paths, batch_size=32, n_threads=8, device=None):
+    """Decodifica en paralelo y calcula los embeddings por lotes, (n, 512) float32"""
+    from facenet_pytorch import MTCNN
+    from utils import cargar_modelo
+
+    device = device or cargar_modelo.default_device()
+    embedder = cargar_modelo.cargar_embedder(device)
+    mtcnn = MTCNN(image_size=160, margin=0, device=device)
+
+    embeddings = np.empty((len(paths), 512), dtype=np.float32)
+    bloques = [paths[i:i + batch_size] for i in range(0, len(paths), batch_size)]
+    with ThreadPoolExecutor(n_threads) as pool:
+        # Decodificamos el bloque siguiente mientras se procesa el actual
+        futuros = [pool.submit(_leer, path) for path in bloques[0]] if bloques else []
+        for i, bloque in enumerate(bloques):
+            imagenes = [futuro.result() for futuro in futuros]
+            if i + 1 < len(bloques):
+                futuros = [pool.submit(_leer, path) for path in bloques[i + 1]]
+            with torch.no_grad():
+                emb = embedder(_recortar(imagenes, mtcnn).to(device))
+            emb = torch.nn.functional.normalize(emb, dim=1)
+            embeddings[i * batch_size:i * batch_size + len(bloque)] = emb.cpu().numpy()
+    return embeddings
+
+
+def construir_store(carpetas=CARPETAS, salida=SALIDA, batch_size=32, n_threads=8, device=None):
+    """
+    Escribe embeddings.npy (una fila por imagen), means.npy (vector de
+    identidad medio por persona) e index.json. Solo se recalculan las
+    imágenes cuyo hash cambió respecto al store anterior.
+    """
+    salida = Path(salida)
+    salida.mkdir(parents=True, exist_ok=True)
+    imagenes = listar_imagenes(carpetas)
+    print(f"📊 {len(imagenes):,} imágenes de referencia")
+    if not imagenes:
+        print(f"❌ No se encontraron carpetas person_* en {carpetas}")
+        return None
+
+    with ThreadPoolExecutor(n_threads) as pool:
+        hashes = list(pool.map(_hash, [path for _, _, path in imagenes]))
+
+    anterior = {}
+    index_file = salida / 'index.json'
+    if index_file.exists() and (salida / 'embeddings.npy').exists():
+        old_index = json.loads(index_file.read_text())
+        old_embeddings = np.load(salida / 'embeddings.npy', mmap_mode='r')
+        anterior = {img['sha1']: old_embeddings[img['row']] for img in old_index['images']}
+
+    nuevas = [i for i, h in enumerate(hashes) if h not in anterior]
+    print(f"   ✓ {len(imagenes) - len(nuevas):,} sin cambios, {len(nuevas):,} a calcular")
+    calculadas = calcular_embeddings([imagenes[i][2] for i in nuevas], batch_size, n_threads, device) if nuevas else []
+    calculadas = dict(zip(nuevas, calculadas))
+
+    tmp = salida / 'embeddings.tmp.npy'
+    embeddings = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=(len(imagenes), 512))
+    for i, h in enumerate(hashes):
+        embeddings[i] = calculadas[i] if i in calculadas else anterior[h]
+    embeddings.flush()
+    del embeddings, anterior
+    tmp.replace(salida / 'embeddings.npy')
+    embeddings = np.load(salida / 'embeddings.npy', mmap_mode='r')
+
+    personas = {}
+    for row, (person_id, gender, _) in enumerate(imagenes):
+        personas.setdefault(person_id, {'gender': gender, 'rows': []})['rows'].append(row)
+
+    means = np.zeros((len(personas), 512), dtype=np.float32)
+    for mean_row, (person_id, persona) in enumerate(personas.items()):
+        mean = embeddings[persona['rows']].mean(axis=0)
+        means[mean_row] = mean / max(np.linalg.norm(mean), 1e-12)
+        persona['mean_row'] = mean_row
+    np.save(salida / 'means.npy', means)
+
+    index = {
+        'images': [{'person': person_id, 'gender': gender, 'image': path.name, 'path': str(path),
+                    'sha1': h, 'row': row}
+                   for row, ((person_id, gender, path), h) in enumerate(zip(imagenes, hashes))],
+        'persons': {str(person_id): persona for person_id, persona in personas.items()},
+    }
+    tmp = salida / 'index.tmp.json'
+    tmp.write_text(json.dumps(index, indent=1))
+    tmp.replace(index_file)
+
+    print(f"\n✅ Store de referencia en: {salida.absolute()} ({len(personas)} personas)")
+    return salida
+
+
+class ReferenceStore():
+    """Read-only access to the store, the matrices are memory-mapped"""
+
+    def __init__(self, path=SALIDA):
+        path = Path(path)
+        self.index = json.loads((path / 'index.json').read_text())
+        self.embeddings = np.load(path / 'embeddings.npy', mmap_mode='r')
+        self.means = np.load(path / 'means.npy', mmap_mode='r')
+
+    def persons(self):
+        return [int(person_id) for person_id in self.index['persons']]
+
+    def gender(self, person_id):
+        return self.index['persons'][str(person_id)]['gender']
+
+    def mean_embedding(self, person_id):
+        return np.array(self.means[self.index['persons'][str(person_id)]['mean_row']])
+
+    def image_embeddings(self, person_id):
+        return np.array(self.embeddings[self.index['persons'][str(person_id)]['rows']])
+
+
+if __name__ == "__main__":
+    construir_store()
@@ -1,8 +1,13 @@
 # generar_conjuntos_candidatos.py - VERSIÓN FINAL CORREGIDA
-import pandas as pd
 import numpy as np
 from pathlib import Path
-import shutil
+try:
+    from utils.metadatos_celeba import cargar_metadatos
+    from utils.vista_previa import Miniaturas, enlazar, escribir_paginas, html_persona
+except ImportError:
+    # Ejecutado como python utils/generar_conjuntos_candidatos.py
+    from metadatos_celeba import cargar_metadatos
+    from vista_previa import Miniaturas, enlazar, escribir_paginas, html_persona
 
 def generar_conjuntos_candidatos():
     """
@@ -26,10 +31,6 @@ def generar_conjuntos_candidatos():
         print(f"❌ No se encontró: {img_path}")
         return None
     
-    # Contar imágenes
-    n_images = len(list(img_path.glob('*.jpg')))
-    print(f"   ✓ {n_images:,} imágenes encontradas\n")
-    
     # Archivos
     identity_file = base_path / 'identity_CelebA.txt'
     attr_file = celeba_path / 'list_attr_celeba.csv'
@@ -42,44 +43,22 @@ def generar_conjuntos_candidatos():
         print(f"❌ No se encontró: {attr_file}")
         return None
     
+    # Tabla mergeada desde el cache, solo se parsean los CSV si cambiaron
     print(f"📊 Leyendo datos...")
-    identity_df = pd.read_csv(identity_file, sep=' ', header=None, names=['image', 'identity'])
-    attr_df = pd.read_csv(attr_file)
-    
-    print(f"   ✓ {len(identity_df):,} registros de identidad")
-    print(f"   ✓ {len(attr_df):,} registros de atributos")
+    metadatos = cargar_metadatos(identity_file, attr_file)
+    print(f"   ✓ {len(metadatos):,} registros después del merge")
     
-    # Merge
-    df = identity_df.merge(attr_df, left_on='image', right_on='image_id', how='inner')
-    print(f"   ✓ {len(df):,} registros después del merge")
-    
-    # Filtrar personas con 4-8 imágenes
+    # Filtrar personas con 4-8 imágenes y por calidad
     print(f"\n🔍 Filtrando personas...")
-    identity_counts = df['identity'].value_counts()
-    valid_identities = identity_counts[(identity_counts >= 4) & (identity_counts <= 8)].index
-    df_filtered = df[df['identity'].isin(valid_identities)]
-    
-    print(f"   ✓ {len(valid_identities):,} personas con 4-8 imágenes")
+    print(f"   ✓ {int(((metadatos.conteo >= 4) & (metadatos.conteo <= 8)).sum()):,} personas con 4-8 imágenes")
     
-    # Filtrar por calidad
     print(f"\n✨ Aplicando filtros de calidad...")
-    quality_filter = (
-        (df_filtered['Eyeglasses'] == -1) &
-        (df_filtered['Wearing_Hat'] == -1) &
-        (df_filtered['Blurry'] == -1)
-    )
-    
-    df_quality = df_filtered[quality_filter]
-    
-    quality_identity_counts = df_quality['identity'].value_counts()
-    final_valid_identities = quality_identity_counts[quality_identity_counts >= 4].index
-    df_final = df_quality[df_quality['identity'].isin(final_valid_identities)]
-    
-    print(f"   ✓ {len(final_valid_identities):,} personas después de filtros")
+    seleccion = metadatos.seleccion()
+    print(f"   ✓ {len(np.unique(metadatos.identity[seleccion])):,} personas después de filtros")
     
     # Separar por género
-    male_ids = df_final[df_final['Male'] == 1]['identity'].unique()
-    female_ids = df_final[df_final['Male'] == -1]['identity'].unique()
+    male_ids = metadatos.personas(seleccion, 1)
+    female_ids = metadatos.personas(seleccion, -1)
     
     print(f"   ✓ Hombres: {len(male_ids):,}, Mujeres: {len(female_ids):,}")
     
@@ -114,10 +93,8 @@ def generar_conjuntos_candidatos():
         total_images = 0
         
         for identity_id in selected_identities:
-            person_data = df_final[df_final['identity'] == identity_id]
-            person_images = person_data['image'].tolist()
-            person_gender = person_data['Male'].iloc[0]
-            gender_label = 'male' if person_gender == 1 else 'female'
+            person_images = metadatos.imagenes(identity_id, seleccion)
+            gender_label = metadatos.genero(identity_id, seleccion)
             
             person_folder = conjunto_folder / f'person_{identity_id:04d}_{gender_label}'
             person_folder.mkdir(exist_ok=True)
@@ -128,7 +105,8 @@ def generar_conjuntos_candidatos():
                 dst = person_folder / img_name
                 
                 if src.exists():
-                    shutil.copy(src, dst)
+                    # Hardlink: mismo archivo que el de CelebA, sin copiar bytes
+                    enlazar(src, dst)
                     copied += 1
             
             total_images += copied
@@ -153,39 +131,28 @@ def generar_conjuntos_candidatos():
     
     return output_base
 
-def crear_resumen_html(output_path, conjuntos_info):
-    """Crea un HTML para visualizar todos los conjuntos"""
-    
-    html = """<!DOCTYPE html>
-<html>
-<head>
-    <title>Conjuntos Candidatos - CelebA</title>
-    <meta charset="UTF-8">
-    <style>
-        body { font-family: Arial, sans-serif; margin: 20px; background-color: #f5f5f5; }
-        h1 { color: #333; text-align: center; }
-        .conjunto { background: white; margin: 20px 0; padding: 20px; border-radius: 10px; box-shadow: 0 2px 5px rgba(0,0,0,0.1); }
-        .conjunto h2 { color: #333; border-bottom: 2px solid #4CAF50; padding-bottom: 10px; }
-        .persona { margin: 20px 0; padding: 15px; background: #fafafa; border-left: 4px solid #2196F3; }
-        .persona.male { border-left-color: #2196F3; }
-        .persona.female { border-left-color: #E91E63; }
-        .images { display: flex; flex-wrap: wrap; gap: 10px; margin-top: 10px; }
-        .images img { width: 150px; height: 150px; object-fit: cover; border: 2px solid #ddd; border-radius: 5px; transition: transform 0.2s; cursor: pointer; }
-        .images img:hover { transform: scale(2); z-index: 1000; box-shadow: 0 4px 8px rgba(0,0,0,0.3); }
-        .stats { display: inline-block; background: #e3f2fd; padding: 5px 15px; border-radius: 20px; margin: 5px; font-size: 14px; }
-        .gender-male { color: #1976D2; font-weight: bold; }
-        .gender-female { color: #C2185B; font-weight: bold; }
-        .instrucciones { margin-top: 40px; padding: 20px; background: #fff3cd; border-radius: 10px; border-left: 5px solid #ffc107; }
-    </style>
-</head>
-<body>
-    <h1>🎭 Conjuntos Candidatos para Selección Manual</h1>
-    <p style="text-align: center;">Hacé hover sobre las imágenes para verlas más grandes. Elegí el conjunto con mejor calidad y variedad.</p>
-"""
+def crear_resumen_html(output_path, conjuntos_info, titulo='🎭 Conjuntos Candidatos para Selección Manual'):
+    """
+    Crea el HTML para visualizar los conjuntos: páginas de POR_PAGINA
+    personas (resumen.html, resumen_2.html, ...) con miniaturas cacheadas en
+    vez de las fotos originales, y una hoja de contacto por persona.
+    """
     
+    output_path = Path(output_path)
+    carpetas = {}
     for conjunto in conjuntos_info:
-        html += f"""
-    <div class="conjunto">
+        for persona in conjunto['personas']:
+            person_folder = output_path / conjunto.get('carpeta', f"conjunto_{conjunto['conjunto']}") / persona['folder']
+            carpetas[(conjunto['conjunto'], persona['id'])] = sorted(person_folder.glob('*.jpg'))
+    
+    print(f"\n🖼️  Generando miniaturas...")
+    miniaturas = Miniaturas()
+    thumbs = miniaturas.construir([img for imagenes in carpetas.values() for img in imagenes])
+    hojas = miniaturas.hojas(carpetas, thumbs)
+    
+    bloques = []
+    for conjunto in conjuntos_info:
+        encabezado = f"""
         <h2>Conjunto {conjunto['conjunto']}</h2>
         <div>
             <span class="stats">Total: {conjunto['total_images']} imágenes</span>
@@ -197,28 +164,16 @@ def crear_resumen_html(output_path, conjuntos_info):
         for persona in conjunto['personas']:
             gender_class = persona['gender']
             gender_label = '👨 Hombre' if persona['gender'] == 'male' else '👩 Mujer'
-            
-            html += f"""
-        <div class="persona {gender_class}">
-            <h3><span class="gender-{gender_class}">{gender_label}</span> - ID: {persona['id']} - {persona['n_images']} imágenes</h3>
-            <div class="images">
-"""
-            
-            person_folder = output_path / f"conjunto_{conjunto['conjunto']}" / persona['folder']
-            images = sorted(list(person_folder.glob('*.jpg')))
-            
-            for img in images:
-                rel_path = img.relative_to(output_path)
-                html += f'<img src="{rel_path}" alt="{img.name}" title="{img.name}">'
-            
-            html += """
-            </div>
-        </div>
-"""
-        
-        html += "</div>"
-    
-    html += """
+            imagenes = carpetas[(conjunto['conjunto'], persona['id'])]
+            if not imagenes:
+                continue
+            titulo_persona = (f'<span class="gender-{gender_class}">{gender_label}</span> - ID: {persona["id"]} '
+                              f'- {persona["n_images"]} imágenes')
+            bloques.append((encabezado, html_persona(output_path, imagenes, thumbs,
+                                                     hojas[(conjunto['conjunto'], persona['id'])],
+                                                     titulo_persona, gender_class)))
+    
+    pie = """
     <div class="instrucciones">
         <h3>📝 Cómo Seleccionar:</h3>
         <ol>
@@ -235,14 +190,10 @@ cp -r ../data/conjuntos_candidatos/conjunto_2 ../data/dataset_final
 mkdir ../data/dataset_final
 cp -r ../data/conjuntos_candidatos/conjunto_1/person_XXXX_male ../data/dataset_final/
         </pre>
-    </div>
-</body>
-</html>
-"""
+    </div>"""
     
-    html_file = output_path / 'resumen.html'
-    with open(html_file, 'w', encoding='utf-8') as f:
-        f.write(html)
+    # Hover y click siguen funcionando: la miniatura se agranda, el click abre la original
+    return escribir_paginas(output_path, 'resumen', titulo, bloques, pie)
 
 def generar_conjunto_extra_grande():
     """Genera conjunto grande con 15 hombres + 15 mujeres"""
@@ -258,27 +209,11 @@ def generar_conjunto_extra_grande():
     identity_file = base_path / 'identity_CelebA.txt'
     attr_file = celeba_path / 'list_attr_celeba.csv'
     
-    identity_df = pd.read_csv(identity_file, sep=' ', header=None, names=['image', 'identity'])
-    attr_df = pd.read_csv(attr_file)
-    df = identity_df.merge(attr_df, left_on='image', right_on='image_id', how='inner')
-    
-    identity_counts = df['identity'].value_counts()
-    valid_identities = identity_counts[(identity_counts >= 4) & (identity_counts <= 8)].index
-    df_filtered = df[df['identity'].isin(valid_identities)]
-    
-    quality_filter = (
-        (df_filtered['Eyeglasses'] == -1) &
-        (df_filtered['Wearing_Hat'] == -1) &
-        (df_filtered['Blurry'] == -1)
-    )
+    metadatos = cargar_metadatos(identity_file, attr_file)
+    seleccion = metadatos.seleccion()
     
-    df_quality = df_filtered[quality_filter]
-    quality_identity_counts = df_quality['identity'].value_counts()
-    final_valid_identities = quality_identity_counts[quality_identity_counts >= 4].index
-    df_final = df_quality[df_quality['identity'].isin(final_valid_identities)]
-    
-    male_ids = df_final[df_final['Male'] == 1]['identity'].unique()
-    female_ids = df_final[df_final['Male'] == -1]['identity'].unique()
+    male_ids = metadatos.personas(seleccion, 1)
+    female_ids = metadatos.personas(seleccion, -1)
     
     np.random.seed(99)
     n_per_gender = 15
@@ -290,27 +225,34 @@ def generar_conjunto_extra_grande():
     output_path = Path('../data/conjunto_extra_grande')
     output_path.mkdir(exist_ok=True)
     
-    print(f"Copiando {len(selected_identities)} personas...")
+    print(f"Enlazando {len(selected_identities)} personas...")
     
     total_copied = 0
+    personas = []
     for identity_id in selected_identities:
-        person_data = df_final[df_final['identity'] == identity_id]
-        person_images = person_data['image'].tolist()
-        person_gender = person_data['Male'].iloc[0]
-        gender_label = 'male' if person_gender == 1 else 'female'
+        person_images = metadatos.imagenes(identity_id, seleccion)
+        gender_label = metadatos.genero(identity_id, seleccion)
         
         person_folder = output_path / f'person_{identity_id:04d}_{gender_label}'
         person_folder.mkdir(exist_ok=True)
         
+        copied = 0
         for img_name in person_images:
             src = img_path / img_name
             dst = person_folder / img_name
             if src.exists():
-                shutil.copy(src, dst)
+                enlazar(src, dst)
                 total_copied += 1
+                copied += 1
+        
+        personas.append({'id': identity_id, 'gender': gender_label, 'n_images': copied, 'folder': person_folder.name})
+    
+    crear_resumen_html(output_path, [{'conjunto': 'EXTRA', 'carpeta': '.', 'personas': personas,
+                                      'total_images': total_copied}], titulo='🎭 Conjunto EXTRA')
     
     print(f"\n✅ Conjunto EXTRA generado: {output_path.absolute()}")
     print(f"   {len(selected_identities)} personas, {total_copied} imágenes totales")
+    print(f"   Revisión: xdg-open {output_path.absolute() / 'resumen.html'}")
 
 if __name__ == "__main__":
     output = generar_conjuntos_candidatos()
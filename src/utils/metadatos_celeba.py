@@ -0,0 +1,135 @@
+# metadatos_celeba.py - Tabla de identidades y atributos de CelebA, cacheada en columnas
+import json
+import os
+from pathlib import Path
+import numpy as np
+
+BASE_PATH = Path('../data')
+IDENTITY_FILE = BASE_PATH / 'identity_CelebA.txt'
+ATTR_FILE = BASE_PATH / 'celeba_data' / 'list_attr_celeba.csv'
+CACHE_DIR = BASE_PATH / 'cache_celeba'
+FILTRO_CALIDAD = ('Eyeglasses', 'Wearing_Hat', 'Blurry') #ATRIBUTOS QUE TIENEN QUE ESTAR EN -1
+
+def _firma(*paths):
+    # Tamaño y mtime de los archivos fuente: si cambian, el cache se descarta
+    return [[str(p), os.stat(p).st_size, os.stat(p).st_mtime_ns] for p in paths]
+
+
+def _construir(identity_file, attr_file):
+    """Parsea y mergea los dos archivos (lo lento), columnas ordenadas por identidad"""
+    import pandas as pd
+
+    identity_df = pd.read_csv(identity_file, sep=' ', header=None, names=['image', 'identity'])
+    attr_df = pd.read_csv(attr_file)
+    df = identity_df.merge(attr_df, left_on='image', right_on='image_id', how='inner')
+
+    # 'orden' guarda la posición original, para reproducir el orden de aparición de antes
+    orden = np.arange(len(df), dtype=np.int64)
+    identity = df['identity'].to_numpy(dtype=np.int32)
+    rows = np.argsort(identity, kind='stable')
+    atributos = [c for c in attr_df.columns if c != 'image_id']
+    columnas = {
+        'image': df['image'].to_numpy(dtype='S')[rows],
+        'identity': identity[rows],
+        'orden': orden[rows],
+    }
+    for nombre in atributos:
+        columnas[f'attr_{nombre}'] = df[nombre].to_numpy(dtype=np.int8)[rows]
+    return columnas
+
+
+class MetadatosCelebA():
+    """
+    Tabla mergeada identidad + atributos, una columna numpy por campo y
+    filas ordenadas por identidad: las imágenes de una persona son el rango
+    inicio[k]:fin[k], sin recorrer la tabla entera.
+    """
+
+    def __init__(self, columnas):
+        self.columnas = columnas
+        self.identity = columnas['identity']
+        self.ids, self.inicio, self.conteo = np.unique(self.identity, return_index=True, return_counts=True)
+        self.fin = self.inicio + self.conteo
+
+    def __len__(self):
+        return len(self.identity)
+
+    def atributo(self, nombre):
+        return self.columnas[f'attr_{nombre}']
+
+    def rango(self, identity_id):
+        k = np.searchsorted(self.ids, identity_id)
+        if k == len(self.ids) or self.ids[k] != identity_id:
+            return slice(0, 0)
+        return slice(self.inicio[k], self.fin[k])
+
+    def _por_identidad(self, valores, ufunc):
+        # Reduce una columna por persona, usando que las filas están agrupadas
+        return ufunc.reduceat(valores, self.inicio) if len(valores) else valores
+
+    def seleccion(self, min_imagenes=4, max_imagenes=8, sin=FILTRO_CALIDAD, min_calidad=4):
+        """
+        Máscara de filas del filtro de siempre: personas con min-max imágenes,
+        imágenes sin `sin`, y personas con al menos `min_calidad` de ellas.
+        """
+        calidad = np.ones(len(self), dtype=bool)
+        for nombre in sin:
+            calidad &= self.atributo(nombre) == -1
+        n_calidad = self._por_identidad(calidad.astype(np.int64), np.add)
+        validas = (self.conteo >= min_imagenes) & (self.conteo <= max_imagenes) & (n_calidad >= min_calidad)
+        return calidad & np.repeat(validas, self.conteo)
+
+    def personas(self, mascara, male=1):
+        """IDs con alguna fila en la máscara y Male == male, en orden de primera aparición en los archivos"""
+        filas = mascara & (self.atributo('Male') == male)
+        orden = np.where(filas, self.columnas['orden'], np.iinfo(np.int64).max)
+        primera = self._por_identidad(orden, np.minimum)
+        hay = self._por_identidad(filas.astype(np.int64), np.add) > 0
+        ids = self.ids[hay]
+        return ids[np.argsort(primera[hay], kind='stable')]
+
+    def genero(self, identity_id, mascara=None):
+        filas = self.rango(identity_id)
+        male = self.atributo('Male')[filas]
+        if mascara is not None:
+            male = male[mascara[filas]]
+        return 'male' if male[0] == 1 else 'female'
+
+    def imagenes(self, identity_id, mascara=None):
+        """Nombres de archivo de una persona (restringidos a la máscara), en el orden original"""
+        # El ordenamiento por identidad fue estable, dentro del rango sigue el orden original
+        filas = self.rango(identity_id)
+        nombres = self.columnas['image'][filas]
+        if mascara is not None:
+            nombres = nombres[mascara[filas]]
+        return [n.decode() for n in nombres]
+
+
+def cargar_metadatos(identity_file=IDENTITY_FILE, attr_file=ATTR_FILE, cache_dir=CACHE_DIR):
+    """MetadatosCelebA desde el cache (.npz + meta.json), reconstruido si cambió algún archivo fuente"""
+    cache_dir = Path(cache_dir)
+    datos, meta = cache_dir / 'metadatos.npz', cache_dir / 'meta.json'
+    firma = _firma(identity_file, attr_file)
+    if datos.exists() and meta.exists() and json.loads(meta.read_text()).get('firma') == firma:
+        with np.load(datos) as npz:
+            return MetadatosCelebA({k: npz[k] for k in npz.files})
+
+    print("📊 Construyendo cache de metadatos CelebA...")
+    columnas = _construir(identity_file, attr_file)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp = cache_dir / 'metadatos.tmp.npz'
+    np.savez(tmp, **columnas)
+    os.replace(tmp, datos)
+    meta.write_text(json.dumps({'firma': firma, 'filas': len(columnas['identity'])}))
+    print(f"   ✓ {len(columnas['identity']):,} registros cacheados en {cache_dir}")
+    return MetadatosCelebA(columnas)
+
+
+if __name__ == "__main__":
+    import time
+    inicio = time.perf_counter()
+    metadatos = cargar_metadatos()
+    mascara = metadatos.seleccion()
+    print(f"✓ {len(metadatos):,} registros, {len(metadatos.ids):,} personas")
+    print(f"✓ Hombres: {len(metadatos.personas(mascara, 1)):,}, Mujeres: {len(metadatos.personas(mascara, -1)):,}")
+    print(f"✓ {time.perf_counter() - inicio:.2f} s")
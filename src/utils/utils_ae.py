@@ -1,3 +1,5 @@
+import numpy as np
+
 def visualize_results(pareto_front, logbook, output_dir='../../results/plots'):
     import matplotlib.pyplot as plt
     from pathlib import Path
@@ -50,19 +52,78 @@ def visualize_results(pareto_front, logbook, output_dir='../../results/plots'):
     
     print(f"Saved visualizations to {output_dir}")
 
-def save_generated_images(pareto_front, stylegan, output_dir='../../results/images'):
+def latent_hash(w):
+    """Short content hash of a latent, used to name its exported files"""
+    import hashlib
+    return hashlib.sha1(np.ascontiguousarray(w, dtype=np.float32).tobytes()).hexdigest()[:12]
+
+def _write_image(img, output_dir, stem, formats, thumb_path, thumbnail):
+    from PIL import Image
+
+    img_pil = Image.fromarray(img)
+    for fmt in formats:
+        options = {'quality': 95} if fmt in ('jpg', 'jpeg', 'webp') else {}
+        img_pil.save(output_dir / f'{stem}.{fmt}', **options)
+    thumb = img_pil.copy()
+    thumb.thumbnail((thumbnail, thumbnail))
+    thumb.save(thumb_path)
+    return thumb
+
+def save_generated_images(pareto_front, stylegan, output_dir='../../results/images', formats=('png',),
+                          thumbnail=128, contact_sheet=True, n_threads=8):
+    """
+    Synthesizes the front in batches (stylegan.generate_batch when the
+    evaluator has it) while a thread pool encodes and writes the files, one
+    per format plus a thumbnail. Files are named after the latent hash, and
+    latents whose thumbnail and requested formats all exist are not
+    synthesized again. The thumbnails are tiled into a single contact_sheet.png.
+    """
+    import math
+    from concurrent.futures import ThreadPoolExecutor
     from pathlib import Path
     from PIL import Image
-    
+
     output_dir = Path(output_dir)
-    output_dir.mkdir(parents=True, exist_ok=True)
-    
-    for i, ind in enumerate(pareto_front):
-        w = np.array(ind)
-        img = stylegan.generate(w)
-        
-]        img_pil = Image.fromarray(img)
-        filename = f'pareto_{i:03d}_f1={ind.fitness.values[0]:.3f}_f2={ind.fitness.values[1]:.3f}.png'
-        img_pil.save(output_dir / filename)
-    
-    print(f"Saved {len(pareto_front)} generated images to {output_dir}")
\ No newline at end of file
+    thumbs_dir = output_dir / 'thumbs'
+    thumbs_dir.mkdir(parents=True, exist_ok=True)
+
+    inds = list(pareto_front)
+    latents = np.array([np.asarray(ind, dtype=np.float32) for ind in inds])
+    hashes = [latent_hash(w) for w in latents]
+    thumb_paths = [thumbs_dir / f'{h}.png' for h in hashes]
+    stems = [f'pareto_{i:03d}_f1={ind.fitness.values[0]:.3f}_f2={ind.fitness.values[1]:.3f}_{h}'
+             for i, (ind, h) in enumerate(zip(inds, hashes))]
+    # A new format (or a renamed stem) needs the image again, not just the thumbnail
+    missing = [i for i, path in enumerate(thumb_paths)
+               if not path.exists() or not all((output_dir / f'{stems[i]}.{fmt}').exists() for fmt in formats)]
+    batch_size = getattr(stylegan, 'batch_size', 16)
+
+    thumbs = {}
+    with ThreadPoolExecutor(n_threads) as pool:
+        futures = {}
+        for start in range(0, len(missing), batch_size):
+            rows = missing[start:start + batch_size]
+            if hasattr(stylegan, 'generate_batch'):
+                imgs = stylegan.generate_batch(latents[rows])
+            else:
+                imgs = [stylegan.generate(latents[i]) for i in rows]
+            # The pool writes this batch while the next one is synthesized
+            for i, img in zip(rows, imgs):
+                futures[i] = pool.submit(_write_image, img, output_dir, stems[i], formats, thumb_paths[i], thumbnail)
+        for i, future in futures.items():
+            thumbs[i] = future.result()
+
+    if contact_sheet and inds:
+        for i, path in enumerate(thumb_paths):
+            if i not in thumbs:
+                thumbs[i] = Image.open(path)
+        cols = math.ceil(math.sqrt(len(inds)))
+        rows = math.ceil(len(inds) / cols)
+        sheet = Image.new('RGB', (cols * thumbnail, rows * thumbnail), 'white')
+        # Sorted by identity similarity, so the sheet reads along the front
+        order = sorted(range(len(inds)), key=lambda i: -inds[i].fitness.values[0])
+        for k, i in enumerate(order):
+            sheet.paste(thumbs[i], ((k % cols) * thumbnail, (k // cols) * thumbnail))
+        sheet.save(output_dir / 'contact_sheet.png')
+
+    print(f"Saved {len(missing)} generated images to {output_dir} ({len(inds) - len(missing)} already there)")
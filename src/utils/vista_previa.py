@@ -0,0 +1,229 @@
+# vista_previa.py - Miniaturas, hojas de contacto y páginas HTML para revisar conjuntos de imágenes
+import hashlib
+import io
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from PIL import Image
+
+SALIDA = Path('../data/miniaturas')
+LADO = 160 #LADO MÁXIMO DE CADA MINIATURA EN PÍXELES
+CALIDAD = 85 #CALIDAD JPEG DE MINIATURAS Y HOJAS
+COLUMNAS = 8 #MINIATURAS POR FILA EN LAS HOJAS DE CONTACTO
+POR_PAGINA = 12 #PERSONAS POR PÁGINA HTML
+
+def enlazar(src, dst):
+    """Hardlink de src en dst (no ocupa espacio ni copia bytes); si el sistema de archivos no lo permite, copia"""
+    src, dst = Path(src), Path(dst)
+    if dst.exists():
+        if os.path.samefile(src, dst):
+            return dst
+        dst.unlink()
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+    return dst
+
+
+def _firma(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _miniatura(src, salida, lado):
+    """(src, sha1): se lee el archivo una vez, el hash nombra la miniatura y solo se genera si falta"""
+    datos = Path(src).read_bytes()
+    sha1 = hashlib.sha1(datos).hexdigest()
+    dst = Path(salida) / f'{sha1}_{lado}.jpg'
+    if not dst.exists():
+        with Image.open(io.BytesIO(datos)) as img:
+            # draft decodifica el JPEG ya reducido, mucho más rápido que abrirlo entero
+            img.draft('RGB', (lado, lado))
+            img = img.convert('RGB')
+            img.thumbnail((lado, lado))
+            tmp = dst.with_suffix(f'.{os.getpid()}.tmp')
+            img.save(tmp, 'JPEG', quality=CALIDAD)
+            tmp.replace(dst)
+    return str(src), sha1
+
+
+def _hoja(miniaturas, dst, lado, columnas):
+    """Pega las miniaturas de una persona en una grilla"""
+    if Path(dst).exists():
+        return dst
+    filas = (len(miniaturas) + columnas - 1) // columnas
+    hoja = Image.new('RGB', (min(len(miniaturas), columnas) * lado, filas * lado), 'white')
+    for i, path in enumerate(miniaturas):
+        with Image.open(path) as img:
+            x = (i % columnas) * lado + (lado - img.width) // 2
+            y = (i // columnas) * lado + (lado - img.height) // 2
+            hoja.paste(img, (x, y))
+    tmp = Path(dst).with_suffix(f'.{os.getpid()}.tmp')
+    hoja.save(tmp, 'JPEG', quality=CALIDAD)
+    tmp.replace(dst)
+    return dst
+
+
+class Miniaturas():
+    """
+    Cache de miniaturas por contenido: <sha1>_<lado>.jpg en `salida`. Un
+    index.json guarda tamaño, mtime y sha1 de cada imagen ya vista, así en
+    una nueva corrida las imágenes sin cambios ni se leen. Las que faltan se
+    hashean y reducen en un pool de procesos.
+    """
+
+    def __init__(self, salida=SALIDA, lado=LADO, n_procesos=None):
+        self.salida = Path(salida)
+        self.lado = lado
+        self.n_procesos = n_procesos or os.cpu_count() or 1
+        self.salida.mkdir(parents=True, exist_ok=True)
+        (self.salida / 'hojas').mkdir(exist_ok=True)
+        self.index_file = self.salida / 'index.json'
+        self.index = json.loads(self.index_file.read_text()) if self.index_file.exists() else {}
+
+    def path(self, sha1):
+        return self.salida / f'{sha1}_{self.lado}.jpg'
+
+    def _pool(self, n_tareas):
+        return ProcessPoolExecutor(max(1, min(self.n_procesos, n_tareas)))
+
+    def construir(self, imagenes):
+        """Miniatura de cada imagen, {imagen: path de la miniatura}"""
+        imagenes = [Path(img) for img in imagenes]
+        sha1s, pendientes = {}, []
+        for img in imagenes:
+            clave = str(img.absolute())
+            previo = self.index.get(clave)
+            if previo is not None and previo[:2] == _firma(img) and self.path(previo[2]).exists():
+                sha1s[img] = previo[2]
+            else:
+                pendientes.append(img)
+
+        if pendientes:
+            with self._pool(len(pendientes)) as pool:
+                chunksize = max(1, len(pendientes) // (4 * self.n_procesos))
+                for src, sha1 in pool.map(_miniatura, pendientes, [self.salida] * len(pendientes),
+                                          [self.lado] * len(pendientes), chunksize=chunksize):
+                    src = Path(src)
+                    sha1s[src] = sha1
+                    self.index[str(src.absolute())] = _firma(src) + [sha1]
+            tmp = self.index_file.with_suffix('.tmp')
+            tmp.write_text(json.dumps(self.index))
+            tmp.replace(self.index_file)
+        print(f"   ✓ Miniaturas: {len(imagenes) - len(pendientes):,} del cache, {len(pendientes):,} nuevas")
+        return {img: self.path(sha1s[img]) for img in imagenes}
+
+    def hojas(self, grupos, miniaturas=None, columnas=COLUMNAS):
+        """
+        Hoja de contacto de cada grupo ({nombre: [imágenes]}), {nombre: path}.
+        `miniaturas` es lo que devolvió construir() si ya se llamó. El nombre
+        de la hoja sale del contenido de sus imágenes, se reutiliza mientras
+        no cambien.
+        """
+        if miniaturas is None:
+            miniaturas = self.construir([img for imagenes in grupos.values() for img in imagenes])
+        tareas = {}
+        for nombre, imagenes in grupos.items():
+            thumbs = [str(miniaturas[Path(img)]) for img in imagenes]
+            if not thumbs:
+                continue
+            clave = hashlib.sha1('|'.join(Path(t).name for t in thumbs).encode() + str(columnas).encode())
+            tareas[nombre] = (thumbs, self.salida / 'hojas' / f'{clave.hexdigest()}.jpg')
+        faltan = [nombre for nombre, (_, dst) in tareas.items() if not dst.exists()]
+        if faltan:
+            with self._pool(len(faltan)) as pool:
+                list(pool.map(_hoja, [tareas[n][0] for n in faltan], [tareas[n][1] for n in faltan],
+                              [self.lado] * len(faltan), [columnas] * len(faltan)))
+        return {nombre: dst for nombre, (_, dst) in tareas.items()}
+
+
+ESTILO = """
+        body { font-family: Arial, sans-serif; margin: 20px; background-color: #f5f5f5; }
+        h1 { color: #333; text-align: center; }
+        .conjunto { background: white; margin: 20px 0; padding: 20px; border-radius: 10px; box-shadow: 0 2px 5px rgba(0,0,0,0.1); }
+        .conjunto h2 { color: #333; border-bottom: 2px solid #4CAF50; padding-bottom: 10px; }
+        .persona { margin: 20px 0; padding: 15px; background: #fafafa; border-left: 4px solid #2196F3; }
+        .persona.male { border-left-color: #2196F3; }
+        .persona.female { border-left-color: #E91E63; }
+        .images { display: flex; flex-wrap: wrap; gap: 10px; margin-top: 10px; }
+        .images img { max-width: 150px; max-height: 150px; border: 2px solid #ddd; border-radius: 5px; transition: transform 0.2s; cursor: pointer; }
+        .images img:hover { transform: scale(2); z-index: 1000; box-shadow: 0 4px 8px rgba(0,0,0,0.3); }
+        .stats { display: inline-block; background: #e3f2fd; padding: 5px 15px; border-radius: 20px; margin: 5px; font-size: 14px; }
+        .gender-male { color: #1976D2; font-weight: bold; }
+        .gender-female { color: #C2185B; font-weight: bold; }
+        .paginas { text-align: center; margin: 20px 0; }
+        .paginas a, .paginas b { display: inline-block; padding: 5px 10px; margin: 2px; border-radius: 5px; background: white; }
+        .instrucciones { margin-top: 40px; padding: 20px; background: #fff3cd; border-radius: 10px; border-left: 5px solid #ffc107; }
+"""
+
+def nombre_pagina(nombre, pagina):
+    # La primera página conserva el nombre de siempre, es la que se abre
+    return f'{nombre}.html' if pagina == 0 else f'{nombre}_{pagina + 1}.html'
+
+
+def escribir_paginas(output_path, nombre, titulo, bloques, pie='', por_pagina=POR_PAGINA):
+    """
+    Reparte `bloques` (pares (encabezado de sección, html de una persona)) en
+    páginas de `por_pagina` personas; si una sección sigue en la página
+    siguiente su encabezado se repite. Devuelve el path de la primera página.
+    """
+    output_path = Path(output_path)
+    paginas = [bloques[i:i + por_pagina] for i in range(0, len(bloques), por_pagina)] or [[]]
+    for n, pagina in enumerate(paginas):
+        navegacion = ' '.join(f'<b>{i + 1}</b>' if i == n else f'<a href="{nombre_pagina(nombre, i)}">{i + 1}</a>'
+                              for i in range(len(paginas)))
+        html = f"""<!DOCTYPE html>
+<html>
+<head>
+    <title>{titulo} ({n + 1}/{len(paginas)})</title>
+    <meta charset="UTF-8">
+    <style>{ESTILO}    </style>
+</head>
+<body>
+    <h1>{titulo}</h1>
+    <div class="paginas">{navegacion}</div>
+"""
+        seccion = None
+        for encabezado, persona in pagina:
+            if encabezado != seccion:
+                if seccion is not None:
+                    html += "\n    </div>"
+                html += f"\n    <div class=\"conjunto\">{encabezado}"
+                seccion = encabezado
+            html += persona
+        if seccion is not None:
+            html += "\n    </div>"
+        html += f"""
+    <div class="paginas">{navegacion}</div>
+{pie if n == len(paginas) - 1 else ''}
+</body>
+</html>
+"""
+        (output_path / nombre_pagina(nombre, n)).write_text(html, encoding='utf-8')
+    # Páginas de una corrida anterior con más personas
+    n = len(paginas)
+    while (output_path / nombre_pagina(nombre, n)).exists():
+        (output_path / nombre_pagina(nombre, n)).unlink()
+        n += 1
+    return output_path / nombre_pagina(nombre, 0)
+
+
+def html_persona(output_path, imagenes, miniaturas, hoja, titulo, gender=None):
+    """Bloque de una persona: miniaturas (click abre la original) y link a su hoja de contacto"""
+    relativo = lambda path: Path(os.path.relpath(Path(path).absolute(), Path(output_path).absolute())).as_posix()
+    html = f"""
+        <div class="persona {gender or ''}">
+            <h3>{titulo} - <a href="{relativo(hoja)}">hoja de contacto</a></h3>
+            <div class="images">
+"""
+    for img in imagenes:
+        html += (f'<a href="{relativo(img)}"><img src="{relativo(miniaturas[Path(img)])}" loading="lazy" '
+                 f'alt="{Path(img).name}" title="{Path(img).name}"></a>')
+    html += """
+            </div>
+        </div>
+"""
+    return html